@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+    This python file checks that the uploads of a sync are preempted when their file is saved again before they start,
+    with a single target. A local SSH server with a bandwidth limit is started on localhost, a cycle uploading a few
+    files is started, and the files are rewritten while most of them are still queued. The cycle must preempt them
+    instead of sending the stale versions, and the next cycle must bring the server repo back in sync.
+
+        python benchmarks/check_preemption.py
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.local_server import LocalSSHServer
+from benchmarks.run_benchmarks import trees_equal, write_init_file
+from benchmarks.trees import write_file
+from ssh_deployer.__main__ import Deployer
+from ssh_deployer.init_file_parser.init_file_parser import InitFileParser
+
+
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--files', dest='files', type=int, default=16, help='Number of files uploaded by the first cycle')
+    parser.add_argument('--file-size', dest='file_size', type=int, default=256 * 1024, help='Size of each file, in bytes')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float, default=1.0,
+                        help='Bandwidth of the emulated link in each direction, in MB/s')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the generated files')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='Turns on verbosity')
+
+    args = parser.parse_args()
+
+    preempted, in_sync = check_preemption(args.files, args.file_size, int(args.bandwidth * 1e6), args.seed, args.verbose)
+
+    print("{} upload(s) preempted, {}".format(preempted, "in sync" if in_sync else "OUT OF SYNC"))
+
+    sys.exit(0 if preempted and in_sync else 1)
+
+
+def check_preemption(files, file_size, bandwidth, seed, verbose=False):
+    """
+        This method runs the check in a temporary directory.
+
+        :param int files: The number of files uploaded by the first cycle.
+        :param int file_size: The size of each file, above the bulk upload size so that they go through the queue.
+        :param int bandwidth: Bandwidth of the emulated link, in bytes per second.
+        :param int seed: Seed of the generated files.
+        :param bool verbose: Turns on the verbosity of the deployer.
+
+        :return: The number of uploads the first cycle preempted, and T/F based on if the server repo is in sync after
+                 the second cycle.
+    """
+
+    rng = random.Random(seed)
+
+    work_directory = tempfile.mkdtemp(prefix="ssh_deployer_preemption_")
+    local_repo = os.path.join(work_directory, "local") + "/"
+    server_repo = os.path.join(work_directory, "server") + "/"
+    os.makedirs(local_repo)
+    os.makedirs(server_repo)
+
+    server = LocalSSHServer(os.path.join(work_directory, "known_hosts"), bandwidth=bandwidth)
+    server.start()
+
+    try:
+        paths = [os.path.join(local_repo, "f{}.bin".format(index)) for index in range(files)]
+        for path in paths:
+            write_file(path, file_size, rng)
+
+        # One upload at a time, so that the others wait in the queue
+        init_path = write_init_file(work_directory, server, local_repo, server_repo,
+                                    {"Upload Workers": 1, "Bulk Upload Max File Size": file_size // 2})
+        fp = InitFileParser(init_file_path=init_path)
+        fp.parse_init_file()
+        deployer = Deployer(fp, verbose=verbose)
+
+        records = []
+        cycle = threading.Thread(target=lambda: records.append(deployer.run_cycle()))
+        cycle.start()
+
+        # Saved again once the first uploads started, the stat signature of the queued files changes
+        time.sleep(file_size / bandwidth + 0.5)
+        for path in paths:
+            write_file(path, file_size, rng)
+        cycle.join()
+
+        deployer.run_cycle()
+        deployer.close()
+        del deployer
+
+        return records[0]["counters"].get("files_upload_preempted", 0), trees_equal(local_repo, server_repo)
+
+    finally:
+        server.stop()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    main()
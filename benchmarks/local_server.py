@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the local_server used by the benchmarks in place of a real remote host. It is a paramiko SSH
+    server listening on localhost that accepts any user, serves SFTP over the local file system and runs exec requests
+    with /bin/sh, which is everything the ssh_agent needs. A latency and a bandwidth limit can be injected between the
+    client and the server to approximate a remote link.
+
+    It is only meant for benchmarks and tests, it does not authenticate anyone.
+"""
+
+import errno
+import heapq
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import (AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer,
+                      SFTPServerInterface)
+
+READ_SIZE = 65536
+
+
+class LocalSSHServer():
+    """
+        This is the local SSH server class. It listens on a free port of 127.0.0.1 and writes its host key to its own
+        known hosts file, pass both to the SSHAgent (or the "Port" and "Known Hosts File" keys of the init file).
+
+        :param float latency: The one way delay, in seconds, added to everything sent in both directions.
+        :param int bandwidth: The maximum amount of bytes per second sent in each direction, 0 for no limit.
+    """
+    def __init__(self, known_hosts_file, latency=0.0, bandwidth=0):
+
+        self.known_hosts_file = known_hosts_file
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(64)
+        self.port = self.socket.getsockname()[1]
+
+        with open(self.known_hosts_file, "w") as known_hosts:
+            known_hosts.write("[127.0.0.1]:{} {} {}\n".format(self.port, self.host_key.get_name(),
+                                                               self.host_key.get_base64()))
+
+        self.transports = []
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+            This method starts accepting connections in a background thread.
+        """
+
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_connections, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            This method stops accepting connections and closes the open ones.
+        """
+
+        self.running = False
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _accept_connections(self):
+
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+
+            if self.latency or self.bandwidth:
+                # The transport talks to one end of a socket pair, the link is emulated between the other end and the
+                # client
+                server_end, link_end = socket.socketpair()
+                _ThrottledLink(client, link_end, self.latency, self.bandwidth).start()
+                _ThrottledLink(link_end, client, self.latency, self.bandwidth).start()
+                client = server_end
+
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, _LocalSFTPServer)
+            transport.start_server(server=_LocalServerInterface())
+            self.transports.append(transport)
+
+
+class _ThrottledLink():
+    """
+        One direction of an emulated link. Data read from the source is written to the destination after the latency,
+        and no faster than the bandwidth. Reading and writing are done by two threads so that data keeps being read
+        while older data is delayed, like on a real link.
+    """
+    def __init__(self, source, destination, latency, bandwidth):
+
+        self.source = source
+        self.destination = destination
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        # (due time, sequence number, data)
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def start(self):
+
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _read(self):
+
+        while True:
+            try:
+                data = self.source.recv(READ_SIZE)
+            except OSError:
+                data = b""
+
+            with self.condition:
+                if not data:
+                    self.closed = True
+                else:
+                    heapq.heappush(self.queue, (time.monotonic() + self.latency, self.sequence, data))
+                    self.sequence += 1
+                self.condition.notify()
+
+            if not data:
+                return
+
+    def _write(self):
+
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                due, _, data = heapq.heappop(self.queue)
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                self.destination.sendall(data)
+            except OSError:
+                break
+
+            if self.bandwidth:
+                time.sleep(len(data) / self.bandwidth)
+
+        try:
+            self.destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class _LocalServerInterface(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return "password,publickey,none"
+
+    def check_auth_none(self, username):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_command, args=(channel, command.decode(errors="surrogateescape")),
+                         daemon=True).start()
+        return True
+
+
+def _run_command(channel, command):
+    """
+        This method runs an exec request with /bin/sh, forwarding the channel to the stdin of the command and its stdout
+        and stderr to the channel, and then sends its exit status.
+    """
+
+    process = subprocess.Popen(["/bin/sh", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def forward_stdin():
+        try:
+            # Flushed as it comes, like sshd, for commands that answer requests as they read them
+            for data in iter(lambda: channel.recv(READ_SIZE), b""):
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+        except (OSError, EOFError):
+            pass
+
+    def forward_stderr():
+        for data in iter(lambda: process.stderr.read1(READ_SIZE), b""):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target=forward_stdin, daemon=True).start()
+    stderr_thread = threading.Thread(target=forward_stderr, daemon=True)
+    stderr_thread.start()
+
+    for data in iter(lambda: process.stdout.read1(READ_SIZE), b""):
+        channel.sendall(data)
+
+    stderr_thread.join()
+    channel.send_exit_status(process.wait())
+    channel.shutdown_write()
+    channel.close()
+
+
+class _LocalFileHandle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class _LocalSFTPServer(SFTPServerInterface):
+    """
+        An SFTP server over the local file system, paths are used as they are received.
+    """
+
+    def list_folder(self, path):
+        try:
+            ret_val = []
+            for name in os.listdir(path):
+                attributes = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attributes.filename = name
+                ret_val.append(attributes)
+            return ret_val
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+
+        handle = _LocalFileHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            return SFTPServer.convert_errno(errno.EEXIST)
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        if getattr(attr, "st_mtime", None) is not None:
+            return self._call(os.utime, path, (attr.st_atime, attr.st_mtime))
+        return SFTP_OK
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+    This python file runs the benchmarks of the ssh_deployer. For each synthetic tree, a local SSH server is started on
+    localhost, the tree is deployed to an empty server repo, the deployer is restarted, and each churn pattern is applied
+    to the local repo before timing the sync cycle that follows. Every cycle runs the full Deployer.run_cycle(): local
+    scan, server scan, diff and transfers, and its metrics (time per phase, bytes uploaded, files hashed...) are kept
+    with its result. The server repo is compared with the local repo after each cycle.
+
+    The results are written as JSON so that runs of different versions can be compared:
+
+        python benchmarks/run_benchmarks.py -o results.json --latency 20 --bandwidth 10
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paramiko
+
+from benchmarks.local_server import LocalSSHServer
+from benchmarks.trees import CHURNS, TREES, list_files
+from ssh_deployer.__main__ import Deployer
+from ssh_deployer.init_file_parser.init_file_parser import InitFileParser
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-o', '--output', dest='output', action='store', default="benchmark_results.json",
+                        help='Path of the JSON results file')
+    parser.add_argument('-t', '--trees', dest='trees', nargs='+', choices=list(TREES), default=list(TREES),
+                        help='Trees to benchmark')
+    parser.add_argument('-c', '--churns', dest='churns', nargs='+', choices=list(CHURNS), default=list(CHURNS),
+                        help='Churn patterns applied between cycles')
+    parser.add_argument('-s', '--scale', dest='scale', type=float, default=1.0,
+                        help='Factor applied to the number and size of the generated files')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                        help='One way latency of the emulated link, in milliseconds')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float, default=0.0,
+                        help='Bandwidth of the emulated link in each direction, in MB/s, 0 for no limit')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the generated trees')
+    parser.add_argument('--performance', dest='performance', action='store', default=None,
+                        help='JSON object of "Performance" init file settings to benchmark with')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
+                        help='Turns on the verbosity of the deployer')
+
+    args = parser.parse_args()
+
+    performance = json.loads(args.performance) if args.performance else {}
+
+    results = {
+        "version": RESULTS_FORMAT_VERSION,
+        "commit": get_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "paramiko": paramiko.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "latency_ms": args.latency,
+        "bandwidth_mb_s": args.bandwidth,
+        "scale": args.scale,
+        "seed": args.seed,
+        "performance": performance,
+        "results": []
+    }
+
+    for tree_name in args.trees:
+        results["results"].extend(run_tree_benchmark(tree_name, args.churns, args.scale, args.seed, args.latency / 1000,
+                                                     int(args.bandwidth * 1000 * 1000), performance, args.verbose))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    print("Results written to {}".format(args.output))
+
+
+def run_tree_benchmark(tree_name, churn_names, scale, seed, latency, bandwidth, performance, verbose=False):
+    """
+        This method runs the benchmark of one tree in a temporary directory.
+
+        :param str tree_name: The name of the tree, a key of TREES.
+        :param list churn_names: The names of the churn patterns, keys of CHURNS.
+        :param float scale: Factor applied to the number and size of the generated files.
+        :param int seed: Seed of the generated tree.
+        :param float latency: One way latency of the emulated link, in seconds.
+        :param int bandwidth: Bandwidth of the emulated link, in bytes per second.
+        :param dict performance: "Performance" init file settings.
+        :param bool verbose: Turns on the verbosity of the deployer.
+
+        :return: A list with the result of each cycle.
+    """
+
+    ret_val = []
+    rng = random.Random(seed)
+
+    work_directory = tempfile.mkdtemp(prefix="ssh_deployer_benchmark_")
+    local_repo = os.path.join(work_directory, "local") + "/"
+    server_repo = os.path.join(work_directory, "server") + "/"
+    os.makedirs(local_repo)
+    os.makedirs(server_repo)
+
+    server = LocalSSHServer(os.path.join(work_directory, "known_hosts"), latency=latency, bandwidth=bandwidth)
+    server.start()
+
+    try:
+        print("Generating tree {}: {}".format(tree_name, TREES[tree_name][0]))
+        TREES[tree_name][1](local_repo, rng, scale)
+
+        init_path = write_init_file(work_directory, server, local_repo, server_repo, performance)
+
+        # The first cycle deploys the whole tree, the second one is the first cycle of a restarted deployer
+        cycles = [("initial", None, True), ("restart", None, True)]
+        cycles.extend((churn_name, churn_name, False) for churn_name in churn_names)
+
+        deployer = None
+        for cycle_name, churn_name, new_deployer in cycles:
+
+            if churn_name is not None:
+                CHURNS[churn_name][1](local_repo, rng)
+
+            if new_deployer:
+                if deployer is not None:
+                    deployer.close()
+                    del deployer
+                fp = InitFileParser(init_file_path=init_path)
+                fp.parse_init_file()
+                deployer = Deployer(fp, verbose=verbose)
+
+            files, size = get_tree_size(local_repo)
+
+            start_time = time.perf_counter()
+            record = deployer.run_cycle()
+            elapsed = time.perf_counter() - start_time
+
+            in_sync = trees_equal(local_repo, server_repo)
+
+            print("{:>16} {:>20}: {:8.3f}(s) {}".format(tree_name, cycle_name, elapsed, "" if in_sync else "OUT OF SYNC"))
+
+            ret_val.append({
+                "tree": tree_name,
+                "cycle": cycle_name,
+                "files": files,
+                "bytes": size,
+                "seconds": elapsed,
+                "in_sync": in_sync,
+                "phases": record["phases"],
+                "operations": record["operations"],
+                "counters": record["counters"]
+            })
+
+        deployer.close()
+        del deployer
+
+    finally:
+        server.stop()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    return ret_val
+
+
+def write_init_file(work_directory, server, local_repo, server_repo, performance):
+    """
+        This method writes the init file of a benchmark run. The caches are kept in the work directory so that runs do
+        not share them.
+
+        :return: The path to the init file.
+    """
+
+    init_json = {
+        "SSH Connection": {
+            "Host": "127.0.0.1",
+            "User": "benchmark",
+            "Port": server.port,
+            "Known Hosts File": server.known_hosts_file
+        },
+        "Deployment": {
+            "Local Repo Path": local_repo,
+            "Server Repo Path": server_repo,
+            "Ignored Files": [],
+            "Do Not Delete": []
+        },
+        "Config": {
+            "Pause": False,
+            "Shutdown": False,
+            "Loop Delay": 0
+        },
+        "Performance": dict({
+            "Hash Cache Path": os.path.join(work_directory, "hash_cache.json"),
+            "Server Snapshot Path": os.path.join(work_directory, "server_snapshot.bin")
+        }, **performance)
+    }
+
+    init_path = os.path.join(work_directory, "ssh_deployer_init.json")
+    with open(init_path, "w") as init_file:
+        json.dump(init_json, init_file, indent=2)
+
+    return init_path
+
+
+# ////////////////////// Helpers ////////////////////// #
+
+def get_commit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_tree_size(root):
+
+    files = list_files(root)
+
+    return len(files), sum(os.path.getsize(os.path.join(root, file)) for file in files)
+
+
+def trees_equal(root_a, root_b):
+
+    files = list_files(root_a)
+    if files != list_files(root_b):
+        return False
+
+    for file in files:
+        if _hash_file(os.path.join(root_a, file)) != _hash_file(os.path.join(root_b, file)):
+            return False
+
+    return True
+
+
+def _hash_file(path):
+
+    h = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the generators of the synthetic repos used by the benchmarks, and the churn patterns applied
+    to them between two sync cycles. Everything is generated from a seeded random generator so that two runs of the
+    benchmarks work on the same trees.
+"""
+
+import os
+import random
+
+# Name -> (description, generator)
+TREES = {}
+
+# Name -> (description, churn function)
+CHURNS = {}
+
+
+def tree(description):
+
+    def register(function):
+        TREES[function.__name__] = (description, function)
+        return function
+
+    return register
+
+
+def churn(description):
+
+    def register(function):
+        CHURNS[function.__name__] = (description, function)
+        return function
+
+    return register
+
+
+def write_file(path, size, rng):
+    """
+        This method writes a file of random content.
+
+        :param str path: The path to the file.
+        :param int size: The size of the file.
+        :param random.Random rng: The random generator.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 1024 * 1024)
+            file.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+
+def list_files(root):
+    """
+        This method lists the files of a tree.
+
+        :param str root: The path to the tree.
+
+        :return: The sorted list of the paths of the files, relative to the tree.
+    """
+
+    ret_val = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            ret_val.append(os.path.relpath(os.path.join(directory, name), root))
+
+    return sorted(ret_val)
+
+
+# ////////////////////// Trees ////////////////////// #
+
+@tree("20000 files of 10 to 2000 bytes in 200 directories")
+def tiny_files(root, rng, scale=1.0):
+
+    for index in range(int(20000 * scale)):
+        write_file(os.path.join(root, "d{}".format(index % 200), "f{}.txt".format(index)), rng.randint(10, 2000), rng)
+
+
+@tree("8 files of 32 MiB")
+def huge_files(root, rng, scale=1.0):
+
+    for index in range(8):
+        write_file(os.path.join(root, "huge{}.bin".format(index)), int(32 * 1024 * 1024 * scale), rng)
+
+
+@tree("4000 files of 1 KiB in directories nested 40 levels deep")
+def deep_nesting(root, rng, scale=1.0):
+
+    for index in range(int(4000 * scale)):
+        depth = index % 40
+        directory = os.path.join(root, *["n{}".format(level) for level in range(depth)])
+        write_file(os.path.join(directory, "f{}.txt".format(index)), 1024, rng)
+
+
+@tree("A source tree like mix: 5000 small files, 200 medium files and 4 large files")
+def mixed(root, rng, scale=1.0):
+
+    for index in range(int(5000 * scale)):
+        write_file(os.path.join(root, "src", "m{}".format(index % 50), "s{}.py".format(index)), rng.randint(100, 20000), rng)
+    for index in range(int(200 * scale)):
+        write_file(os.path.join(root, "assets", "a{}.png".format(index)), rng.randint(100000, 1000000), rng)
+    for index in range(4):
+        write_file(os.path.join(root, "data", "l{}.bin".format(index)), int(16 * 1024 * 1024 * scale), rng)
+
+
+# ////////////////////// Churns ////////////////////// #
+
+@churn("Nothing changes")
+def no_change(root, rng):
+
+    pass
+
+
+@churn("1% of the files are rewritten")
+def modify_few(root, rng):
+
+    files = list_files(root)
+    for file in rng.sample(files, max(1, len(files) // 100)):
+        path = os.path.join(root, file)
+        write_file(path, os.path.getsize(path), rng)
+
+
+@churn("A few bytes are changed in the middle of every file larger than 1 MiB")
+def patch_large(root, rng):
+
+    for file in list_files(root):
+        path = os.path.join(root, file)
+        size = os.path.getsize(path)
+        if size > 1024 * 1024:
+            with open(path, "r+b") as f:
+                f.seek(size // 2)
+                f.write(rng.randbytes(64))
+
+
+@churn("10% of the files are deleted and as many are added")
+def add_delete(root, rng):
+
+    files = list_files(root)
+    for index, file in enumerate(rng.sample(files, max(1, len(files) // 10))):
+        path = os.path.join(root, file)
+        size = os.path.getsize(path)
+        os.remove(path)
+        write_file(os.path.join(root, "added", "a{}.bin".format(index)), size, rng)
+
+
+@churn("10% of the directories are renamed")
+def rename_directories(root, rng):
+
+    directories = sorted({os.path.dirname(file) for file in list_files(root) if os.path.dirname(file)})
+    # Deepest first so that renaming a directory never invalidates the path of another one of the sample
+    for directory in sorted(rng.sample(directories, max(1, len(directories) // 10)), key=len, reverse=True):
+        path = os.path.join(root, directory)
+        os.rename(path, path + "_renamed")
@@ -14,6 +14,9 @@
         - The path to the local in the ssh server that the repo will be copied to.
         - A list of all ignored files that will be ignored by the deployer.
 
+    The "Deployment" and "SSH Connection" groups can also be lists: a single deployer process then deploys several local
+    repos, each one to one or several servers, sharing one SSH connection per server.
+
     The deployer will run in an infinite loop until the init file specifies to be shutdown and will constantly update
     the repo on the server with any changes made to the local repo.
 """
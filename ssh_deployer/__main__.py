@@ -1,22 +1,45 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
 import signal
 import datetime
 import time
 import sys
 import json
 import os
-import hashlib
-
+import concurrent.futures
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ssh_deployer.directory_tree.directory_tree import (DirectoryTree, copy_tree, get_element, get_metadata_value,
+                                                        is_file_value, parse_metadata_value, set_element,
+                                                        trees_differ)
+from ssh_deployer.hash_cache.hash_cache import HashCache
+from ssh_deployer.hash_engine.hash_engine import (DEFAULT_HASH_ENGINE, SAMPLED_CAPABILITY, HashEngine,
+                                                  choose_hash_algorithm)
+from ssh_deployer.ignore_matcher.ignore_matcher import IgnoreMatcher
 from ssh_deployer.init_file_parser.init_file_parser import InitFileParser
-from ssh_deployer.ssh_agent.ssh_agent import SSHAgent
+from ssh_deployer.metrics.metrics import Metrics
+from ssh_deployer.scheduler.scheduler import Scheduler
+from ssh_deployer.server_snapshot.server_snapshot import ServerSnapshot
+from ssh_deployer.ssh_agent.connection_pool import ConnectionPool
+from ssh_deployer.ssh_agent.ssh_agent import RACY_MTIME_WINDOW, UPLOAD_PART_SUFFIX, SSHAgent, get_server_mtime
+from ssh_deployer.transfer_queue.transfer_queue import TokenBucket, TransferQueue
+from ssh_deployer.watcher.watcher import InotifyWatcher, WatcherError
 
 loop_start_msg = "+---------- Start of loop ----------+"
 loop_end_msg = "+---------- End of loop ----------+"
 
 running = True
 
+# Below this number of files to hash, a worker pool costs more than it saves
+MIN_PARALLEL_HASH_FILES = 16
+
+# Seconds before a target whose sync failed is retried, doubled with each failure up to the maximum
+TARGET_RETRY_DELAY = 5
+MAX_TARGET_RETRY_DELAY = 300
+
 
 def main():
     
@@ -32,6 +55,10 @@ def main():
         loop_print("Cleaning up, please wait")
         global running
         running = False
+        if scheduler is not None:
+            scheduler.wake()
+
+    scheduler = None
 
     signal.signal(signal.SIGINT, sigint_handler)
 
@@ -50,7 +77,15 @@ def main():
     if not fp.parse_init_file():
         raise ValueError("Init file was not correctly parsed")
 
-    ssh_agent = SSHAgent(fp.ssh_host, fp.ssh_user, verbose=v)
+    # Every deployment of the init file runs in this process, sharing the metrics and one connection per server
+    metrics = Metrics(json_lines_file=fp.metrics_json_lines_file, prometheus_file=fp.metrics_prometheus_file)
+    connection_pool = ConnectionPool(verbose=v, metrics=metrics)
+    bandwidth_limiter = TokenBucket(fp.bandwidth_limit) if fp.bandwidth_limit else None
+
+    deployers = [Deployer(fp, deployment, verbose=v, metrics=metrics, connection_pool=connection_pool,
+                          bandwidth_limiter=bandwidth_limiter)
+                 for deployment in fp.deployments]
+    scheduler = Scheduler(deployers, verbose=v, config_path=args.init_path)
 
     while running:
         loop_print(loop_start_msg)
@@ -65,87 +100,899 @@ def main():
         elif pause:
 
             loop_print("Deployer is paused")
-            pass
+            scheduler.wait_for_config(loop_delay, fp.watch_debounce)
 
         else:
 
-            # Check the structures of each repo
-            scan_local_repo = get_local_directory_structure(fp.deployment_local, fp.ignore_files)
-            scan_server_repo = ssh_agent.get_server_directory_structure(fp.deployment_server, fp.do_not_delete)
+            scheduler.run_due_cycles(loop_delay)
+            scheduler.wait(loop_delay, fp.watch_debounce)
 
-            loop_print("Server repo structure:")
-            loop_print(json.dumps(scan_server_repo, indent=4))
+        loop_print(loop_end_msg)
 
-            if scan_local_repo != scan_server_repo:
+    scheduler.close()
+    connection_pool.close()
 
-                files_to_copy = get_copy_actions_from_diff(scan_local_repo, scan_server_repo)
-                files_to_del = get_delete_actions_from_diff(scan_local_repo, scan_server_repo)
+    del fp
+    del scheduler
 
-                for file in files_to_copy:
-                    local_file = fp.deployment_local + file
-                    server_dir = os.path.dirname(fp.deployment_server + file)
-                    ssh_agent.copy_file_to_server(local_file, server_dir)
+    sys.exit(0)
+
+
+class Deployer():
+    """
+        This is the Deployer class. It holds everything needed to keep the server repos of the targets in sync with a
+        local repo, the caches, the state of the last sync and the targets, and runs one sync cycle at a time. There is
+        one per deployment of the init file, the Scheduler of the main() loop drives them, the benchmarks call it
+        directly.
+
+        The local repo is scanned and hashed once per cycle for all the targets, each target then syncs its server repo
+        in its own thread (see DeploymentTarget).
+    """
+    def __init__(self, fp, deployment=None, verbose=False, metrics=None, connection_pool=None, bandwidth_limiter=None):
+
+        self.fp = fp
+        self.verbose = verbose
+
+        # One of fp.deployments, the first one by default
+        deployment = deployment if deployment is not None else fp.deployments[0]
+        self.name = deployment["name"]
+        self.deployment_local = deployment["deployment_local"]
+        self.ignore_files = deployment["ignore_files"]
+
+        if metrics is None:
+            metrics = Metrics(json_lines_file=fp.metrics_json_lines_file, prometheus_file=fp.metrics_prometheus_file)
+        self.metrics = metrics
+
+        # The bandwidth limit is shared by every deployment of the process, main() gives them the same TokenBucket
+        if bandwidth_limiter is None and fp.bandwidth_limit:
+            bandwidth_limiter = TokenBucket(fp.bandwidth_limit)
+
+        self.hash_cache = HashCache(self.deployment_local, cache_path=deployment["hash_cache_path"],
+                                    max_entries=fp.hash_cache_size, verbose=verbose)
+
+        self.targets = [DeploymentTarget(fp, deployment, target, index, metrics=self.metrics, verbose=verbose,
+                                         connection_pool=connection_pool, bandwidth_limiter=bandwidth_limiter)
+                        for index, target in enumerate(deployment["targets"])]
+
+        self.watcher = None
+        if fp.watch_mode:
+            try:
+                self.watcher = InotifyWatcher(self.deployment_local, self.ignore_files, verbose=verbose)
+            except WatcherError as e:
+                print("!!! ERROR: Watch mode disabled, falling back to polling: [{}] !!!".format(e))
+
+        # In watch mode this holds the local repo structure as of the last sync, which is also the state of the server
+        # repo of every target in sync
+        self.synced_repo = None
+        self.synced_compare_mode = None
+        self.last_full_sync = None
+        self.last_verification = time.monotonic()
+        self.last_cycle_end = None
+        self.dirty_paths = set()
+
+        # Whether the last full sync found the local repo changed, and the number of cycles in a row that found nothing
+        # to do, the polling backs off with them (see get_next_cycle_time())
+        self.local_changed = True
+        self.idle_cycles = 0
+
+        # The engine the local repo is hashed with, chosen by the first full sync (see _choose_hash_engine())
+        self.hash_engine = None
+
+    def loop_print(self, msg):
+
+        if self.verbose:
+            current_time = datetime.datetime.now()
+            current_timestamp = current_time.strftime("%Y/%m/%d/%H/%M/%S")
+            print(f"{current_timestamp}: {msg}")
+
+    def run_cycle(self):
+        """
+            This method runs one sync cycle. It is a full sync, scanning both repos and comparing them, when not in watch
+            mode or when one is due, and otherwise only the paths changed since the last cycle are synced.
+
+            The metrics of the cycle are recorded and exported when it ends, and the cycle is profiled with cProfile if
+            it is the one chosen in the init file.
+
+            :return: The metrics record of the cycle.
+        """
+
+        fp = self.fp
+        watcher = self.watcher
 
-                for file in files_to_del:
-                    server_file = fp.deployment_server + file
-                    ssh_agent.delete_file_from_server(server_file)
+        self.metrics.start_cycle()
+
+        profiler = None
+        if fp.profile_cycle and self.metrics.cycles == fp.profile_cycle:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        full_sync_due = (watcher is None or self.last_full_sync is None or watcher.overflowed or
+                         time.monotonic() - self.last_full_sync >= fp.full_sync_interval)
+
+        # A server that connected since the hash engine was chosen may not support it, another one is chosen
+        if fp.hash_algorithm == "auto" and self.hash_engine is not None:
+            full_sync_due = full_sync_due or any(target.hash_capabilities is not None and
+                                                 not self.hash_engine.is_supported(target.hash_capabilities)
+                                                 for target in self.targets)
+
+        try:
+
+            if full_sync_due:
+
+                cycle_type = "full"
+                self.full_sync()
+
+            elif self.dirty_paths or any(target.needs_sync() for target in self.targets):
+
+                cycle_type = "dirty"
+                self.sync_dirty_paths()
 
             else:
 
-                loop_print("Repo is up to date")
+                cycle_type = "idle"
+                self.loop_print("Repo is up to date")
 
-        loop_print(f"Sleeping {loop_delay}(s)")
-        time.sleep(loop_delay)
+        finally:
 
-        loop_print(loop_end_msg)
+            if profiler is not None:
+                profiler.disable()
+                profile_file = fp.profile_file or os.path.abspath("ssh_deployer_cycle_{}.prof".format(self.metrics.cycles))
+                profiler.dump_stats(profile_file)
+                self.loop_print(f"Profile of the cycle written to {profile_file}")
 
-    del fp
-    del ssh_agent
+        self.last_cycle_end = time.monotonic()
 
-    sys.exit(0)
+        # The targets that failed have their own retry delay, they do not keep the polling from backing off
+        if cycle_type == "full" and not self.local_changed and all(target.in_sync or target.failures for target in self.targets):
+            self.idle_cycles += 1
+        else:
+            self.idle_cycles = 0
+
+        targets = {target.name: target.get_state() for target in self.targets}
+        self.metrics.set("targets_in_sync", sum(state == "in_sync" for state in targets.values()))
+
+        return self.metrics.end_cycle(type=cycle_type, deployment=self.name, targets=targets)
+
+    def full_sync(self):
+        """
+            This method scans the local repo, and has every target scan its server repo and copy and delete what is
+            needed for it to match the local repo. The targets scan their server repo while the local repo is being
+            scanned, they only wait for the local scan to compare the two.
+        """
+
+        fp = self.fp
+        hash_cache = self.hash_cache
+
+        # Events received from now on are handled by the next cycle, the ones before are covered by this scan
+        if self.watcher is not None:
+            self.watcher.drain()
+            self.dirty_paths.clear()
+
+        # In the metadata compare mode, the content of every file is still compared every verify_interval seconds
+        compare_mode = fp.compare_mode
+        if compare_mode == "metadata" and fp.verify_interval and time.monotonic() - self.last_verification >= fp.verify_interval:
+            self.loop_print("Running a verification sweep")
+            compare_mode = "hash"
+            self.last_verification = time.monotonic()
+
+        hash_engine = self._choose_hash_engine()
+        if hash_engine != self.hash_engine:
+            self.loop_print(f"Hashing with {hash_engine.name}")
+            hash_cache.set_hash_engine(hash_engine)
+            self.hash_engine = hash_engine
+
+        local_tree = concurrent.futures.Future()
+        futures = self._submit_targets(local_tree, compare_mode, full_sync=True)
+
+        try:
+            with self.metrics.phase("local_scan"):
+                scan_local_repo = get_local_directory_structure(self.deployment_local, self.ignore_files, hash_cache,
+                                                                fp.local_hash_workers, fp.local_hash_executor,
+                                                                compare_mode, hash_engine=hash_engine)
+        except BaseException as e:
+            local_tree.set_exception(e)
+            raise
+
+        local_tree.set_result(scan_local_repo)
+
+        if compare_mode == "hash":
+            self.loop_print(f"Hash cache: {hash_cache.hits} hit(s), {hash_cache.misses} miss(es)")
+            self.metrics.add("local_files_hashed", hash_cache.misses)
+            if hash_cache.hits + hash_cache.misses:
+                self.metrics.set("hash_cache_hit_ratio", hash_cache.hits / (hash_cache.hits + hash_cache.misses))
+            hash_cache.prune()
+            hash_cache.save()
+
+        self.local_changed = self.synced_repo is None or trees_differ(self.synced_repo, scan_local_repo)
+        self.synced_repo = scan_local_repo
+        self.synced_compare_mode = compare_mode
+        self.last_full_sync = time.monotonic()
+
+        self._wait_for_targets(futures)
+
+    def sync_dirty_paths(self):
+        """
+            This method syncs the paths reported as changed by the watcher since the last cycle, and retries the targets
+            that failed their last sync.
+        """
+
+        fp = self.fp
+
+        files_to_copy = []
+        files_to_del = []
+        content_index = {}
+
+        if self.dirty_paths:
+
+            self.loop_print(f"{len(self.dirty_paths)} path(s) changed")
+
+            # The targets still syncing in the background read the synced structure, it is updated in a copy
+            if any(target.busy() for target in self.targets):
+                self.synced_repo = copy_tree(self.synced_repo)
+
+            with self.metrics.phase("dirty_scan"):
+                files_to_copy, files_to_del = get_dirty_path_actions(self.synced_repo, self.dirty_paths,
+                                                                     self.deployment_local, self.ignore_files, self.hash_cache,
+                                                                     fp.local_hash_workers, fp.local_hash_executor,
+                                                                     self.synced_compare_mode, content_index, self.hash_engine)
+            self.dirty_paths.clear()
+
+        local_tree = concurrent.futures.Future()
+        local_tree.set_result(self.synced_repo)
+
+        self._wait_for_targets(self._submit_targets(local_tree, self.synced_compare_mode, files_to_copy=files_to_copy,
+                                                    files_to_del=files_to_del, content_index=content_index))
+
+    def get_next_cycle_time(self, loop_delay):
+        """
+            This method tells when the next cycle of the deployer is due. Without a watcher a cycle is due loop_delay
+            seconds after a cycle that found changes, the delay then doubles with each cycle that found none, up to the
+            max_idle_loop_delay of the init file. In watch mode it is due as soon as paths changed, when a full sync is
+            due, or when a target has a sync to retry.
+
+            :param int loop_delay: The amount of seconds between two cycles of the polling mode.
+
+            :return: The time.monotonic() time of the next cycle.
+        """
+
+        if self.last_cycle_end is None:
+            return 0
+
+        if self.watcher is None:
+            max_delay = max(loop_delay, self.fp.max_idle_loop_delay)
+            return self.last_cycle_end + min(max_delay, loop_delay * 2 ** min(self.idle_cycles, 32))
+
+        if self.dirty_paths or self.watcher.overflowed:
+            return 0
+
+        ret_val = self.last_full_sync + self.fp.full_sync_interval
+        for target in self.targets:
+            if not target.busy() and (not target.in_sync or target.missed_changes or target.failed_files):
+                ret_val = min(ret_val, target.retry_time)
+
+        return ret_val
+
+    def busy(self):
+        """
+            :return: T/F based on if a target is still syncing in the background.
+        """
+
+        return any(target.busy() for target in self.targets)
+
+    def close(self):
+        """
+            This method waits for the targets still syncing, saves the caches and stops watching the local repo.
+        """
+
+        for target in self.targets:
+            target.close()
+
+        self.hash_cache.save()
+
+        if self.watcher is not None:
+            self.watcher.close()
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _submit_targets(self, local_tree, compare_mode, full_sync=False, files_to_copy=(), files_to_del=(),
+                        content_index=None):
+        """
+            This method gives the sync of the current cycle to every target that is not still busy with a previous one.
+            A target that is not in sync, because its last sync failed or because it missed the changes of a cycle while
+            it was busy, does a full sync instead of only applying the changes.
+
+            :param Future local_tree: The structure of the local repo, it may still be being scanned.
+            :param str compare_mode: The compare mode of the local structure.
+
+            :return: The futures of the syncs.
+        """
+
+        changed = full_sync or bool(files_to_copy) or bool(files_to_del)
+
+        ret_val = []
+        for target in self.targets:
+
+            if target.busy():
+                if changed:
+                    target.missed_changes = True
+                # The uploads it still has queued for the paths that changed again are sent by its next sync instead
+                preempted = target.transfer_queue.preempt([self.deployment_local + path
+                                                           for path in list(files_to_copy) + list(files_to_del)])
+                if preempted:
+                    self.loop_print(f"{target.name}: {preempted} queued upload(s) preempted")
+                self.loop_print(f"{target.name} is still syncing, skipping it")
+
+            elif time.monotonic() < target.retry_time:
+                self.loop_print(f"{target.name} failed its last sync, skipping it until it is retried")
+
+            elif full_sync or not target.in_sync or target.missed_changes:
+                target.missed_changes = False
+                ret_val.append(target.submit(target.full_sync, local_tree, compare_mode, self.hash_cache, self.hash_engine))
+
+            elif changed or target.failed_files:
+                ret_val.append(target.submit(target.sync_actions, local_tree.result(), compare_mode, list(files_to_copy),
+                                             list(files_to_del), content_index))
+
+        return ret_val
+
+    def _choose_hash_engine(self):
+        """
+            This method picks the engine the repos are hashed with, the one of the init file or, in "auto", the fastest
+            algorithm supported by every server that connected so far. The sampled mode is only used if they all support
+            it. The first time, the targets connect to find what their server supports.
+
+            :return: The HashEngine.
+        """
+
+        fp = self.fp
+
+        if fp.hash_algorithm != "auto":
+            return HashEngine(fp.hash_algorithm, fp.hash_sample_size)
+
+        if self.hash_engine is None:
+            futures = [target.executor.submit(target.connect) for target in self.targets
+                       if target.hash_capabilities is None and not target.busy() and time.monotonic() >= target.retry_time]
+            with self.metrics.phase("connect"):
+                concurrent.futures.wait(futures)
+
+        capabilities = [target.hash_capabilities for target in self.targets if target.hash_capabilities is not None]
+        if not capabilities:
+            return self.hash_engine if self.hash_engine is not None else DEFAULT_HASH_ENGINE
+
+        # The algorithm the hash cache was filled with is kept unless another one is much faster
+        current = self.hash_engine.algorithm if self.hash_engine is not None else self.hash_cache.hash_engine.split("/")[0]
+        algorithm = choose_hash_algorithm(capabilities, current)
+
+        sample_size = fp.hash_sample_size
+        if sample_size and not all(SAMPLED_CAPABILITY in server_capabilities for server_capabilities in capabilities):
+            self.loop_print("Sampled hashing needs the remote agent on every server, hashing whole files")
+            sample_size = 0
 
+        return HashEngine(algorithm, sample_size)
 
-def get_local_directory_structure(directory_path, ignore_files):
+    def _wait_for_targets(self, futures):
+        """
+            This method waits for the syncs of the targets. With several targets, the cycle only waits
+            slow_target_timeout seconds for them, the slower ones are left syncing in the background and skipped until
+            they are done.
+        """
+
+        if not futures:
+            return
+
+        with self.metrics.phase("targets"):
+            timeout = self.fp.slow_target_timeout if len(self.targets) > 1 else None
+            _, not_done = concurrent.futures.wait(futures, timeout=timeout)
+
+        if not_done:
+            self.loop_print(f"{len(not_done)} target(s) still syncing in the background")
+
+
+class DeploymentTarget():
+    """
+        This is the DeploymentTarget class. It holds the state of one server repo the local repo is deployed to: the
+        connection to its server, its snapshot and whether it is in sync with the synced local repo structure. Its syncs
+        run in a thread of its own, so that a slow or unreachable server does not hold back the others. The connection
+        is opened by the first sync, and a target whose sync failed is retried after a delay that doubles with each
+        failure.
+    """
+    def __init__(self, fp, deployment, target, index=0, metrics=None, verbose=False, connection_pool=None,
+                 bandwidth_limiter=None):
+
+        self.fp = fp
+        self.deployment_local = deployment["deployment_local"]
+        # The part files of interrupted chunked uploads are left out of the server scans, so that they are not deleted
+        # before the upload is resumed
+        self.do_not_delete = IgnoreMatcher(deployment["do_not_delete"].patterns + ["*" + UPLOAD_PART_SUFFIX])
+        self.host = target["host"]
+        self.user = target["user"]
+        self.port = target["port"]
+        self.known_hosts_file = target["known_hosts_file"]
+        self.deployment_server = target["deployment_server"]
+        self.name = "{}@{}:{}".format(self.user, self.host, self.deployment_server)
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.verbose = verbose
+
+        self.connection_pool = connection_pool
+        self.bandwidth_limiter = bandwidth_limiter
+        self.ssh_agent = None
+
+        # The uploads of the sync in progress, by priority, the deployer preempts the ones whose file changed again
+        self.transfer_queue = TransferQueue()
+
+        self.server_snapshot = None
+        if fp.server_snapshot:
+            # Each target needs its own snapshot file, the first one keeps the path of the init file
+            snapshot_path = deployment["server_snapshot_path"]
+            if snapshot_path and index:
+                snapshot_root, snapshot_extension = os.path.splitext(snapshot_path)
+                snapshot_path = "{}_{}{}".format(snapshot_root, index, snapshot_extension)
+            self.server_snapshot = ServerSnapshot(self.host, self.user, self.deployment_server,
+                                                  snapshot_path=snapshot_path, verbose=verbose)
+
+        # Only written by the sync thread: whether the server repo matches the synced structure, the files that could
+        # not be copied (relative to the repo), and when to retry after a failure
+        self.in_sync = False
+        self.failed_files = set()
+        self.failures = 0
+        self.retry_time = 0
+        # The hash algorithms the server supports, known once it connected (see HashEngine.is_supported())
+        self.hash_capabilities = None
+
+        # Only written by the deployer: set when a cycle skipped the target while it was busy
+        self.missed_changes = False
+
+        # Whether the server repo was scanned since the start, the snapshot is only reconciled by the first scan
+        self.scanned = False
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ssh_deployer_target")
+        self.future = None
+
+    def loop_print(self, msg):
+
+        if self.verbose:
+            current_time = datetime.datetime.now()
+            current_timestamp = current_time.strftime("%Y/%m/%d/%H/%M/%S")
+            print(f"{current_timestamp}: [{self.name}] {msg}")
+
+    def busy(self):
+
+        return self.future is not None and not self.future.done()
+
+    def needs_sync(self):
+        """
+            This method tells if the target has to sync even though nothing changed locally.
+
+            :return: T/F based on if the target is idle and out of sync or has files to copy again.
+        """
+
+        return (not self.busy() and time.monotonic() >= self.retry_time and
+                (not self.in_sync or self.missed_changes or bool(self.failed_files)))
+
+    def get_state(self):
+        """
+            :return: "syncing", "in_sync" or "out_of_sync".
+        """
+
+        if self.busy():
+            return "syncing"
+
+        return "in_sync" if self.in_sync else "out_of_sync"
+
+    def submit(self, function, *args):
+        """
+            This method runs a sync in the thread of the target.
+
+            :param function: full_sync or sync_actions.
+            :param args: Its arguments.
+
+            :return: The future of the sync.
+        """
+
+        self.future = self.executor.submit(self._run, function, *args)
+
+        return self.future
+
+    def connect(self):
+        """
+            This method opens the connection to the server, if it is not opened yet, to find the hash algorithms it
+            supports. A failure is retried like a failed sync. It must run in the thread of the target.
+        """
+
+        try:
+            self._connect()
+        except Exception as e:
+            self._fail("connect to", e)
+
+    def full_sync(self, local_tree, compare_mode, hash_cache, hash_engine=DEFAULT_HASH_ENGINE):
+        """
+            This method scans the server repo, and copies and deletes what is needed for it to match the local repo.
+
+            :param Future local_tree: The structure of the local repo, the server repo is scanned while it is built.
+            :param str compare_mode: The compare mode local_tree was built with.
+            :param HashCache hash_cache: The hash cache of the local repo.
+            :param HashEngine hash_engine: The engine local_tree was hashed with, the server files are hashed with it.
+        """
+
+        fp = self.fp
+        server_snapshot = self.server_snapshot
+
+        if not hash_engine.is_supported(self.hash_capabilities):
+            raise IOError("The server cannot hash with [{}], it supports [{}]".format(
+                hash_engine.name, ", ".join(sorted(self.hash_capabilities))))
+
+        if server_snapshot is not None:
+            server_snapshot.set_hash_engine(hash_engine)
+
+        self.ssh_agent.hash_engine = hash_engine
+        self.ssh_agent.remove_stale_uploads()
+
+        # On the first sync, the server files that did not change since the snapshot was saved are not hashed. The
+        # stat-only listing is done before any hashing so that a recorded hash is never older than its metadata.
+        with self.metrics.phase("server_scan"):
+            metadata_server_repo = None
+            if server_snapshot is not None and not self.scanned and compare_mode == "hash":
+                metadata_server_repo = self._scan_server("metadata", hash_engine)
+
+            if metadata_server_repo is not None and server_snapshot.entries:
+                scan_server_repo = server_snapshot.reconcile(
+                    metadata_server_repo,
+                    lambda files: get_server_file_hashes(self.ssh_agent, self.deployment_server, files, hash_engine))
+                self.loop_print(f"Server snapshot: {server_snapshot.reused} file(s) reused, "
+                                f"{server_snapshot.rehashed} file(s) hashed")
+                self.metrics.set("server_snapshot_files_reused", server_snapshot.reused)
+            else:
+                scan_server_repo = self._scan_server(compare_mode, hash_engine)
+                if server_snapshot is not None and metadata_server_repo is not None:
+                    # First run, the snapshot is filled with the hashes of the full scan
+                    server_snapshot.reconcile(metadata_server_repo,
+                                              lambda files: {file: get_element(scan_server_repo, file) for file in files
+                                                             if isinstance(get_element(scan_server_repo, file), bytes)})
+                elif server_snapshot is not None and compare_mode == "hash":
+                    server_snapshot.check(scan_server_repo)
+
+            if server_snapshot is not None:
+                server_snapshot.save()
+
+        self.scanned = True
+
+        with self.metrics.phase("local_scan_wait"):
+            local_tree = local_tree.result()
+
+        # Dumping a large structure is expensive, it is only done when it is printed
+        if self.verbose:
+            self.loop_print("Server repo structure:")
+            self.loop_print(json.dumps(scan_server_repo, indent=4, default=lambda value: value.hex()))
+
+        self.failed_files = set()
+
+        if trees_differ(local_tree, scan_server_repo):
+
+            with self.metrics.phase("diff"):
+                files_to_copy = get_copy_actions_from_diff(local_tree, scan_server_repo)
+                files_to_del = get_delete_actions_from_diff(local_tree, scan_server_repo)
+
+                # Files whose content already is on the server are copied there instead of being uploaded
+                content_index = None
+                if compare_mode == "hash" and files_to_copy:
+                    content_index = get_content_index(scan_server_repo)
+
+            if compare_mode == "metadata":
+                with self.metrics.phase("metadata_resolve"):
+                    files_to_copy = resolve_metadata_mismatches(files_to_copy, local_tree, scan_server_repo,
+                                                                self.deployment_local, self.deployment_server,
+                                                                self.ssh_agent, hash_cache, hash_engine)
+
+            self._apply_actions(local_tree, compare_mode, files_to_copy, files_to_del, content_index)
+
+        else:
+
+            self.loop_print("Repo is up to date")
+
+    def sync_actions(self, local_tree, compare_mode, files_to_copy, files_to_del, content_index=None):
+        """
+            This method applies the actions found by a dirty path scan to a server repo that was in sync, along with the
+            files that could not be copied by the last sync.
+
+            :param dict local_tree: The updated structure of the local repo.
+            :param str compare_mode: The compare mode local_tree was built with.
+            :param list files_to_copy: The files to copy, relative to the repo.
+            :param list files_to_del: The files/directories to delete, relative to the repo.
+            :param dict content_index: The index of the server files the files to copy may be copied from.
+        """
+
+        copying = set(files_to_copy)
+        files_to_copy += [file for file in sorted(self.failed_files)
+                          if file not in copying and is_file_value(get_element(local_tree, file))]
+
+        self._apply_actions(local_tree, compare_mode, files_to_copy, files_to_del, content_index)
+
+    def close(self):
+        """
+            This method waits for the sync in progress, saves the snapshot and closes the connection.
+        """
+
+        self.executor.shutdown(wait=True)
+
+        if self.server_snapshot is not None:
+            self.server_snapshot.save()
+
+        self.ssh_agent = None
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _run(self, function, *args):
+
+        try:
+            self._connect()
+
+            function(*args)
+
+            self.in_sync = True
+            self.failures = 0
+
+        except Exception as e:
+            self._fail("sync", e)
+
+    def _connect(self):
+
+        if self.ssh_agent is None:
+            fp = self.fp
+            self.ssh_agent = SSHAgent(self.host, self.user, verbose=self.verbose, sftp_channels=fp.upload_workers,
+                                      delta_threshold=fp.delta_threshold, port=self.port,
+                                      known_hosts_file=self.known_hosts_file, metrics=self.metrics,
+                                      remote_agent=fp.remote_agent, connect_timeout=fp.connect_timeout,
+                                      connection_pool=self.connection_pool,
+                                      chunked_upload_threshold=fp.chunked_upload_threshold,
+                                      upload_chunk_size=fp.upload_chunk_size,
+                                      bandwidth_limiter=self.bandwidth_limiter)
+
+        self.hash_capabilities = self.ssh_agent.get_hash_capabilities()
+
+    def _fail(self, action, error):
+
+        self.in_sync = False
+        self.failures += 1
+        delay = min(MAX_TARGET_RETRY_DELAY, TARGET_RETRY_DELAY * 2 ** (self.failures - 1))
+        self.retry_time = time.monotonic() + delay
+        print("!!! ERROR: Could not {} [{}], retrying in {}(s): [{}] !!!".format(action, self.name, delay, error))
+
+        # A broken connection is opened again by the next sync
+        transport = self.ssh_agent.ssh.get_transport() if self.ssh_agent is not None else None
+        if transport is None or not transport.is_active():
+            self.ssh_agent = None
+
+    def _scan_server(self, compare_mode, hash_engine):
+
+        fp = self.fp
+
+        ret_val = None
+        if fp.remote_scan_mode == "manifest":
+            ret_val = self.ssh_agent.get_server_manifest(self.deployment_server, self.do_not_delete, fp.remote_hash_workers,
+                                                         compare_mode, hash_engine)
+        if ret_val is None:
+            ret_val = self.ssh_agent.get_server_directory_structure(self.deployment_server, self.do_not_delete, compare_mode,
+                                                                    hash_engine=hash_engine)
+
+        return ret_val
+
+    def _apply_actions(self, local_tree, compare_mode, files_to_copy, files_to_del, content_index=None):
+
+        fp = self.fp
+        ssh_agent = self.ssh_agent
+
+        self.metrics.add("files_to_copy", len(files_to_copy))
+        self.metrics.add("files_to_delete", len(files_to_del))
+
+        copied_files = files_to_copy
+
+        if content_index and files_to_copy and compare_mode == "hash":
+            with self.metrics.phase("server_copy"):
+                files_to_copy = self._copy_files_on_server(local_tree, files_to_copy, files_to_del, content_index)
+
+        # A path to delete that is a file to copy, or one of its directories, was replaced by a directory or a file and
+        # is deleted before the uploads, the other paths are deleted while the files are uploaded
+        copied_paths = set()
+        for file in copied_files:
+            while file and file not in copied_paths:
+                copied_paths.add(file)
+                file = os.path.dirname(file)
+        replaced_files = [file for file in files_to_del if file in copied_paths]
+        files_to_del_along = [file for file in files_to_del if file not in copied_paths]
+
+        if replaced_files:
+            self._delete_files(replaced_files)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+
+            delete_future = executor.submit(self._delete_files, files_to_del_along) if files_to_del_along else None
+
+            with self.metrics.phase("upload"):
+
+                # Small files go in a single tar stream when there are enough of them, uploaded while the others are
+                # uploaded one by one
+                tar_future = None
+                small_files = [file for file in files_to_copy
+                               if _is_small_file(self.deployment_local + file, fp.bulk_upload_max_file_size)]
+                if len(small_files) >= fp.bulk_upload_min_files:
+                    tar_future = executor.submit(ssh_agent.copy_files_to_server_tar, self.deployment_local,
+                                                 self.deployment_server, small_files,
+                                                 compression=fp.bulk_upload_compression)
+                    small_files_set = set(small_files)
+                    files_to_copy = [file for file in files_to_copy if file not in small_files_set]
+
+                for file in files_to_copy:
+                    self.transfer_queue.put(self.deployment_local + file, os.path.dirname(self.deployment_server + file))
+                failed_files = ssh_agent.copy_files_to_server(self.transfer_queue, workers=fp.upload_workers)
+
+                # The small files are uploaded one by one if the tar stream failed
+                if tar_future is not None and not tar_future.result():
+                    for file in small_files:
+                        self.transfer_queue.put(self.deployment_local + file, os.path.dirname(self.deployment_server + file))
+                    failed_files += ssh_agent.copy_files_to_server(self.transfer_queue, workers=fp.upload_workers)
+
+            if delete_future is not None:
+                delete_future.result()
+
+        # Files that could not be copied are retried by the next cycle
+        self.failed_files = {local_file[len(self.deployment_local):] for local_file in failed_files}
+
+        if self.server_snapshot is not None:
+            update_server_snapshot(self.server_snapshot, copied_files, files_to_del, failed_files, local_tree,
+                                   compare_mode, self.deployment_local)
+            self.server_snapshot.save()
+
+    def _delete_files(self, files_to_del):
+
+        with self.metrics.phase("delete"):
+            try:
+                self.ssh_agent.delete_files_from_server([self.deployment_server + file for file in files_to_del])
+            except IOError as e:
+                # Some are still on the server, the next cycle does a full sync to rescan it and delete them again
+                self.missed_changes = True
+                print("!!! ERROR: Could not delete files from the server: [{}] !!!".format(e))
+
+    def _copy_files_on_server(self, local_tree, files_to_copy, files_to_del, content_index):
+        """
+            This method copies or moves, within the server, the files to copy whose content already is there (see
+            get_server_copy_actions()).
+
+            :return: The files left to upload, including the ones that could not be copied on the server.
+        """
+
+        fp = self.fp
+
+        copy_actions, files_to_upload = get_server_copy_actions(files_to_copy, files_to_del, local_tree, content_index)
+        if not copy_actions:
+            return files_to_copy
+
+        self.loop_print(f"{len(copy_actions)} file(s) already on the server, copying them there")
+
+        operations = []
+        for operation, source, destination in copy_actions:
+            # Like uploads, the server copy gets the local modification time, or RACY_MTIME if it is too recent
+            try:
+                mtime = get_server_mtime(os.stat(self.deployment_local + destination).st_mtime)
+            except OSError:
+                mtime = None
+            operations.append((operation, self.deployment_server + source, self.deployment_server + destination, mtime))
+
+        try:
+            failed_files = self.ssh_agent.copy_files_on_server(operations)
+        except IOError as e:
+            print("!!! ERROR: Could not copy files on the server: [{}] !!!".format(e))
+            failed_files = [destination for _, _, destination, _ in operations]
+
+        # The files that could not be copied on the server are uploaded
+        files_to_upload += [server_file[len(self.deployment_server):] for server_file in failed_files]
+
+        return files_to_upload
+
+
+def get_local_directory_structure(directory_path, ignore_files, hash_cache=None, hash_workers=1, hash_executor="thread",
+                                  compare_mode="hash", prefix="", hash_engine=DEFAULT_HASH_ENGINE):
     """
         This method will use the os library to scan the local directory and populate a directory structure of the local
         repo. The structure of the repo will be denoted by a dictionary with each key being the name of an element in
         the repo. The value to each element will either be an integer representing the file size of element, or a
         dictionary representing the directory of the element. Therefore checking the type of the value of a key in
         repo structure will let you know whether the element is either a directory or a file. If while going through the
-        repo, an element is a part of the ignored files list, it is skipped and will not appear in the returned structure.
+        repo, an element matches the ignored files patterns, it is skipped and will not appear in the returned structure.
+        Ignored directories are not walked.
 
         example_repo_structure = {
             "foo": 42,
             "bar": { ... }
         }
 
+        The scan is done in two phases: the directory is first walked, only using the stat results of os.scandir(), and
+        the files that are not in the hash cache are then hashed by a pool of hash_workers workers. In the metadata
+        compare mode nothing is hashed, files are given the value of get_metadata_value() instead of their hash. The
+        files and directories that disappear during the scan, like editor swap files, are left out of the structure.
+
         :param str directory: The path to the local directory/repo.
+        :param IgnoreMatcher ignore_files: The patterns of the ignored files.
+        :param HashCache hash_cache: Optional cache used to skip hashing files whose stat signature did not change.
+        :param int hash_workers: The number of files hashed in parallel.
+        :param str hash_executor: "thread" or "process", the kind of workers used to hash files.
+        :param str compare_mode: "hash" or "metadata".
+        :param str prefix: When scanning a directory of the repo, its path relative to the repo followed by a "/", the
+                           ignored files patterns are matched against the paths relative to the repo.
+        :param HashEngine hash_engine: The engine the files are hashed with.
 
         :return: The structure of the repo in type dictionary.
     """
 
-    ret_val = {}
+    # (directory structure, element name, file path, stat result) of every file that needs to be hashed
+    pending_files = []
+
+    ret_val = _walk_local_directory(directory_path, ignore_files, hash_cache, pending_files, compare_mode, prefix)
+
+    digests = _hash_files([file_path for _, _, file_path, _ in pending_files], hash_engine, hash_workers, hash_executor)
+
+    for (directory_tree, element_name, file_path, stat_result), digest in zip(pending_files, digests):
+        if digest is None:
+            # The file disappeared since the directory was walked
+            del directory_tree[element_name]
+            continue
+        directory_tree[element_name] = digest
+        if hash_cache is not None:
+            hash_cache.store(file_path, stat_result, digest)
+
+    return ret_val
+
+
+def _walk_local_directory(directory_path, ignore_files, hash_cache, pending_files, compare_mode="hash", prefix=""):
+
+    ret_val = DirectoryTree()
 
     # Scan te directory and iterate through all elements
     directory_scan = os.scandir(directory_path)
     for element in directory_scan:
 
-        element_name = element.name
+        # Names are interned, the same names repeat in every directory of a large repo
+        element_name = sys.intern(element.name)
+
+        is_dir = element.is_dir()
 
-        # If the name is not a part of the ignored files list we check the structure
-        element_path = os.path.abspath(directory_path + element_name)
-        if element_path not in ignore_files:
+        # If the element does not match the ignored files patterns we check the structure
+        if not ignore_files.is_ignored(prefix + element_name, is_dir):
 
             # If the element is a directory we recursively call this method to get the structure of the directory
-            if element.is_dir():
+            if is_dir:
 
                 dir_full_path = os.path.abspath("{}/{}".format(directory_path, element_name))
-                ret_val[element_name] = get_local_directory_structure(dir_full_path, ignore_files)
-
-            # If the element is a file, we set the element's value to the file size
+                try:
+                    ret_val[element_name] = _walk_local_directory(dir_full_path, ignore_files, hash_cache, pending_files,
+                                                                  compare_mode, prefix + element_name + "/")
+                except FileNotFoundError:
+                    # The directory disappeared since it was listed
+                    pass
+
+            # In the metadata compare mode the stat result is all we need for a file
+            elif element.is_file() and compare_mode == "metadata":
+
+                try:
+                    stat_result = element.stat()
+                except FileNotFoundError:
+                    continue
+                ret_val[element_name] = get_metadata_value(stat_result.st_size, stat_result.st_mtime)
+
+            # If the element is a file, we set the element's value to its cached hash or queue it to be hashed
             elif element.is_file():
 
-                ret_val[element_name] = _hash_file(f"{directory_path}/{element_name}")
+                file_path = os.path.join(directory_path, element_name)
+                try:
+                    stat_result = element.stat()
+                except FileNotFoundError:
+                    continue
+                digest = hash_cache.lookup(file_path, stat_result) if hash_cache is not None else None
+                if digest is not None:
+                    ret_val[element_name] = digest
+                else:
+                    ret_val[element_name] = None
+                    pending_files.append((ret_val, element_name, file_path, stat_result))
 
             # else print the file size is not recognized, this is for debugging.
             else:
@@ -154,6 +1001,40 @@ def get_local_directory_structure(directory_path, ignore_files):
     return ret_val
 
 
+def _hash_files(file_paths, hash_engine=DEFAULT_HASH_ENGINE, workers=1, executor="thread"):
+    """
+        This method hashes a list of files, in parallel when there are enough of them. Threads suit large files since
+        hashlib releases the GIL while hashing, processes suit many small files where the interpreter is the bottleneck.
+
+        :param list file_paths: The paths of the files to hash.
+        :param HashEngine hash_engine: The engine the files are hashed with.
+        :param int workers: The number of files hashed in parallel.
+        :param str executor: "thread" or "process".
+
+        :return: The list of digests, in the order of file_paths, None for the files that no longer exist.
+    """
+
+    hash_file = functools.partial(_hash_existing_file, hash_engine)
+
+    if workers <= 1 or len(file_paths) < MIN_PARALLEL_HASH_FILES:
+        return [hash_file(file_path) for file_path in file_paths]
+
+    if executor == "process":
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(hash_file, file_paths, chunksize=max(1, len(file_paths) // (workers * 4))))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hash_file, file_paths))
+
+
+def _hash_existing_file(hash_engine, file_path):
+
+    try:
+        return hash_engine.hash_file(file_path)
+    except FileNotFoundError:
+        return None
+
+
 def get_copy_actions_from_diff(local_tree, server_tree):
     """
         This method will go through each file in the local repo and check to see if the same file exists in the server
@@ -163,6 +1044,8 @@ def get_copy_actions_from_diff(local_tree, server_tree):
             If the server has the file but they differ -> file needs to be copied to the sever.
             If the server has the file and the are the same -> no action.
 
+        Directories are compared by their digest first, so identical subtrees are skipped without being walked.
+
         :param dict local_tree: The repo structure of the repo on the local machine.
         :param server_tree: The repo structure of the repo on the server machine.
 
@@ -170,53 +1053,35 @@ def get_copy_actions_from_diff(local_tree, server_tree):
     """
 
     ret_val = []
+    _collect_copy_actions(local_tree, server_tree, "", ret_val)
 
-    # Iterate through each element of the local repo
-    for element_name, element_value in local_tree.items():
-
-        # Get some boolean values to perform logic above.
-        element_exists_in_server = element_name in server_tree.keys()
-        is_dir = type(element_value) == dict
-        elements_differ = None
-        both_are_dirs = None
-        # If the element exists in the server we can update the two boolean values set to None above
-        if element_exists_in_server:
-            elements_differ = element_value != server_tree[element_name]
-            both_are_dirs = type(element_value) == dict and type(server_tree[element_name]) == dict
-
-
-        if not element_exists_in_server:
+    return ret_val
 
-            # If the element does not exist on the server repo and is a directory we get the paths of all files
-            # in the directory and add them all to the copy list
-            if is_dir:
 
-                new_actions = get_all_directory_paths(element_value)
-                new_actions = [element_name + "/" + copy_path for copy_path in new_actions]
-                ret_val += new_actions
+def _collect_copy_actions(local_tree, server_tree, prefix, ret_val):
 
-            # If the element does not exist on the sever repo and is a file we add it to the copy list.
-            else:
+    # Iterate through each element of the local repo
+    for element_name, element_value in local_tree.items():
 
-                ret_val.append(element_name)
+        server_value = server_tree.get(element_name)
+        is_dir = isinstance(element_value, dict)
 
-        # Else, the element does exist in the server so we check if the elements differ
-        elif elements_differ:
+        # If the element does not exist on the server repo, or is not a directory there, and is a directory we add the
+        # paths of all files in the directory to the copy list
+        if is_dir and not isinstance(server_value, dict):
 
-            # If the elements are both directories then we recursively call this method to further get all needed
-            # copy actions
-            if both_are_dirs:
+            _collect_directory_paths(element_value, prefix + element_name + "/", ret_val)
 
-                new_actions = get_copy_actions_from_diff(element_value, server_tree[element_name])
-                new_actions = [element_name + "/" + copy_path for copy_path in new_actions]
-                ret_val += new_actions
+        # If both elements are directories with a different content we recursively look for the needed copy actions
+        elif is_dir:
 
-            # Otherwise if the elements differ add to the copy list
-            else:
+            if trees_differ(element_value, server_value):
+                _collect_copy_actions(element_value, server_value, prefix + element_name + "/", ret_val)
 
-                ret_val.append(element_name)
+        # If the file does not exist on the server repo or differs we add it to the copy list
+        elif element_value != server_value:
 
-    return ret_val
+            ret_val.append(prefix + element_name)
 
 
 def get_delete_actions_from_diff(local_tree, server_tree):
@@ -228,31 +1093,342 @@ def get_delete_actions_from_diff(local_tree, server_tree):
             If the element in the server does not exist in the local repo -> element needs to the deleted from the server
             If the element is a directory -> recursively call the method to find any files needed to be deleted
 
+        Directories are compared by their digest first, so identical subtrees are skipped without being walked.
+
         :param dict local_tree: The repo structure of the repo on the local machine.
         :param dict server_tree: The repo structure of the repo on the server machine.
 
         :return: A list of files/directories needed to be deleted on the serer machine.
     """
+
     ret_val = []
+    _collect_delete_actions(local_tree, server_tree, "", ret_val)
+
+    return ret_val
+
+
+def _collect_delete_actions(local_tree, server_tree, prefix, ret_val):
 
     # Go through each element in the server repo
     for element_name, element_value in server_tree.items():
 
-        # Perform some boolean operations to perform logic
-        element_in_local = element_name in local_tree.keys()
-        element_is_dir = type(element_value) == dict
+        local_value = local_tree.get(element_name)
+        element_is_dir = isinstance(element_value, dict)
+
+        # A protected directory holds elements that must not be deleted, only its other elements are
+        if element_is_dir and getattr(element_value, "protected", False) and not isinstance(local_value, dict):
+
+            _collect_delete_actions(DirectoryTree(), element_value, prefix + element_name + "/", ret_val)
+
+        # If the element does not exist in local repo, or a directory replaced a file or the opposite, we must delete it
+        # from the server
+        elif local_value is None or element_is_dir != isinstance(local_value, dict):
+
+            ret_val.append(prefix + element_name)
+
+        # Else if it is a directory with a different content, recursively look for any deleted files
+        elif element_is_dir and trees_differ(local_value, element_value):
+
+            _collect_delete_actions(local_value, element_value, prefix + element_name + "/", ret_val)
+
+
+def get_content_index(directory_tree, prefix="", content_index=None):
+    """
+        This method indexes the files of a repo structure built in the hash compare mode by their content.
+
+        :param dict directory_tree: The repo structure.
+        :param str prefix: The path of the structure relative to the repo, followed by a "/", or "" for the repo itself.
+        :param dict content_index: An index to add the files to, a new one is created if None.
+
+        :return: A dictionary mapping each hash to the list of the paths of the files with this content.
+    """
+
+    ret_val = {} if content_index is None else content_index
+
+    for name, element in directory_tree.items():
+        if isinstance(element, dict):
+            get_content_index(element, prefix + name + "/", ret_val)
+        elif isinstance(element, bytes):
+            ret_val.setdefault(element, []).append(prefix + name)
+
+    return ret_val
+
+
+def get_server_copy_actions(files_to_copy, files_to_del, local_tree, content_index):
+    """
+        This method finds the files to copy whose content already is on the server, so that they are copied or moved
+        within the server instead of being uploaded. A moved or renamed file shows up in the diff as a file to delete
+        and a file to copy with the same hash, it becomes a single move, and a duplicated file becomes a copy.
+
+        A source is only used if its server content does not change during the sync, that is if it is not itself a file
+        to copy. A source that is about to be deleted is moved to the first destination that needs it, and copied to
+        the others: the copies must be run before the moves. Files to copy that are under, or are, a path to delete are
+        left to the uploads as the deletion has to happen first.
+
+        :param list files_to_copy: The files to copy, relative to the repo.
+        :param list files_to_del: The files/directories to delete, relative to the repo.
+        :param dict local_tree: The repo structure of the local repo, built in the hash compare mode.
+        :param dict content_index: The index of the server files, as returned by get_content_index().
+
+        :return: A list of (operation, source, destination) tuples, "cp" ones first, and the files left to upload.
+    """
+
+    copying = set(files_to_copy)
+    deleting = set(files_to_del)
+
+    def is_deleted(path):
+        while path:
+            if path in deleting:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    copies = []
+    moves = []
+    moved_sources = set()
+    files_to_upload = []
+
+    for file in files_to_copy:
+
+        sources = [source for source in content_index.get(get_element(local_tree, file), ()) if source not in copying]
+        if not sources or is_deleted(file):
+            files_to_upload.append(file)
+            continue
+
+        movable_sources = [source for source in sources if source not in moved_sources and is_deleted(source)]
+        if movable_sources:
+            moved_sources.add(movable_sources[0])
+            moves.append(("mv", movable_sources[0], file))
+        else:
+            copies.append(("cp", sources[0], file))
+
+    return copies + moves, files_to_upload
+
+
+def get_dirty_path_actions(synced_tree, dirty_paths, directory_path, ignore_files, hash_cache=None, hash_workers=1,
+                           hash_executor="thread", compare_mode="hash", content_index=None, hash_engine=DEFAULT_HASH_ENGINE):
+    """
+        This method is used in watch mode to only rescan the paths of the local repo that changed. Each dirty path is
+        rescanned, compared with its value in the repo structure of the last sync, and the structure is updated in
+        place with the new value. Since the server was in sync with synced_tree, this gives the copy and delete actions
+        needed without scanning the server.
+
+        :param dict synced_tree: The repo structure of the local repo as of the last sync, updated in place.
+        :param set dirty_paths: The paths, relative to the repo, reported as changed by the watcher.
+        :param str directory_path: The path to the local directory/repo.
+        :param IgnoreMatcher ignore_files: The patterns of the ignored files.
+        :param HashCache hash_cache: Optional cache used to skip hashing files whose stat signature did not change.
+        :param int hash_workers: The number of files hashed in parallel when a directory is rescanned.
+        :param str hash_executor: "thread" or "process", the kind of workers used to hash files.
+        :param str compare_mode: "hash" or "metadata", the compare mode synced_tree was built with.
+        :param dict content_index: In the hash compare mode, the files of the rescanned paths as of the last sync are
+                                   added to this index (see get_content_index()), they are the server files the new
+                                   files may be copied from.
+        :param HashEngine hash_engine: The engine synced_tree was hashed with.
+
+        :return: A list of files needed to be copied and a list of files/directories needed to be deleted on the server.
+    """
+
+    files_to_copy = []
+    files_to_del = []
+
+    for dirty_path in _coalesce_dirty_paths(synced_tree, dirty_paths):
+
+        parent_path, element_name = os.path.split(dirty_path)
+        parent_tree = get_subtree(synced_tree, parent_path)
+
+        element_path = os.path.abspath(os.path.join(directory_path, dirty_path))
+        if ignore_files.is_path_ignored(dirty_path, os.path.isdir(element_path)):
+            continue
+
+        # Rescan the element, a None value means it no longer exists, including when it disappears while rescanned
+        new_value = None
+        try:
+            if os.path.isdir(element_path):
+                new_value = get_local_directory_structure(element_path + "/", ignore_files, hash_cache, hash_workers,
+                                                          hash_executor, compare_mode, dirty_path + "/", hash_engine)
+            elif os.path.isfile(element_path):
+                if compare_mode == "metadata":
+                    stat_result = os.stat(element_path)
+                    new_value = get_metadata_value(stat_result.st_size, stat_result.st_mtime)
+                elif hash_cache is not None:
+                    new_value = hash_cache.get_hash(element_path, os.stat(element_path), hash_engine.hash_file)
+                else:
+                    new_value = hash_engine.hash_file(element_path)
+        except FileNotFoundError:
+            new_value = None
+
+        old_value = parent_tree.get(element_name)
+
+        if content_index is not None and compare_mode == "hash" and old_value is not None:
+            get_content_index({element_name: old_value}, parent_path + "/" if parent_path else "", content_index)
+
+        new_tree = {} if new_value is None else {element_name: new_value}
+        old_tree = {} if old_value is None else {element_name: old_value}
+
+        files_to_copy += [os.path.join(parent_path, path) for path in get_copy_actions_from_diff(new_tree, old_tree)]
+        files_to_del += [os.path.join(parent_path, path) for path in get_delete_actions_from_diff(new_tree, old_tree)]
+
+        set_element(synced_tree, dirty_path, new_value)
+
+    return files_to_copy, files_to_del
+
+
+def resolve_metadata_mismatches(files_to_copy, local_tree, server_tree, local_root, server_root, ssh_agent, hash_cache=None,
+                                hash_engine=DEFAULT_HASH_ENGINE):
+    """
+        This method is used in the metadata compare mode to avoid uploading files whose modification time differs but
+        whose content is the same, like files copied to the server by other means. The files to copy that have the same
+        size on both sides are hashed on both sides, and the ones with the same hash only get their server modification
+        time updated.
+
+        :param list files_to_copy: The files to copy as returned by get_copy_actions_from_diff().
+        :param dict local_tree: The repo structure of the local repo, built in the metadata compare mode.
+        :param dict server_tree: The repo structure of the server repo, built in the metadata compare mode.
+        :param str local_root: The path to the local repo.
+        :param str server_root: The path to the server repo.
+        :param SSHAgent ssh_agent: The agent used to hash the server files.
+        :param HashCache hash_cache: Optional cache used to skip hashing files whose stat signature did not change.
+        :param HashEngine hash_engine: The engine the files are hashed with.
+
+        :return: The files that really need to be copied.
+    """
+
+    ambiguous_files = []
+    for file in files_to_copy:
+        server_value = get_element(server_tree, file)
+        if isinstance(server_value, str) and parse_metadata_value(server_value)[0] == parse_metadata_value(get_element(local_tree, file))[0]:
+            ambiguous_files.append(file)
+
+    if not ambiguous_files:
+        return files_to_copy
+
+    server_hashes = ssh_agent.get_server_file_hashes([server_root + file for file in ambiguous_files], hash_engine)
+
+    same_files = set()
+    mtimes_to_set = []
+    for file in ambiguous_files:
+        local_file = local_root + file
+        try:
+            stat_result = os.stat(local_file)
+            if hash_cache is not None:
+                local_hash = hash_cache.get_hash(local_file, stat_result, hash_engine.hash_file)
+            else:
+                local_hash = hash_engine.hash_file(local_file)
+        except FileNotFoundError:
+            # The file disappeared since the scan, its upload fails and is reported as such
+            continue
+
+        if server_hashes.get(server_root + file) == local_hash:
+            same_files.add(file)
+            mtimes_to_set.append((server_root + file, get_server_mtime(stat_result.st_mtime)))
+
+    ssh_agent.set_server_file_mtimes(mtimes_to_set)
+
+    return [file for file in files_to_copy if file not in same_files]
 
-        # If the element does not exist in local repo, we must deleted it from the server
-        if not element_in_local:
 
-            ret_val.append(element_name)
+def get_server_file_hashes(ssh_agent, server_root, files, hash_engine=DEFAULT_HASH_ENGINE):
+    """
+        This method hashes server files given relative to the server repo.
+
+        :param SSHAgent ssh_agent: The agent used to hash the server files.
+        :param str server_root: The path to the server repo.
+        :param list files: The paths of the files relative to the server repo.
+        :param HashEngine hash_engine: The engine the files are hashed with.
+
+        :return: A dictionary mapping each relative path to its hash, files that could not be hashed are missing.
+    """
+
+    server_hashes = ssh_agent.get_server_file_hashes([server_root + file for file in files], hash_engine)
+
+    return {server_file[len(server_root):]: file_hash for server_file, file_hash in server_hashes.items()}
+
+
+def update_server_snapshot(server_snapshot, copied_files, deleted_files, failed_files, local_tree, compare_mode,
+                           local_root):
+    """
+        This method records the files copied to the server in the server snapshot, and forgets the deleted ones. The
+        server copy of an uploaded file has the size and modification time of the local file, unless it was modified
+        too recently for its modification time to be copied, in which case it is forgotten and hashed again on the next
+        start.
+
+        :param list copied_files: The files that were to be copied, relative to the repo.
+        :param list deleted_files: The files and directories deleted from the server, relative to the repo.
+        :param list failed_files: The local paths of the files that could not be copied.
+        :param dict local_tree: The local repo structure the files were copied from.
+        :param str compare_mode: The compare mode local_tree was built with, only hashes can be recorded.
+        :param str local_root: The path to the local repo.
+    """
+
+    # Before the copied files are recorded, as one of them may replace a deleted directory
+    server_snapshot.forget(deleted_files)
+
+    forgotten_files = []
+    failed_files = set(failed_files)
+    for file in copied_files:
+        local_file = local_root + file
+        file_hash = get_element(local_tree, file) if compare_mode == "hash" and local_tree is not None else None
+
+        try:
+            stat_result = os.stat(local_file)
+        except OSError:
+            stat_result = None
+
+        if (local_file in failed_files or not isinstance(file_hash, bytes) or stat_result is None or
+                time.time() - stat_result.st_mtime <= RACY_MTIME_WINDOW):
+            forgotten_files.append(file)
+        else:
+            server_snapshot.record(file, stat_result.st_size, stat_result.st_mtime, file_hash)
+
+    server_snapshot.forget(forgotten_files)
+
+
+def get_subtree(directory_tree, path):
+    """
+        This method returns the structure of a directory inside a repo structure.
+
+        :param dict directory_tree: The repo structure.
+        :param str path: The path of the directory relative to the repo, "" for the repo itself.
 
-        # Else if it exists in the local repo and it is a directory, recursively call the method to find any deleted files
-        elif element_is_dir:
+        :return: The structure of the directory, or None if the path is not a directory of the structure.
+    """
+
+    ret_val = directory_tree
+
+    for name in path.split("/") if path else []:
+        ret_val = ret_val.get(name) if isinstance(ret_val, dict) else None
+        if ret_val is None:
+            break
+
+    return ret_val if isinstance(ret_val, dict) else None
+
+
+def _coalesce_dirty_paths(directory_tree, dirty_paths):
+    """
+        This method reduces a set of dirty paths to the smallest set of paths to rescan. A path whose parent is not a
+        known directory of the structure is replaced by its closest ancestor that is, and paths that are inside another
+        dirty path are dropped since rescanning the ancestor covers them.
+
+        :param dict directory_tree: The repo structure of the last sync.
+        :param set dirty_paths: The dirty paths relative to the repo.
+
+        :return: The sorted list of paths to rescan.
+    """
+
+    candidates = set()
+    for path in dirty_paths:
+        while path and get_subtree(directory_tree, os.path.dirname(path)) is None:
+            path = os.path.dirname(path)
+        candidates.add(path)
 
-            new_actions = get_delete_actions_from_diff(local_tree[element_name], element_value)
-            new_actions = [element_name + "/" + delete_path for delete_path in new_actions]
-            ret_val += new_actions
+    ret_val = []
+    for path in sorted(candidates):
+        ancestor = os.path.dirname(path)
+        while ancestor and ancestor not in candidates:
+            ancestor = os.path.dirname(ancestor)
+        if not ancestor:
+            ret_val.append(path)
 
     return ret_val
 
@@ -265,39 +1441,36 @@ def get_all_directory_paths(directory_tree):
 
         :return: A list of all paths to each file in the dictionary.
     """
+
     ret_val = []
+    _collect_directory_paths(directory_tree, "", ret_val)
+
+    return ret_val
+
+
+def _collect_directory_paths(directory_tree, prefix, ret_val):
 
     # Iterate through the directory and append to the ret_val list with the path to each file
     for name, element in directory_tree.items():
 
-        # If the element is a directory then recursively call the method and append to the two lists together
-        if type(element) == dict:
+        # If the element is a directory then recursively add the paths of its files
+        if isinstance(element, dict):
 
-            new_files = get_all_directory_paths(element)
-            new_files = [name + "/" + file for file in new_files]
-            ret_val += new_files
+            _collect_directory_paths(element, prefix + name + "/", ret_val)
 
         # If the element is a file then we add the file name to the list
         else:
 
-            ret_val.append(name)
+            ret_val.append(prefix + name)
 
-    return ret_val
 
-def _hash_file(filename):
-
-   # make a hash object
-   h = hashlib.sha1()
-   # open file for reading in binary mode
-   with open(filename,'rb') as file:
-       # loop till the end of the file
-       chunk = 0
-       while chunk != b'':
-           # read only 1024 bytes at a time
-           chunk = file.read(1024)
-           h.update(chunk)
-   # return the hex representation of digest
-   return h.hexdigest()
+def _is_small_file(file_path, max_size):
+
+    # A file deleted since it was scanned is left to the single uploads, which report it as failed
+    try:
+        return os.path.getsize(file_path) <= max_size
+    except OSError:
+        return False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the rsync style delta transfer used by the ssh_agent to update large files that already exist
+    on the server. The server sends a signature of its copy of the file (a weak rolling checksum and a strong hash per
+    block), the local file is searched for those blocks, and only a delta made of references to the server blocks and of
+    literal data is sent back. The server rebuilds the file next to the old one, checks its hash and renames it in place.
+
+    The server side is a small stdlib only python script, REMOTE_DELTA_SCRIPT, that is run with python3 -c.
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Literal data is sent in pieces of at most this size
+MAX_LITERAL_SIZE = 64 * 1024
+
+# The local file is read in pieces of this size
+READ_SIZE = 1024 * 1024
+
+# Once this many blocks were rolled over without a match, the search jumps block by block until the next match. This
+# bounds the time spent in the byte by byte python loop on data that is new rather than moved.
+MAX_ROLLED_BLOCKS = 16
+
+ADLER_MOD = 65521
+
+SIGNATURE_HEADER = struct.Struct(">QI")
+SIGNATURE_ENTRY = struct.Struct(">I20s")
+
+COPY_OPERATION = struct.Struct(">cQI")
+DATA_OPERATION = struct.Struct(">cI")
+END_OPERATION = b"E"
+
+REMOTE_DELTA_SCRIPT = r'''
+import hashlib, os, shutil, struct, sys, zlib
+mode, path = sys.argv[1], sys.argv[2]
+out = sys.stdout.buffer
+if mode == "signature":
+    block_size = int(sys.argv[3])
+    with open(path, "rb") as f:
+        out.write(struct.pack(">QI", os.fstat(f.fileno()).st_size, block_size))
+        for block in iter(lambda: f.read(block_size), b""):
+            out.write(struct.pack(">I20s", zlib.adler32(block), hashlib.sha1(block).digest()))
+elif mode == "patch":
+    tmp_path, block_size = sys.argv[3], int(sys.argv[4])
+    stream = sys.stdin.buffer
+    def read(size):
+        data = stream.read(size)
+        if len(data) != size:
+            sys.exit("truncated delta")
+        return data
+    expected = read(20)
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as old, open(tmp_path, "wb") as new:
+            while True:
+                operation = read(1)
+                if operation == b"E":
+                    break
+                if operation == b"C":
+                    index, count = struct.unpack(">QI", read(12))
+                    old.seek(index * block_size)
+                    data = old.read(count * block_size)
+                elif operation == b"D":
+                    data = read(struct.unpack(">I", read(4))[0])
+                else:
+                    sys.exit("bad delta operation")
+                h.update(data)
+                new.write(data)
+        if h.digest() != expected:
+            sys.exit("hash mismatch after patch")
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+'''
+
+
+def get_block_size(file_size):
+    """
+        This method picks the block size used for a file, the square root of its size like rsync, bounded and rounded
+        to a multiple of 1024 bytes.
+
+        :param int file_size: The size of the file.
+
+        :return: The block size in bytes.
+    """
+
+    block_size = int(file_size ** 0.5) // 1024 * 1024
+
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def parse_signatures(data):
+    """
+        This method parses the output of the signature mode of REMOTE_DELTA_SCRIPT.
+
+        :param bytes data: The signature sent by the server.
+
+        :return: The size of the server file, the block size, and a dictionary mapping each weak checksum to a dictionary
+                 mapping each strong hash to a block index.
+    """
+
+    file_size, block_size = SIGNATURE_HEADER.unpack_from(data, 0)
+
+    signatures = {}
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(data[SIGNATURE_HEADER.size:])):
+        signatures.setdefault(weak, {}).setdefault(strong, index)
+
+    return file_size, block_size, signatures
+
+
+def generate_delta(local_file, block_size, signatures):
+    """
+        This generator computes the delta of a local file against the signature of the server copy and yields it in
+        the format read by the patch mode of REMOTE_DELTA_SCRIPT. The file is read with readinto() through a sliding
+        window and never fully read in memory, mmap is avoided as a file truncated during the delta would crash the
+        deployer with a SIGBUS. Consecutive matching blocks are merged into a single copy operation.
+
+        The last block of the server file may be shorter than block_size, it can only match the end of the local file.
+        A local file modified during the delta gives a patch whose hash does not match, which the server rejects.
+
+        :param str local_file: The path to the local file.
+        :param int block_size: The block size of the signature.
+        :param dict signatures: The signatures as returned by parse_signatures().
+
+        :return: A generator of bytes, the first 20 being the sha1 of the local file.
+    """
+
+    with open(local_file, "rb", buffering=0) as file:
+        size = os.fstat(file.fileno()).st_size
+
+        yield _hash_file(file)
+
+        if size == 0:
+            yield END_OPERATION
+            return
+
+        file.seek(0)
+        data = _FileWindow(file, size)
+
+        pending_copy = None
+        literal_start = 0
+        position = 0
+        weak = None
+        rolled = 0
+
+        while True:
+
+            # Literal data is sent as it is found, so that the window does not grow over a region without matches
+            if position - literal_start >= MAX_LITERAL_SIZE:
+                if pending_copy is not None:
+                    yield COPY_OPERATION.pack(b"C", *pending_copy)
+                    pending_copy = None
+                yield from _literal_operations(data, literal_start, literal_start + MAX_LITERAL_SIZE)
+                literal_start += MAX_LITERAL_SIZE
+
+            # The window holds the pending literal data, the current block and the byte rolled in after it
+            if position + block_size >= data.end:
+                data.fill(literal_start, position + block_size + 1)
+                if position + block_size > data.size:
+                    break
+
+            if weak is None:
+                weak = zlib.adler32(data[position:position + block_size])
+
+            candidates = signatures.get(weak)
+            index = None
+            if candidates is not None:
+                index = candidates.get(hashlib.sha1(data[position:position + block_size]).digest())
+
+            if index is not None:
+
+                if literal_start < position:
+                    if pending_copy is not None:
+                        yield COPY_OPERATION.pack(b"C", *pending_copy)
+                        pending_copy = None
+                    yield from _literal_operations(data, literal_start, position)
+
+                if pending_copy is not None and pending_copy[0] + pending_copy[1] == index:
+                    pending_copy[1] += 1
+                else:
+                    if pending_copy is not None:
+                        yield COPY_OPERATION.pack(b"C", *pending_copy)
+                    pending_copy = [index, 1]
+
+                position += block_size
+                literal_start = position
+                weak = None
+                rolled = 0
+                continue
+
+            if rolled >= MAX_ROLLED_BLOCKS * block_size:
+                # Give up on finding shifted blocks in this region, only check block aligned positions
+                position += block_size
+                weak = None
+                continue
+
+            if position + block_size < data.size:
+                weak = _roll_adler32(weak, data[position], data[position + block_size], block_size)
+            else:
+                weak = None
+            position += 1
+            rolled += 1
+
+        data.fill(literal_start, data.size)
+        size = data.size
+
+        # The end of the file may match the short last block of the server file
+        if 0 < size - literal_start < block_size:
+            tail = data[literal_start:size]
+            index = signatures.get(zlib.adler32(tail), {}).get(hashlib.sha1(tail).digest())
+            if index is not None:
+                if pending_copy is not None:
+                    yield COPY_OPERATION.pack(b"C", *pending_copy)
+                pending_copy = [index, 1]
+                literal_start = size
+
+        if pending_copy is not None:
+            yield COPY_OPERATION.pack(b"C", *pending_copy)
+
+        yield from _literal_operations(data, literal_start, size)
+
+    yield END_OPERATION
+
+
+# ////////////////////// Helpers ////////////////////// #
+
+def _roll_adler32(checksum, byte_out, byte_in, block_size):
+    """
+        This method slides an adler32 checksum, as computed by zlib.adler32(), by one byte.
+
+        :param int checksum: The checksum of the current window.
+        :param int byte_out: The byte leaving the window.
+        :param int byte_in: The byte entering the window.
+        :param int block_size: The size of the window.
+
+        :return: The checksum of the next window.
+    """
+
+    a = checksum & 0xffff
+    b = checksum >> 16
+
+    a = (a - byte_out + byte_in) % ADLER_MOD
+    b = (b - block_size * byte_out + a - 1) % ADLER_MOD
+
+    return (b << 16) | a
+
+
+def _literal_operations(data, start, end):
+
+    for offset in range(start, end, MAX_LITERAL_SIZE):
+        literal = bytes(data[offset:min(offset + MAX_LITERAL_SIZE, end)])
+        yield DATA_OPERATION.pack(b"D", len(literal)) + literal
+
+
+def _hash_file(file):
+
+    h = hashlib.sha1()
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+
+    for length in iter(lambda: file.readinto(buffer), 0):
+        h.update(view[:length])
+
+    return h.digest()
+
+
+class _FileWindow():
+    """
+        This is the _FileWindow class. It holds the bytes of a file from a start offset to the last one read, and is
+        indexed and sliced with file offsets. The bytes before the start offset are dropped as the window moves on.
+    """
+    def __init__(self, file, size):
+
+        self.file = file
+        # The size of the file when the delta started, lowered if it is truncated since
+        self.size = size
+
+        # File offsets of the first byte of data and of the byte after its last one
+        self.start = 0
+        self.end = 0
+        self.data = bytearray()
+        self.buffer = bytearray(READ_SIZE)
+
+    def fill(self, start, end):
+        """
+            This method moves the window to start and reads the file up to end, or up to its size.
+
+            :param int start: The first offset kept in the window.
+            :param int end: The offset the window is read up to.
+        """
+
+        if start > self.start:
+            del self.data[:start - self.start]
+            self.start = start
+
+        end = min(end, self.size)
+        view = memoryview(self.buffer)
+        while self.end < end:
+            length = self.file.readinto(view[:min(len(self.buffer), self.size - self.end)])
+            if not length:
+                # Truncated since the delta started
+                self.size = self.end
+                break
+            self.data += view[:length]
+            self.end += length
+
+    def __getitem__(self, item):
+
+        if isinstance(item, slice):
+            return self.data[item.start - self.start:item.stop - self.start]
+
+        return self.data[item - self.start]
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the DirectoryTree used by the ssh_deployer to represent the structure of a repo. It is a
+    dictionary, mapping the name of each element of a directory to either the hash of a file or the DirectoryTree of a
+    sub directory, that also carries a Merkle digest of its whole content. Two directories with the same digest hold the
+    same content, which lets the diff of two repos skip identical subtrees with a single comparison.
+
+    Hashes and digests are kept as raw 20 byte sha1 digests rather than hex strings, and names are interned, so that the
+    structure of a repo with millions of files stays compact in memory.
+"""
+
+import hashlib
+
+
+class DirectoryTree(dict):
+    """
+        This is the DirectoryTree class. Its digest is computed lazily from the digests of its elements and cached until
+        the tree is modified. Modifying a nested tree does not reset the digests of its ancestors, use set_element() to
+        update a tree in place.
+
+        A server directory is protected when elements matching the do not delete patterns were left out of its
+        structure, or out of the structure of one of its sub directories. It must not be deleted as a whole.
+    """
+
+    __slots__ = ("_digest", "protected")
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self._digest = None
+        self.protected = False
+
+    @property
+    def digest(self):
+        """
+            The raw digest of the tree. It is the sha1 of the sorted list of the elements of the directory, each one
+            given as its type, name and hash (for a file) or digest (for a directory).
+        """
+
+        if self._digest is None:
+            h = hashlib.sha1()
+            for name in sorted(self):
+                value = self[name]
+                if isinstance(value, dict):
+                    h.update(b"D" + name.encode(errors="surrogateescape") + b"\0" + get_digest(value) + b"\n")
+                else:
+                    h.update(b"F" + name.encode(errors="surrogateescape") + b"\0" + _value_bytes(value) + b"\n")
+            self._digest = h.digest()
+
+        return self._digest
+
+    def invalidate(self):
+        """
+            This method resets the cached digest of the tree.
+        """
+
+        self._digest = None
+
+    def __setitem__(self, key, value):
+        self._digest = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._digest = None
+        super().__delitem__(key)
+
+    def pop(self, *args):
+        self._digest = None
+        return super().pop(*args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._digest = None
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._digest = None
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._digest = None
+        super().clear()
+
+
+def get_digest(tree):
+    """
+        This method returns the digest of a repo structure, it also accepts plain dictionaries in which case the digest
+        is computed each time.
+
+        :param dict tree: The repo structure.
+
+        :return: The raw digest of the structure.
+    """
+
+    if isinstance(tree, DirectoryTree):
+        return tree.digest
+
+    return DirectoryTree(tree).digest
+
+
+def trees_differ(tree_a, tree_b):
+    """
+        This method checks whether two repo structures have a different content by comparing their digests.
+
+        :param dict tree_a: The first repo structure.
+        :param dict tree_b: The second repo structure.
+
+        :return: T/F based on if the structures differ.
+    """
+
+    return get_digest(tree_a) != get_digest(tree_b)
+
+
+def is_file_value(value):
+    """
+        This method checks whether a value of a repo structure is the value of a file, either its raw hash in the hash
+        compare mode or the value of get_metadata_value() in the metadata compare mode.
+
+        :param value: The value of an element of a repo structure.
+
+        :return: T/F based on if the value is the one of a file.
+    """
+
+    return isinstance(value, (bytes, str))
+
+
+def get_metadata_value(size, mtime):
+    """
+        This method returns the value of a file in a repo structure built in the metadata compare mode, where files are
+        compared by size and modification time (in whole seconds, the resolution of SFTP) instead of by content.
+
+        :param int size: The size of the file.
+        :param float mtime: The modification time of the file.
+
+        :return: The value of the file in the structure.
+    """
+
+    return "{}:{}".format(size, int(mtime))
+
+
+def parse_metadata_value(value):
+    """
+        This method is the reverse of get_metadata_value().
+
+        :param str value: The value of a file in a structure built in the metadata compare mode.
+
+        :return: The size and the modification time of the file.
+    """
+
+    size, mtime = value.split(":")
+
+    return int(size), int(mtime)
+
+
+def get_element(tree, path):
+    """
+        This method returns the value of an element of a repo structure.
+
+        :param dict tree: The repo structure.
+        :param str path: The path of the element relative to the repo.
+
+        :return: The hash of a file, the structure of a directory, or None if the element does not exist.
+    """
+
+    ret_val = tree
+    for name in path.split("/"):
+        ret_val = ret_val.get(name) if isinstance(ret_val, dict) else None
+        if ret_val is None:
+            break
+
+    return ret_val
+
+
+def copy_tree(tree):
+    """
+        This method copies a repo structure, with the digests already computed, so that the copy can be updated in place
+        without modifying the original.
+
+        :param dict tree: The repo structure.
+
+        :return: The copy of the structure.
+    """
+
+    ret_val = DirectoryTree((name, copy_tree(value) if isinstance(value, dict) else value) for name, value in tree.items())
+    ret_val._digest = getattr(tree, "_digest", None)
+    ret_val.protected = getattr(tree, "protected", False)
+
+    return ret_val
+
+
+def set_protected(tree, path):
+    """
+        This method marks the directories holding an element left out of a repo structure as protected (see
+        DirectoryTree), the missing ones are created.
+
+        :param DirectoryTree tree: The repo structure.
+        :param str path: The path of the element relative to the repo.
+    """
+
+    parent = tree
+    parent.protected = True
+    for name in path.split("/")[:-1]:
+        if not isinstance(parent.get(name), dict):
+            parent[name] = DirectoryTree()
+        parent = parent[name]
+        parent.protected = True
+
+
+def set_element(tree, path, value):
+    """
+        This method sets the value of an element of a repo structure in place, and resets the digest of every directory
+        on the way so that they are recomputed. The parent directory of the element must exist in the structure.
+
+        :param DirectoryTree tree: The repo structure.
+        :param str path: The path of the element relative to the repo.
+        :param value: The hash of a file, the DirectoryTree of a directory, or None to remove the element.
+    """
+
+    names = path.split("/")
+
+    parent = tree
+    for name in names[:-1]:
+        if isinstance(parent, DirectoryTree):
+            parent.invalidate()
+        parent = parent[name]
+
+    if value is None:
+        parent.pop(names[-1], None)
+    else:
+        parent[names[-1]] = value
+
+
+
+# ////////////////////// Helpers ////////////////////// #
+
+def _value_bytes(value):
+
+    return value if isinstance(value, bytes) else value.encode()
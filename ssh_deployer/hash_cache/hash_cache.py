@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the hash_cache used by the ssh_deployer to avoid re-hashing local files that have not
+    changed since the last scan. A file's digest is reused as long as the (inode, size, mtime_ns) of its stat result
+    is identical to the one recorded when the digest was computed. The cache is saved to disk so that it survives
+    restarts of the deployer.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from ssh_deployer.hash_engine.hash_engine import DEFAULT_HASH_ENGINE
+
+DEFAULT_MAX_ENTRIES = 500000
+
+# Files modified this recently are not cached, a same-size write in the same timestamp tick would go unnoticed
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+CACHE_FILE_VERSION = 1
+
+
+def get_default_cache_path(repo_path):
+    """
+        This method returns the default location of the hash cache of a given local repo. The cache is stored in the
+        XDG cache directory ($XDG_CACHE_HOME or ~/.cache) and named after a hash of the repo path so that several repos
+        can be deployed from the same machine.
+
+        :param str repo_path: The path to the local repo.
+
+        :return: The path to the cache file.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    repo_id = hashlib.sha1(os.path.abspath(repo_path).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_home, "ssh_deployer", "hash_cache_{}.json".format(repo_id))
+
+
+class HashCache():
+    """
+        This is the hash_cache class. It maps the path of a local file to its stat signature and digest. It is thread
+        safe, the targets of the deployer look files up while the local repo is being scanned.
+    """
+    def __init__(self, repo_path, cache_path=None, max_entries=DEFAULT_MAX_ENTRIES, verbose=False):
+
+        self.repo_path = repo_path
+        self.cache_path = cache_path if cache_path else get_default_cache_path(repo_path)
+        self.max_entries = max_entries
+        self.verbose = verbose
+
+        # path -> (inode, size, mtime_ns, raw digest), kept in least recently used order, digests are saved in hex
+        self.entries = {}
+        # Name of the HashEngine the digests were computed with
+        self.hash_engine = DEFAULT_HASH_ENGINE.name
+        # Paths looked up since the last prune(), everything else was deleted from the repo
+        self.seen = set()
+        self.dirty = False
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.load()
+
+    def set_hash_engine(self, hash_engine):
+        """
+            This method sets the engine the digests are computed with, the cache is emptied if it was another one.
+
+            :param HashEngine hash_engine: The engine.
+        """
+
+        with self.lock:
+            if hash_engine.name != self.hash_engine:
+                if self.verbose: print("Hash engine changed from {} to {}, clearing the hash cache".format(self.hash_engine, hash_engine.name))
+                self.hash_engine = hash_engine.name
+                self.entries = {}
+                self.dirty = True
+
+    def get_hash(self, file_path, stat_result, hash_function):
+        """
+            This method returns the digest of a file, using the cached digest if the stat signature of the file did not
+            change, or calling hash_function and caching its result otherwise.
+
+            :param str file_path: The path to the file.
+            :param os.stat_result stat_result: The stat result of the file, usually from os.scandir().
+            :param hash_function: A function taking a file path and returning its digest.
+
+            :return: The digest of the file.
+        """
+
+        digest = self.lookup(file_path, stat_result)
+
+        if digest is None:
+            digest = hash_function(file_path)
+            self.store(file_path, stat_result, digest)
+
+        return digest
+
+    def lookup(self, file_path, stat_result):
+        """
+            This method returns the cached digest of a file if its stat signature did not change.
+
+            :param str file_path: The path to the file.
+            :param os.stat_result stat_result: The stat result of the file.
+
+            :return: The digest of the file, or None if it needs to be hashed.
+        """
+
+        with self.lock:
+            self.seen.add(file_path)
+
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[:3] == (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns):
+                self.hits += 1
+                # Move the entry to the end to keep the least recently used order
+                self.entries[file_path] = self.entries.pop(file_path)
+                return entry[3]
+
+            self.misses += 1
+
+        return None
+
+    def store(self, file_path, stat_result, digest):
+        """
+            This method caches the digest of a file computed for a given stat signature.
+
+            :param str file_path: The path to the file.
+            :param os.stat_result stat_result: The stat result of the file when it was hashed.
+            :param bytes digest: The digest of the file.
+        """
+
+        with self.lock:
+            self.seen.add(file_path)
+
+            entry = self.entries.pop(file_path, None)
+
+            if time.time_ns() - stat_result.st_mtime_ns > RACY_WINDOW_NS:
+                self.entries[file_path] = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns, digest)
+                self.dirty = True
+            elif entry is not None:
+                self.dirty = True
+
+    def prune(self):
+        """
+            This method evicts the entries of every path that was not looked up since the last prune, which are the paths
+            deleted from the repo, and then the least recently used entries until the cache fits in max_entries. It
+            should only be called after a full scan of the repo, the hit and miss counters are reset for the next scan.
+        """
+
+        with self.lock:
+            for file_path in [path for path in self.entries if path not in self.seen]:
+                del self.entries[file_path]
+                self.dirty = True
+
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+                self.dirty = True
+
+            self.seen = set()
+            self.hits = 0
+            self.misses = 0
+
+    def load(self):
+        """
+            This method loads the cache from the cache file. A missing or unreadable cache file results in an empty
+            cache.
+        """
+
+        try:
+            with open(self.cache_path) as cache_file:
+                cache_json = json.load(cache_file)
+
+            if cache_json.get("version") == CACHE_FILE_VERSION and cache_json.get("repo") == self.repo_path:
+                self.entries = {file_path: (inode, size, mtime_ns, bytes.fromhex(digest))
+                                for file_path, (inode, size, mtime_ns, digest) in cache_json["entries"].items()}
+                # Caches saved before the hash engine was pluggable hold sha1 digests
+                self.hash_engine = cache_json.get("hash_engine", DEFAULT_HASH_ENGINE.name)
+
+        except FileNotFoundError:
+            pass
+
+        except Exception as e:
+            print("!!! ERROR: Could not load hash cache [{}]: [{}] !!!".format(self.cache_path, e))
+
+        if self.verbose: print("Loaded {} hash cache entries from {}".format(len(self.entries), self.cache_path))
+
+    def save(self):
+        """
+            This method writes the cache to the cache file if it changed since it was loaded. The file is written to a
+            temporary path and renamed so that a crash never leaves a truncated cache behind.
+        """
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+
+                tmp_path = "{}.tmp".format(self.cache_path)
+                with open(tmp_path, "w") as cache_file:
+                    entries = {file_path: (inode, size, mtime_ns, digest.hex())
+                               for file_path, (inode, size, mtime_ns, digest) in self.entries.items()}
+                    json.dump({"version": CACHE_FILE_VERSION, "repo": self.repo_path, "hash_engine": self.hash_engine,
+                               "entries": entries}, cache_file)
+                os.replace(tmp_path, self.cache_path)
+
+                self.dirty = False
+
+            except Exception as e:
+                print("!!! ERROR: Could not save hash cache [{}]: [{}] !!!".format(self.cache_path, e))
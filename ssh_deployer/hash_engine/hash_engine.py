@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the hash_engine used by the ssh_deployer to hash the files of the local and server repos. The
+    algorithm is pluggable: both sides of a deployment must hash with the same one, so the deployer asks each server
+    which algorithms it supports when it connects and picks the fastest one they all share.
+
+    A server supports an algorithm when it has its coreutils command (sha1sum, md5sum, b2sum), or through the remote
+    agent which hashes with the python hashlib of the server. The sampled mode, which hashes large files from a few
+    samples of their content, is only supported through the remote agent.
+"""
+
+import hashlib
+import os
+import time
+
+# Algorithm -> (hashlib name, hashlib arguments, server command or None when only the remote agent supports it). The
+# BLAKE2 digests are truncated to 160 bits, the size of a sha1 digest.
+HASH_ALGORITHMS = {
+    "sha1": ("sha1", {}, "sha1sum"),
+    "md5": ("md5", {}, "md5sum"),
+    "blake2b": ("blake2b", {"digest_size": 20}, "b2sum -l 160"),
+    "blake2s": ("blake2s", {"digest_size": 20}, None),
+}
+
+DEFAULT_HASH_ALGORITHM = "sha1"
+
+# Capability of a server that can hash in the sampled mode
+SAMPLED_CAPABILITY = "sampled"
+
+# The algorithm in use is kept unless another one is this much faster, switching rehashes every file
+HASH_SWITCH_MARGIN = 1.2
+
+HASH_BUFFER_SIZE = 1024 * 1024
+BENCHMARK_SIZE = 8 * 1024 * 1024
+
+# Algorithm -> measured local throughput in bytes per second, see get_hash_throughput()
+_throughputs = {}
+
+
+class HashEngine():
+    """
+        This is the hash_engine class. It hashes files with a given algorithm. With a sample size, the files larger
+        than three samples are hashed from their size and from a sample at their start, middle and end instead of from
+        their whole content, a change that leaves the size and the samples unchanged then goes unnoticed.
+    """
+    def __init__(self, algorithm=DEFAULT_HASH_ALGORITHM, sample_size=0):
+
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError("Unknown hash algorithm [{}]".format(algorithm))
+
+        self.algorithm = algorithm
+        self.sample_size = sample_size
+
+        # Identifies the digests of the engine, digests computed by different engines must not be compared
+        self.name = algorithm if not sample_size else "{}/sampled:{}".format(algorithm, sample_size)
+
+    def __eq__(self, other):
+        return isinstance(other, HashEngine) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def new(self):
+        """
+            :return: A new hashlib object of the algorithm.
+        """
+
+        name, arguments, _ = HASH_ALGORITHMS[self.algorithm]
+
+        return hashlib.new(name, **arguments)
+
+    def hash_file(self, filename):
+        """
+            This method returns the raw digest of a file. The file is read with readinto() in a large reusable buffer,
+            mmap is avoided as a file truncated while being hashed would crash the deployer with a SIGBUS.
+
+            :param str filename: The path to the file.
+
+            :return: The raw digest of the file.
+        """
+
+        h = self.new()
+        buffer = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+
+        with open(filename, 'rb', buffering=0) as file:
+
+            if self.sample_size:
+                size = os.fstat(file.fileno()).st_size
+                if size > 3 * self.sample_size:
+                    h.update(str(size).encode())
+                    for offset in (0, (size - self.sample_size) // 2, size - self.sample_size):
+                        file.seek(offset)
+                        h.update(file.read(self.sample_size))
+                    return h.digest()
+
+            for length in iter(lambda: file.readinto(buffer), 0):
+                h.update(view[:length])
+
+        return h.digest()
+
+    def server_command(self):
+        """
+            :return: The server command hashing the files given as arguments, or None if only the remote agent can hash
+                     with this engine.
+        """
+
+        return HASH_ALGORITHMS[self.algorithm][2] if not self.sample_size else None
+
+    def agent_arguments(self):
+        """
+            :return: The arguments the remote agent needs to hash with this engine.
+        """
+
+        name, arguments, _ = HASH_ALGORITHMS[self.algorithm]
+
+        return {"name": name, "arguments": arguments, "sample": self.sample_size}
+
+    def is_supported(self, capabilities):
+        """
+            :param set capabilities: The algorithms a server supports, and SAMPLED_CAPABILITY if it supports the sampled
+                                     mode.
+
+            :return: T/F based on if the server can hash with this engine.
+        """
+
+        return self.algorithm in capabilities and (not self.sample_size or SAMPLED_CAPABILITY in capabilities)
+
+
+DEFAULT_HASH_ENGINE = HashEngine()
+
+
+def get_hash_throughput(algorithm):
+    """
+        This method measures how fast an algorithm hashes on the local machine. The measure is done once and cached.
+
+        :param str algorithm: One of HASH_ALGORITHMS.
+
+        :return: The throughput in bytes per second.
+    """
+
+    if algorithm not in _throughputs:
+        engine = HashEngine(algorithm)
+        data = bytes(BENCHMARK_SIZE)
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            engine.new().update(data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        _throughputs[algorithm] = BENCHMARK_SIZE / max(best, 1e-9)
+
+    return _throughputs[algorithm]
+
+
+def choose_hash_algorithm(capabilities, current=None):
+    """
+        This method picks the fastest algorithm supported by every server. The local throughput of each algorithm is
+        used to rank them, assuming the servers run on similar hardware.
+
+        :param list capabilities: The capabilities of each server, see HashEngine.is_supported().
+        :param str current: The algorithm in use, it is kept unless another one is HASH_SWITCH_MARGIN times faster.
+
+        :return: The algorithm, DEFAULT_HASH_ALGORITHM if the servers share none.
+    """
+
+    candidates = [algorithm for algorithm in HASH_ALGORITHMS
+                  if all(algorithm in server_capabilities for server_capabilities in capabilities)]
+
+    if not candidates:
+        return DEFAULT_HASH_ALGORITHM
+
+    ret_val = max(candidates, key=get_hash_throughput)
+    if current in candidates and get_hash_throughput(ret_val) < HASH_SWITCH_MARGIN * get_hash_throughput(current):
+        ret_val = current
+
+    return ret_val
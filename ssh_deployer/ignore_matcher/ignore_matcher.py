@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the ignore_matcher used by the ssh_deployer to match the "Ignored Files" and "Do Not Delete"
+    patterns of the init file. The patterns follow the syntax of .gitignore files:
+
+        build/          A directory named build, at any depth (the trailing "/" only matches directories)
+        *.pyc           Any file or directory whose name ends with .pyc, at any depth
+        /config.json    config.json at the root of the repo only, a pattern with a "/" is relative to the repo root
+        docs/*.md       Markdown files directly inside the docs directory of the repo root
+        **/logs         A logs directory or file at any depth, logs/** everything inside logs, a/**/b any depth between
+        !keep.pyc       A pattern starting with "!" includes again what an earlier pattern ignored
+
+    The last pattern matching a path decides. As with git, a file cannot be included again if one of its directories is
+    ignored: ignored directories are pruned, they are never walked. Patterns are compiled once into regular expressions
+    matched against paths relative to the repo.
+"""
+
+import collections
+import re
+
+# pattern: the glob without its "!", leading and trailing "/", anchored: relative to the repo root
+IgnoreRule = collections.namedtuple("IgnoreRule", ["pattern", "regex", "negate", "dir_only", "anchored"])
+
+
+class IgnoreMatcher():
+    """
+        This is the ignore_matcher class. It is built from a list of patterns, blank ones and the ones starting with "#"
+        are skipped.
+    """
+    def __init__(self, patterns):
+
+        self.patterns = list(patterns)
+        self.rules = [rule for rule in (compile_pattern(pattern) for pattern in self.patterns) if rule is not None]
+        self.has_negations = any(rule.negate for rule in self.rules)
+
+        # Without negations, a path is ignored if any rule matches it, so the rules are merged into a single regular
+        # expression for files and one for directories
+        self.file_regex = None
+        self.directory_regex = None
+        if not self.has_negations:
+            self.file_regex = _merge_regexes([rule.regex for rule in self.rules if not rule.dir_only])
+            self.directory_regex = _merge_regexes([rule.regex for rule in self.rules])
+
+    def __bool__(self):
+
+        return bool(self.rules)
+
+    def is_ignored(self, path, is_dir=False):
+        """
+            This method tells if a path matches the patterns. The directories of the path are not checked, the walks
+            that call it never enter ignored directories.
+
+            :param str path: The path relative to the repo, "/" separated, without a leading "/".
+            :param bool is_dir: T/F based on if the path is a directory.
+
+            :return: T/F based on if the path is ignored.
+        """
+
+        if not self.has_negations:
+            regex = self.directory_regex if is_dir else self.file_regex
+            return regex is not None and regex.match(path) is not None
+
+        for rule in reversed(self.rules):
+            if (is_dir or not rule.dir_only) and rule.regex.match(path):
+                return not rule.negate
+
+        return False
+
+    def is_path_ignored(self, path, is_dir=False):
+        """
+            This method tells if a path, or one of its directories, matches the patterns. It is meant for the paths that
+            were not found by walking the repo, like the ones reported by the watcher.
+
+            :param str path: The path relative to the repo, "/" separated, without a leading "/".
+            :param bool is_dir: T/F based on if the path is a directory.
+
+            :return: T/F based on if the path is ignored.
+        """
+
+        names = path.split("/")
+        for index in range(1, len(names)):
+            if self.is_ignored("/".join(names[:index]), is_dir=True):
+                return True
+
+        return self.is_ignored(path, is_dir)
+
+
+def compile_pattern(pattern):
+    """
+        This method compiles a .gitignore style pattern.
+
+        :param str pattern: The pattern.
+
+        :return: The IgnoreRule of the pattern, or None for a blank pattern or a comment.
+    """
+
+    pattern = pattern.rstrip(" ")
+    if not pattern or pattern.startswith("#"):
+        return None
+
+    negate = pattern.startswith("!")
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+        pattern = pattern[1:]
+
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+
+    # A "/" anywhere but at the end ties the pattern to the repo root, otherwise it matches a name at any depth
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    if not pattern:
+        return None
+
+    regex = _translate(pattern)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+
+    return IgnoreRule(pattern, re.compile(regex + "\\Z", re.DOTALL), negate, dir_only, anchored)
+
+
+def escape_pattern(path):
+    """
+        This method escapes the special characters of a path, so that it is matched literally as a pattern.
+
+        :param str path: The path.
+
+        :return: The pattern.
+    """
+
+    return "".join("\\" + character if character in "*?[\\" else character for character in path)
+
+
+# ////////////////////// Helpers ////////////////////// #
+
+def _translate(pattern):
+    """
+        This method translates a pattern into a regular expression, "**" being special only as a whole path segment.
+    """
+
+    segments = pattern.split("/")
+    ret_val = ""
+
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+
+        if segment == "**":
+            # At the end it matches everything inside the directory, elsewhere any number of directories
+            ret_val += ".+" if last else "(?:.*/)?"
+        else:
+            ret_val += _translate_segment(segment) + ("" if last else "/")
+
+    return ret_val
+
+
+def _translate_segment(segment):
+
+    ret_val = ""
+    index = 0
+
+    while index < len(segment):
+        character = segment[index]
+
+        if character == "*":
+            ret_val += "[^/]*"
+            while index + 1 < len(segment) and segment[index + 1] == "*":
+                index += 1
+
+        elif character == "?":
+            ret_val += "[^/]"
+
+        elif character == "[":
+            # A "]" right after the opening bracket, or its negation, is part of the set
+            end = index + 1
+            if end < len(segment) and segment[end] in "!^":
+                end += 1
+            if end < len(segment) and segment[end] == "]":
+                end += 1
+            end = segment.find("]", end)
+
+            if end < 0:
+                ret_val += re.escape(character)
+            else:
+                characters = segment[index + 1:end]
+                negate = characters[:1] in ("!", "^")
+                if negate:
+                    characters = characters[1:]
+                characters = characters.replace("\\", "\\\\").replace("[", "\\[")
+                ret_val += "(?!/)[{}{}]".format("^" if negate else "", characters)
+                index = end
+
+        elif character == "\\" and index + 1 < len(segment):
+            index += 1
+            ret_val += re.escape(segment[index])
+
+        else:
+            ret_val += re.escape(character)
+
+        index += 1
+
+    return ret_val
+
+
+def _merge_regexes(regexes):
+
+    if not regexes:
+        return None
+
+    return re.compile("|".join("(?:{})".format(regex.pattern) for regex in regexes), re.DOTALL)
@@ -3,13 +3,21 @@
 import json
 import os
 
-from schema import Schema, SchemaError
+from schema import And, Schema, SchemaError, Optional, Or
+
+from ssh_deployer.hash_engine.hash_engine import HASH_ALGORITHMS
+from ssh_deployer.ignore_matcher.ignore_matcher import IgnoreMatcher, escape_pattern
 
 SSH_CONNECTION_CFG_GROUP = "SSH Connection"
 HOST_CFG_KEY = "Host"
 USER_CFG_KEY = "User"
+PORT_CFG_KEY = "Port"
+KNOWN_HOSTS_FILE_CFG_KEY = "Known Hosts File"
+
+DEFAULT_PORT = 22
 
 DEPLOYMENT_CFG_GROUP = "Deployment"
+NAME_CFG_KEY = "Name"
 LOCAL_REPO_PATH_CFG_KEY = "Local Repo Path"
 SERVER_REPO_PATH_CFG_KEY = "Server Repo Path"
 IGNORED_FILES_CFG_KEY = "Ignored Files"
@@ -20,21 +28,146 @@ PAUSE_CFG_KEY = "Pause"
 SHUTDOWN_CFG_KEY = "Shutdown"
 LOOP_DELAY_CFG_KEY = "Loop Delay"
 
+PERFORMANCE_CFG_GROUP = "Performance"
+HASH_CACHE_PATH_CFG_KEY = "Hash Cache Path"
+HASH_CACHE_SIZE_CFG_KEY = "Hash Cache Size"
+REMOTE_SCAN_MODE_CFG_KEY = "Remote Scan Mode"
+REMOTE_HASH_WORKERS_CFG_KEY = "Remote Hash Workers"
+WATCH_MODE_CFG_KEY = "Watch Mode"
+WATCH_DEBOUNCE_CFG_KEY = "Watch Debounce"
+FULL_SYNC_INTERVAL_CFG_KEY = "Full Sync Interval"
+UPLOAD_WORKERS_CFG_KEY = "Upload Workers"
+BULK_UPLOAD_MIN_FILES_CFG_KEY = "Bulk Upload Min Files"
+BULK_UPLOAD_MAX_FILE_SIZE_CFG_KEY = "Bulk Upload Max File Size"
+BULK_UPLOAD_COMPRESSION_CFG_KEY = "Bulk Upload Compression"
+DELTA_THRESHOLD_CFG_KEY = "Delta Threshold"
+LOCAL_HASH_WORKERS_CFG_KEY = "Local Hash Workers"
+LOCAL_HASH_EXECUTOR_CFG_KEY = "Local Hash Executor"
+
+LOCAL_HASH_EXECUTORS = ("thread", "process")
+
+COMPARE_MODE_CFG_KEY = "Compare Mode"
+VERIFY_INTERVAL_CFG_KEY = "Verify Interval"
+
+COMPARE_MODES = ("hash", "metadata")
+
+METRICS_CFG_GROUP = "Metrics"
+JSON_LINES_FILE_CFG_KEY = "JSON Lines File"
+PROMETHEUS_FILE_CFG_KEY = "Prometheus File"
+PROFILE_CYCLE_CFG_KEY = "Profile Cycle"
+PROFILE_FILE_CFG_KEY = "Profile File"
+
+SERVER_SNAPSHOT_CFG_KEY = "Server Snapshot"
+SERVER_SNAPSHOT_PATH_CFG_KEY = "Server Snapshot Path"
+
+REMOTE_AGENT_CFG_KEY = "Remote Agent"
+
+CONNECT_TIMEOUT_CFG_KEY = "Connect Timeout"
+SLOW_TARGET_TIMEOUT_CFG_KEY = "Slow Target Timeout"
+
+HASH_ALGORITHM_CFG_KEY = "Hash Algorithm"
+HASH_SAMPLE_SIZE_CFG_KEY = "Hash Sample Size"
+
+CHUNKED_UPLOAD_THRESHOLD_CFG_KEY = "Chunked Upload Threshold"
+UPLOAD_CHUNK_SIZE_CFG_KEY = "Upload Chunk Size"
+
+MAX_IDLE_LOOP_DELAY_CFG_KEY = "Max Idle Loop Delay"
+
+BANDWIDTH_LIMIT_CFG_KEY = "Bandwidth Limit"
+
+BULK_UPLOAD_COMPRESSIONS = ("none", "gzip", "bz2", "xz")
+
+REMOTE_SCAN_MODES = ("manifest", "sftp")
+
+DEFAULT_HASH_CACHE_SIZE = 500000
+DEFAULT_REMOTE_SCAN_MODE = "manifest"
+DEFAULT_REMOTE_HASH_WORKERS = 4
+DEFAULT_WATCH_MODE = False
+DEFAULT_WATCH_DEBOUNCE = 0.2
+DEFAULT_FULL_SYNC_INTERVAL = 300
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_BULK_UPLOAD_MIN_FILES = 64
+DEFAULT_BULK_UPLOAD_MAX_FILE_SIZE = 1024 * 1024
+DEFAULT_BULK_UPLOAD_COMPRESSION = "gzip"
+DEFAULT_DELTA_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_LOCAL_HASH_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_LOCAL_HASH_EXECUTOR = "thread"
+DEFAULT_COMPARE_MODE = "hash"
+DEFAULT_VERIFY_INTERVAL = 3600
+DEFAULT_SERVER_SNAPSHOT = True
+DEFAULT_REMOTE_AGENT = False
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_SLOW_TARGET_TIMEOUT = 30
+DEFAULT_HASH_ALGORITHM = "auto"
+DEFAULT_HASH_SAMPLE_SIZE = 0
+DEFAULT_CHUNKED_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_IDLE_LOOP_DELAY = 30
+DEFAULT_BANDWIDTH_LIMIT = 0
+
+# A target of the "SSH Connection" group, its "Server Repo Path" overrides the one of the "Deployment" group
+SSH_TARGET_VALIDATION = {
+    HOST_CFG_KEY: str,
+    USER_CFG_KEY: str,
+    Optional(PORT_CFG_KEY): int,
+    Optional(KNOWN_HOSTS_FILE_CFG_KEY): str,
+    Optional(SERVER_REPO_PATH_CFG_KEY): str
+}
+
+SSH_CONNECTION_VALIDATION = Or(SSH_TARGET_VALIDATION, And([SSH_TARGET_VALIDATION], len))
+
+# A deployment of the "Deployment" group, its "SSH Connection" overrides the top level one
+DEPLOYMENT_VALIDATION = {
+    Optional(NAME_CFG_KEY): str,
+    LOCAL_REPO_PATH_CFG_KEY: str,
+    SERVER_REPO_PATH_CFG_KEY: str,
+    IGNORED_FILES_CFG_KEY: [str],
+    DO_NOT_DELETE_CFG_KEY: [str],
+    Optional(SSH_CONNECTION_CFG_GROUP): SSH_CONNECTION_VALIDATION
+}
+
 CFG_FILE_VALIDATION = Schema({
-    SSH_CONNECTION_CFG_GROUP: {
-        HOST_CFG_KEY: str,
-        USER_CFG_KEY: str
-    },
-    DEPLOYMENT_CFG_GROUP: {
-        LOCAL_REPO_PATH_CFG_KEY: str,
-        SERVER_REPO_PATH_CFG_KEY: str,
-        IGNORED_FILES_CFG_KEY: list,
-        DO_NOT_DELETE_CFG_KEY: list
-    },
+    Optional(SSH_CONNECTION_CFG_GROUP): SSH_CONNECTION_VALIDATION,
+    DEPLOYMENT_CFG_GROUP: Or(DEPLOYMENT_VALIDATION, And([DEPLOYMENT_VALIDATION], len)),
     CONFIG_CFG_GROUP: {
         PAUSE_CFG_KEY: bool,
         SHUTDOWN_CFG_KEY: bool,
         LOOP_DELAY_CFG_KEY: int
+    },
+    Optional(PERFORMANCE_CFG_GROUP): {
+        Optional(HASH_CACHE_PATH_CFG_KEY): str,
+        Optional(HASH_CACHE_SIZE_CFG_KEY): int,
+        Optional(REMOTE_SCAN_MODE_CFG_KEY): lambda mode: mode in REMOTE_SCAN_MODES,
+        Optional(REMOTE_HASH_WORKERS_CFG_KEY): int,
+        Optional(WATCH_MODE_CFG_KEY): bool,
+        Optional(WATCH_DEBOUNCE_CFG_KEY): Or(int, float),
+        Optional(FULL_SYNC_INTERVAL_CFG_KEY): int,
+        Optional(UPLOAD_WORKERS_CFG_KEY): int,
+        Optional(BULK_UPLOAD_MIN_FILES_CFG_KEY): int,
+        Optional(BULK_UPLOAD_MAX_FILE_SIZE_CFG_KEY): int,
+        Optional(BULK_UPLOAD_COMPRESSION_CFG_KEY): lambda compression: compression in BULK_UPLOAD_COMPRESSIONS,
+        Optional(DELTA_THRESHOLD_CFG_KEY): int,
+        Optional(LOCAL_HASH_WORKERS_CFG_KEY): int,
+        Optional(LOCAL_HASH_EXECUTOR_CFG_KEY): lambda executor: executor in LOCAL_HASH_EXECUTORS,
+        Optional(COMPARE_MODE_CFG_KEY): lambda mode: mode in COMPARE_MODES,
+        Optional(VERIFY_INTERVAL_CFG_KEY): int,
+        Optional(SERVER_SNAPSHOT_CFG_KEY): bool,
+        Optional(SERVER_SNAPSHOT_PATH_CFG_KEY): str,
+        Optional(REMOTE_AGENT_CFG_KEY): bool,
+        Optional(CONNECT_TIMEOUT_CFG_KEY): Or(int, float),
+        Optional(SLOW_TARGET_TIMEOUT_CFG_KEY): Or(int, float),
+        Optional(HASH_ALGORITHM_CFG_KEY): lambda algorithm: algorithm == "auto" or algorithm in HASH_ALGORITHMS,
+        Optional(HASH_SAMPLE_SIZE_CFG_KEY): And(int, lambda size: size >= 0),
+        Optional(CHUNKED_UPLOAD_THRESHOLD_CFG_KEY): And(int, lambda size: size >= 0),
+        Optional(UPLOAD_CHUNK_SIZE_CFG_KEY): And(int, lambda size: size > 0),
+        Optional(MAX_IDLE_LOOP_DELAY_CFG_KEY): Or(int, float),
+        Optional(BANDWIDTH_LIMIT_CFG_KEY): And(int, lambda limit: limit >= 0)
+    },
+    Optional(METRICS_CFG_GROUP): {
+        Optional(JSON_LINES_FILE_CFG_KEY): str,
+        Optional(PROMETHEUS_FILE_CFG_KEY): str,
+        Optional(PROFILE_CYCLE_CFG_KEY): int,
+        Optional(PROFILE_FILE_CFG_KEY): str
     }
 })
 
@@ -44,13 +177,52 @@ class InitFileParser():
 
         self.init_file_path = init_file_path
 
+        # Stat signature of the init file when parse_cfg_from_init_json() last read it, and the values it returned
+        self.cfg_signature = None
+        self.cfg_values = (None, None, None)
+
         self.attributes = {
+            "deployments": None,
             "ssh_host": None,
             "ssh_user": None,
+            "ssh_port": None,
+            "known_hosts_file": None,
+            "targets": None,
             "deployment_local": None,
             "deployment_server": None,
             "ignore_files": None,
-            "do_not_delete": None
+            "do_not_delete": None,
+            "hash_cache_path": None,
+            "hash_cache_size": None,
+            "remote_scan_mode": None,
+            "remote_hash_workers": None,
+            "watch_mode": None,
+            "watch_debounce": None,
+            "full_sync_interval": None,
+            "upload_workers": None,
+            "bulk_upload_min_files": None,
+            "bulk_upload_max_file_size": None,
+            "bulk_upload_compression": None,
+            "delta_threshold": None,
+            "local_hash_workers": None,
+            "local_hash_executor": None,
+            "compare_mode": None,
+            "verify_interval": None,
+            "server_snapshot": None,
+            "server_snapshot_path": None,
+            "remote_agent": None,
+            "connect_timeout": None,
+            "slow_target_timeout": None,
+            "hash_algorithm": None,
+            "hash_sample_size": None,
+            "chunked_upload_threshold": None,
+            "upload_chunk_size": None,
+            "max_idle_loop_delay": None,
+            "bandwidth_limit": None,
+            "metrics_json_lines_file": None,
+            "metrics_prometheus_file": None,
+            "profile_cycle": None,
+            "profile_file": None
         }
 
         self.parse_init_file()
@@ -69,20 +241,101 @@ class InitFileParser():
 
                 CFG_FILE_VALIDATION.validate(init_json)
 
-                self.attributes["ssh_host"] = init_json[SSH_CONNECTION_CFG_GROUP][HOST_CFG_KEY]
+                performance = init_json.get(PERFORMANCE_CFG_GROUP, {})
+
+                # A single deployment or a list of them, all run by the same deployer process
+                deployments_json = init_json[DEPLOYMENT_CFG_GROUP]
+                if not isinstance(deployments_json, list):
+                    deployments_json = [deployments_json]
+                deployments = [self._parse_deployment(deployment_json, index, init_json.get(SSH_CONNECTION_CFG_GROUP),
+                                                      performance)
+                               for index, deployment_json in enumerate(deployments_json)]
+                self.attributes["deployments"] = deployments
+
+                # The first deployment and its first target, for the code that only deals with one of them
+                for name in ("deployment_local", "deployment_server", "ignore_files", "do_not_delete", "targets",
+                             "hash_cache_path", "server_snapshot_path"):
+                    self.attributes[name] = deployments[0][name]
+
+                self.attributes["ssh_host"] = deployments[0]["targets"][0]["host"]
+
+                self.attributes["ssh_user"] = deployments[0]["targets"][0]["user"]
+
+                self.attributes["ssh_port"] = deployments[0]["targets"][0]["port"]
+
+                self.attributes["known_hosts_file"] = deployments[0]["targets"][0]["known_hosts_file"]
+
+                self.attributes["hash_cache_size"] = performance.get(HASH_CACHE_SIZE_CFG_KEY, DEFAULT_HASH_CACHE_SIZE)
+
+                self.attributes["remote_scan_mode"] = performance.get(REMOTE_SCAN_MODE_CFG_KEY, DEFAULT_REMOTE_SCAN_MODE)
+
+                self.attributes["remote_hash_workers"] = performance.get(REMOTE_HASH_WORKERS_CFG_KEY, DEFAULT_REMOTE_HASH_WORKERS)
+
+                self.attributes["watch_mode"] = performance.get(WATCH_MODE_CFG_KEY, DEFAULT_WATCH_MODE)
+
+                self.attributes["watch_debounce"] = performance.get(WATCH_DEBOUNCE_CFG_KEY, DEFAULT_WATCH_DEBOUNCE)
+
+                self.attributes["full_sync_interval"] = performance.get(FULL_SYNC_INTERVAL_CFG_KEY, DEFAULT_FULL_SYNC_INTERVAL)
+
+                self.attributes["upload_workers"] = performance.get(UPLOAD_WORKERS_CFG_KEY, DEFAULT_UPLOAD_WORKERS)
+
+                self.attributes["bulk_upload_min_files"] = performance.get(BULK_UPLOAD_MIN_FILES_CFG_KEY, DEFAULT_BULK_UPLOAD_MIN_FILES)
+
+                self.attributes["bulk_upload_max_file_size"] = performance.get(BULK_UPLOAD_MAX_FILE_SIZE_CFG_KEY, DEFAULT_BULK_UPLOAD_MAX_FILE_SIZE)
+
+                self.attributes["bulk_upload_compression"] = performance.get(BULK_UPLOAD_COMPRESSION_CFG_KEY, DEFAULT_BULK_UPLOAD_COMPRESSION)
+
+                # 0 disables delta transfers
+                self.attributes["delta_threshold"] = performance.get(DELTA_THRESHOLD_CFG_KEY, DEFAULT_DELTA_THRESHOLD)
+
+                self.attributes["local_hash_workers"] = performance.get(LOCAL_HASH_WORKERS_CFG_KEY, DEFAULT_LOCAL_HASH_WORKERS)
 
-                self.attributes["ssh_user"] = init_json[SSH_CONNECTION_CFG_GROUP][USER_CFG_KEY]
+                self.attributes["local_hash_executor"] = performance.get(LOCAL_HASH_EXECUTOR_CFG_KEY, DEFAULT_LOCAL_HASH_EXECUTOR)
 
-                deployment_local = init_json[DEPLOYMENT_CFG_GROUP][LOCAL_REPO_PATH_CFG_KEY]
-                self.attributes["deployment_local"] = os.path.abspath(deployment_local) + "/"
+                self.attributes["compare_mode"] = performance.get(COMPARE_MODE_CFG_KEY, DEFAULT_COMPARE_MODE)
 
-                deployment_server = init_json[DEPLOYMENT_CFG_GROUP][SERVER_REPO_PATH_CFG_KEY]
-                self.attributes["deployment_server"] = os.path.abspath(deployment_server) + "/"
+                # 0 disables the verification sweeps of the metadata compare mode
+                self.attributes["verify_interval"] = performance.get(VERIFY_INTERVAL_CFG_KEY, DEFAULT_VERIFY_INTERVAL)
 
-                ignore_files = init_json[DEPLOYMENT_CFG_GROUP][IGNORED_FILES_CFG_KEY]
-                self.attributes["ignore_files"] = [os.path.abspath(self.attributes["deployment_local"] + "/" + ignore_file) for ignore_file in ignore_files]
+                self.attributes["server_snapshot"] = performance.get(SERVER_SNAPSHOT_CFG_KEY, DEFAULT_SERVER_SNAPSHOT)
 
-                self.attributes["do_not_delete"] = init_json[DEPLOYMENT_CFG_GROUP][DO_NOT_DELETE_CFG_KEY]
+                self.attributes["remote_agent"] = performance.get(REMOTE_AGENT_CFG_KEY, DEFAULT_REMOTE_AGENT)
+
+                self.attributes["connect_timeout"] = performance.get(CONNECT_TIMEOUT_CFG_KEY, DEFAULT_CONNECT_TIMEOUT)
+
+                # How long a cycle waits for the slowest targets, the others are left syncing in the background
+                self.attributes["slow_target_timeout"] = performance.get(SLOW_TARGET_TIMEOUT_CFG_KEY, DEFAULT_SLOW_TARGET_TIMEOUT)
+
+                # "auto" picks the fastest algorithm supported by every server of a deployment
+                self.attributes["hash_algorithm"] = performance.get(HASH_ALGORITHM_CFG_KEY, DEFAULT_HASH_ALGORITHM)
+
+                # Files larger than three samples are hashed from samples of their content, 0 hashes whole files
+                self.attributes["hash_sample_size"] = performance.get(HASH_SAMPLE_SIZE_CFG_KEY, DEFAULT_HASH_SAMPLE_SIZE)
+
+                # New files at least this large are uploaded in chunks written in parallel, and resumed after a
+                # failure, 0 uploads every file in a single stream
+                self.attributes["chunked_upload_threshold"] = performance.get(CHUNKED_UPLOAD_THRESHOLD_CFG_KEY, DEFAULT_CHUNKED_UPLOAD_THRESHOLD)
+
+                self.attributes["upload_chunk_size"] = performance.get(UPLOAD_CHUNK_SIZE_CFG_KEY, DEFAULT_UPLOAD_CHUNK_SIZE)
+
+                # Without a watcher, the delay between two polls of an unchanged repo doubles from the Loop Delay up to
+                # this one, a value not above the Loop Delay polls at a fixed interval
+                self.attributes["max_idle_loop_delay"] = performance.get(MAX_IDLE_LOOP_DELAY_CFG_KEY, DEFAULT_MAX_IDLE_LOOP_DELAY)
+
+                # Bytes per second the uploads of every deployment share, 0 for no limit
+                self.attributes["bandwidth_limit"] = performance.get(BANDWIDTH_LIMIT_CFG_KEY, DEFAULT_BANDWIDTH_LIMIT)
+
+                metrics = init_json.get(METRICS_CFG_GROUP, {})
+
+                # Contrary to the caches, the metrics files are relative to the working directory, "" disables them
+                self.attributes["metrics_json_lines_file"] = os.path.abspath(metrics[JSON_LINES_FILE_CFG_KEY]) if metrics.get(JSON_LINES_FILE_CFG_KEY) else None
+
+                self.attributes["metrics_prometheus_file"] = os.path.abspath(metrics[PROMETHEUS_FILE_CFG_KEY]) if metrics.get(PROMETHEUS_FILE_CFG_KEY) else None
+
+                # The number of the cycle to profile with cProfile, 0 disables profiling
+                self.attributes["profile_cycle"] = metrics.get(PROFILE_CYCLE_CFG_KEY, 0)
+
+                self.attributes["profile_file"] = os.path.abspath(metrics[PROFILE_FILE_CFG_KEY]) if metrics.get(PROFILE_FILE_CFG_KEY) else None
 
                 ret_val = True
 
@@ -98,12 +351,23 @@ class InitFileParser():
 
     def parse_cfg_from_init_json(self):
         """
-            Todo Please
+            This method reads the pause, shutdown and loop delay values of the "Config" group. It is called by every
+            iteration of the loop, so the init file is only read and validated again when its stat signature (mtime,
+            size, inode) changed since the last successful parse. The last valid values are kept while the file is not
+            valid, an editor may be writing it, and the file is read again by the next call.
+
+            :return: The pause, shutdown and loop delay values.
         """
 
-        pause_value = None
-        shutdown_value = None
-        loop_delay_value = None
+        try:
+            init_stat = os.stat(self.init_file_path)
+        except OSError as e:
+            print("!!! ERROR: An error occurred when reading init file [{}] !!!".format(e))
+            return self.cfg_values
+
+        signature = (init_stat.st_mtime_ns, init_stat.st_size, init_stat.st_ino)
+        if signature == self.cfg_signature:
+            return self.cfg_values
 
         try:
             init_json_file = open(self.init_file_path)
@@ -119,6 +383,9 @@ class InitFileParser():
 
                 loop_delay_value = init_json[CONFIG_CFG_GROUP][LOOP_DELAY_CFG_KEY]
 
+                self.cfg_values = (pause_value, shutdown_value, loop_delay_value)
+                self.cfg_signature = signature
+
             except SchemaError as e:
                 print("!!! ERROR: CFG file not correct format; Schema Error: [{}] !!!".format(e))
 
@@ -127,7 +394,72 @@ class InitFileParser():
         except Exception as e:
             print("!!! ERROR: An error occurred when parsing init file [{}] !!!".format(e))
 
-        return pause_value, shutdown_value, loop_delay_value
+        return self.cfg_values
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _parse_deployment(self, deployment_json, index, ssh_connection, performance):
+        """
+            This method parses an entry of the "Deployment" group.
+
+            :param dict deployment_json: The entry.
+            :param int index: Its index in the group, the cache files of the deployments after the first one are suffixed
+                              with it when their path is given by the init file.
+            :param ssh_connection: The top level "SSH Connection" group, used when the entry does not have its own.
+            :param dict performance: The "Performance" group.
+
+            :return: A dictionary of the settings of the deployment.
+        """
+
+        deployment_local = os.path.abspath(deployment_json[LOCAL_REPO_PATH_CFG_KEY]) + "/"
+        deployment_server = os.path.abspath(deployment_json[SERVER_REPO_PATH_CFG_KEY]) + "/"
+
+        # A single target or a list of them, the local repo is deployed to each one
+        ssh_connection = deployment_json.get(SSH_CONNECTION_CFG_GROUP, ssh_connection)
+        if ssh_connection is None:
+            raise SchemaError("No [{}] for the deployment of [{}]".format(SSH_CONNECTION_CFG_GROUP, deployment_local))
+
+        targets = []
+        for target in ssh_connection if isinstance(ssh_connection, list) else [ssh_connection]:
+            target_server = target.get(SERVER_REPO_PATH_CFG_KEY)
+            targets.append({
+                "host": target[HOST_CFG_KEY],
+                "user": target[USER_CFG_KEY],
+                "port": target.get(PORT_CFG_KEY, DEFAULT_PORT),
+                # None uses the system known hosts (~/.ssh/known_hosts)
+                "known_hosts_file": target.get(KNOWN_HOSTS_FILE_CFG_KEY) or None,
+                "deployment_server": os.path.abspath(target_server) + "/" if target_server else deployment_server
+            })
+
+        # The cache paths are relative to the local repo, None lets the caches pick their XDG location
+        cache_paths = []
+        for cache_path in (performance.get(HASH_CACHE_PATH_CFG_KEY), performance.get(SERVER_SNAPSHOT_PATH_CFG_KEY)):
+            if cache_path:
+                cache_path = os.path.abspath(os.path.join(deployment_local, cache_path))
+                if index:
+                    cache_root, cache_extension = os.path.splitext(cache_path)
+                    cache_path = "{}_{}{}".format(cache_root, index, cache_extension)
+            cache_paths.append(cache_path)
+
+        # The cache files inside the local repo, and the temporary files they are saved through, are never deployed.
+        # They come last so that no pattern of the init file includes them again
+        ignored_files = list(deployment_json[IGNORED_FILES_CFG_KEY])
+        for cache_path in cache_paths:
+            if cache_path and cache_path.startswith(deployment_local):
+                cache_pattern = "/" + escape_pattern(cache_path[len(deployment_local):])
+                ignored_files += [cache_pattern, cache_pattern + ".tmp"]
+
+        return {
+            "name": deployment_json.get(NAME_CFG_KEY) or deployment_local,
+            "deployment_local": deployment_local,
+            "deployment_server": deployment_server,
+            # Both are lists of .gitignore style patterns, relative to the local repo and to the server repo
+            "ignore_files": IgnoreMatcher(ignored_files),
+            "do_not_delete": IgnoreMatcher(deployment_json[DO_NOT_DELETE_CFG_KEY]),
+            "targets": targets,
+            "hash_cache_path": cache_paths[0],
+            "server_snapshot_path": cache_paths[1]
+        }
 
     def __getattr__(self, item):
         ret_val = None
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the metrics used by the ssh_deployer to tell where the time of a sync cycle goes. Each cycle
+    records the duration of its phases (local scan, server scan, diff, uploads, deletes...), the calls and duration of
+    the ssh_agent operations, and counters such as the bytes uploaded or the files hashed. At the end of a cycle its
+    record is appended to a JSON lines file, and the totals since the start of the deployer are written to a Prometheus
+    textfile, to be picked up by the node_exporter textfile collector.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+METRICS_PREFIX = "ssh_deployer"
+
+
+class Metrics():
+    """
+        This is the metrics class. Recording is thread safe, the ssh_agent workers update the counters concurrently.
+        Without a json_lines_file nor a prometheus_file, the metrics are only kept in memory.
+    """
+    def __init__(self, json_lines_file=None, prometheus_file=None):
+
+        self.json_lines_file = json_lines_file
+        self.prometheus_file = prometheus_file
+
+        self.lock = threading.Lock()
+
+        self.cycles = 0
+        self.cycle_start = None
+
+        # Metrics of the current cycle
+        self.phases = {}
+        self.operations = {}
+        self.counters = {}
+        self.gauges = {}
+
+        # Totals since the start of the deployer
+        self.total_seconds = 0.0
+        self.total_phases = {}
+        self.total_operations = {}
+        self.total_counters = {}
+
+    def start_cycle(self):
+        """
+            This method starts recording a new cycle.
+        """
+
+        with self.lock:
+            self.cycles += 1
+            self.cycle_start = time.monotonic()
+            self.phases = {}
+            self.operations = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def end_cycle(self, **fields):
+        """
+            This method ends the current cycle, adds it to the totals and exports it.
+
+            :param fields: Extra fields added to the record of the cycle.
+
+            :return: The record of the cycle.
+        """
+
+        with self.lock:
+            duration = time.monotonic() - self.cycle_start if self.cycle_start is not None else 0.0
+            self.cycle_start = None
+
+            self.total_seconds += duration
+            _add_to(self.total_phases, self.phases)
+            for name, (calls, seconds) in self.operations.items():
+                total = self.total_operations.setdefault(name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+            _add_to(self.total_counters, self.counters)
+
+            record = dict(fields)
+            record.update({
+                "cycle": self.cycles,
+                "time": time.time(),
+                "seconds": duration,
+                "phases": dict(self.phases),
+                "operations": {name: {"calls": calls, "seconds": seconds}
+                               for name, (calls, seconds) in self.operations.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges)
+            })
+
+        if self.json_lines_file:
+            self._append_json_line(record)
+
+        if self.prometheus_file:
+            self._write_prometheus_file(record)
+
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+            This context manager records the duration of a phase of the current cycle.
+
+            with metrics.phase("local_scan"):
+                ...
+        """
+
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """
+            This context manager records a call of an operation, and its duration, in the current cycle.
+        """
+
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self.lock:
+                operation = self.operations.setdefault(name, [0, 0.0])
+                operation[0] += 1
+                operation[1] += elapsed
+
+    def add(self, name, value=1):
+        """
+            This method adds to a counter of the current cycle.
+
+            :param str name: The name of the counter.
+            :param int value: The amount to add.
+        """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+            This method sets a gauge, a value that is exported as is instead of being summed over the cycles.
+
+            :param str name: The name of the gauge.
+            :param float value: The value of the gauge.
+        """
+
+        with self.lock:
+            self.gauges[name] = value
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _append_json_line(self, record):
+
+        try:
+            with open(self.json_lines_file, "a") as json_lines_file:
+                json_lines_file.write(json.dumps(record) + "\n")
+
+        except Exception as e:
+            print("!!! ERROR: Could not write metrics to [{}]: [{}] !!!".format(self.json_lines_file, e))
+
+    def _write_prometheus_file(self, record):
+
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(METRICS_PREFIX, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(METRICS_PREFIX, name, metric_type))
+            for labels, value in samples:
+                lines.append("{}_{}{} {}".format(METRICS_PREFIX, name, labels, _format_value(value)))
+
+        with self.lock:
+            metric("cycles_total", "counter", "Sync cycles run.", [("", self.cycles)])
+            metric("cycle_seconds_total", "counter", "Time spent in sync cycles.", [("", self.total_seconds)])
+            metric("last_cycle_seconds", "gauge", "Duration of the last sync cycle.", [("", record["seconds"])])
+            metric("last_cycle_timestamp_seconds", "gauge", "End time of the last sync cycle.", [("", record["time"])])
+            metric("phase_seconds_total", "counter", "Time spent in each phase of the sync cycles.",
+                   [('{{phase="{}"}}'.format(name), seconds) for name, seconds in sorted(self.total_phases.items())])
+            metric("last_cycle_phase_seconds", "gauge", "Time spent in each phase of the last sync cycle.",
+                   [('{{phase="{}"}}'.format(name), seconds) for name, seconds in sorted(record["phases"].items())])
+            metric("operation_calls_total", "counter", "Calls of each ssh_agent operation.",
+                   [('{{operation="{}"}}'.format(name), calls)
+                    for name, (calls, _) in sorted(self.total_operations.items())])
+            metric("operation_seconds_total", "counter", "Time spent in each ssh_agent operation.",
+                   [('{{operation="{}"}}'.format(name), seconds)
+                    for name, (_, seconds) in sorted(self.total_operations.items())])
+            for name, value in sorted(self.total_counters.items()):
+                metric("{}_total".format(name), "counter", "Total {}.".format(name.replace("_", " ")), [("", value)])
+            for name, value in sorted(record["gauges"].items()):
+                metric(name, "gauge", "Value of {} in the last sync cycle.".format(name.replace("_", " ")), [("", value)])
+
+        try:
+            # Written to a temporary file and renamed so that the collector never reads a partial file
+            tmp_path = "{}.tmp".format(self.prometheus_file)
+            with open(tmp_path, "w") as prometheus_file:
+                prometheus_file.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.prometheus_file)
+
+        except Exception as e:
+            print("!!! ERROR: Could not write metrics to [{}]: [{}] !!!".format(self.prometheus_file, e))
+
+
+def timed_operation(method):
+    """
+        This decorator records the calls of a method as an operation of the metrics held by its object.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _add_to(totals, values):
+
+    for name, value in values.items():
+        totals[name] = totals.get(name, 0) + value
+
+
+def _format_value(value):
+
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the remote_agent used by the ssh_agent to run its small server operations without opening an
+    SSH channel for each of them. A stdlib only python helper, REMOTE_AGENT_SCRIPT, is started on the server with
+    python3 -c and kept running for the life of the connection. Requests and responses are exchanged over its stdin and
+    stdout as length prefixed frames, and are pipelined: any number of requests can be in flight, each response carries
+    the id of its request.
+
+    A frame is a header, packed as FRAME_HEADER (length of the body, request id, operation or status), followed by the
+    body. Paths and path lists are sent as raw bytes, NUL separated, the other arguments as JSON.
+"""
+
+import json
+import shlex
+import struct
+import threading
+from concurrent.futures import Future
+
+from ssh_deployer.hash_engine.hash_engine import DEFAULT_HASH_ENGINE, HASH_ALGORITHMS
+from ssh_deployer.metrics.metrics import Metrics
+
+FRAME_HEADER = struct.Struct(">IIB")
+PUT_HEADER = struct.Struct(">H")
+
+PROTOCOL_VERSION = 3
+HELLO = "ssh_deployer_agent {}".format(PROTOCOL_VERSION).encode()
+
+OPERATION_MANIFEST = 1
+OPERATION_HASH = 2
+OPERATION_PUT = 3
+OPERATION_COPY = 4
+OPERATION_DELETE = 5
+OPERATION_MKDIR = 6
+OPERATION_UTIME = 7
+OPERATION_CAPABILITIES = 8
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# Files up to this size are uploaded through the agent in a single frame, larger ones are streamed over SFTP
+MAX_PUT_SIZE = 8 * 1024 * 1024
+
+# Seconds to wait for the agent to start
+START_TIMEOUT = 30
+
+REMOTE_AGENT_SCRIPT = r'''
+import hashlib, json, os, re, shutil, stat, struct, sys, uuid
+from concurrent.futures import ThreadPoolExecutor
+HEADER = struct.Struct(">IIB")
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+def reply(request_id, status, body):
+    stdout.write(HEADER.pack(len(body), request_id, status) + body)
+    stdout.flush()
+def paths(body):
+    return [path for path in body.split(b"\0") if path]
+def hash_file(path, engine):
+    h, sample = hashlib.new(engine["name"], **engine["arguments"]), engine["sample"]
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if sample and size > 3 * sample:
+                h.update(str(size).encode())
+                for offset in (0, (size - sample) // 2, size - sample):
+                    f.seek(offset)
+                    h.update(f.read(sample))
+            else:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest().encode()
+def hash_files(body):
+    size = struct.unpack(">H", body[:2])[0]
+    engine = json.loads(body[2:2 + size])
+    return b"\0".join(digest + b"  " + path for path, digest in
+                      ((path, hash_file(path, engine)) for path in paths(body[2 + size:])) if digest is not None)
+def capabilities(algorithms):
+    supported = ["sampled"]
+    for algorithm, (name, arguments) in algorithms.items():
+        try:
+            hashlib.new(name, **arguments)
+            supported.append(algorithm)
+        except (ValueError, TypeError):
+            pass
+    return json.dumps(supported).encode()
+def manifest(args):
+    root = os.fsencode(args["root"])
+    rules = [(re.compile(regex, re.DOTALL), negate, dir_only) for regex, negate, dir_only in args["rules"]]
+    def ignored(path, is_dir):
+        for regex, negate, dir_only in reversed(rules):
+            if (is_dir or not dir_only) and regex.match(os.fsdecode(path)):
+                return not negate
+        return False
+    records, files = [], []
+    for directory, directories, names in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        prefix = b"" if relative == b"." else relative + b"/"
+        records.extend(b"I " + prefix + name for name in directories if ignored(prefix + name, True))
+        directories[:] = [name for name in directories
+                          if not os.path.islink(os.path.join(directory, name)) and not ignored(prefix + name, True)]
+        records.extend(b"D " + prefix + name for name in directories)
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if ignored(prefix + name, stat.S_ISDIR(st.st_mode)):
+                records.append(b"I " + prefix + name)
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if args["mode"] == "metadata":
+                records.append(b"M %d %f " % (st.st_size, st.st_mtime) + prefix + name)
+            else:
+                files.append((prefix + name, path))
+    with ThreadPoolExecutor(max_workers=max(1, args["workers"])) as pool:
+        for (name, _), digest in zip(files, pool.map(lambda path: hash_file(path, args["hash"]), [path for _, path in files])):
+            if digest is not None:
+                records.append(digest + b"  " + name)
+    return b"\0".join(records)
+def put(body):
+    size = struct.unpack(">H", body[:2])[0]
+    args = json.loads(body[2:2 + size])
+    path = os.fsencode(args["path"])
+    directory, name = os.path.split(path)
+    os.makedirs(directory or b".", exist_ok=True)
+    tmp_path = os.path.join(directory, b"." + name + b"." + uuid.uuid4().hex[:8].encode() + b".ssh_deployer_tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(body[2 + size:])
+        if args["mtime"] is not None:
+            os.utime(tmp_path, (args["mtime"], args["mtime"]))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return b""
+def delete(body):
+    errors = []
+    def failed(path, error):
+        if not isinstance(error, FileNotFoundError):
+            errors.append("cannot remove {}: {}".format(os.fsdecode(path), error.strerror or error))
+    if sys.version_info >= (3, 12):
+        handler = {"onexc": lambda function, path, error: failed(path, error)}
+    else:
+        handler = {"onerror": lambda function, path, exc_info: failed(path, exc_info[1])}
+    for path in paths(body):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, **handler)
+        else:
+            try:
+                os.remove(path)
+            except OSError as e:
+                failed(path, e)
+    if errors:
+        raise OSError("; ".join(errors))
+    return b""
+def mkdir(body):
+    for path in paths(body):
+        os.makedirs(path, exist_ok=True)
+    return b""
+def utime(args):
+    failed = []
+    for path, mtime in args:
+        try:
+            os.utime(path, (mtime, mtime))
+        except OSError:
+            failed.append(path)
+    return json.dumps(failed).encode()
+def copy(args):
+    failed = []
+    for operation, source, destination, mtime in args:
+        directory, name = os.path.split(destination)
+        tmp_path = os.path.join(directory, "." + name + "." + uuid.uuid4().hex[:8] + ".ssh_deployer_tmp")
+        try:
+            os.makedirs(directory or ".", exist_ok=True)
+            if operation == "mv":
+                os.replace(source, destination)
+            else:
+                shutil.copyfile(source, tmp_path)
+                os.replace(tmp_path, destination)
+            if mtime is not None:
+                os.utime(destination, (mtime, mtime))
+        except OSError:
+            failed.append(destination)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return json.dumps(failed).encode()
+OPERATIONS = {
+    1: lambda body: manifest(json.loads(body)),
+    2: hash_files,
+    3: put,
+    4: lambda body: copy(json.loads(body)),
+    5: delete,
+    6: mkdir,
+    7: lambda body: utime(json.loads(body)),
+    8: lambda body: capabilities(json.loads(body)),
+}
+reply(0, 0, b"ssh_deployer_agent 3")
+while True:
+    header = stdin.read(HEADER.size)
+    if len(header) < HEADER.size:
+        break
+    length, request_id, operation = HEADER.unpack(header)
+    body = stdin.read(length)
+    try:
+        reply(request_id, 0, OPERATIONS[operation](body))
+    except Exception as e:
+        reply(request_id, 1, "{}: {}".format(type(e).__name__, e).encode(errors="replace"))
+'''
+
+
+class RemoteAgentError(IOError):
+    """
+        Raised when a request to the remote agent failed, or when the agent is not running.
+    """
+
+
+class RemoteAgent():
+    """
+        This is the remote agent class. It starts REMOTE_AGENT_SCRIPT over an SSH connection and sends it requests.
+        Requests can be sent from several threads at once, each one gets a Future of its response.
+    """
+    def __init__(self, ssh, verbose=False, metrics=None):
+
+        self.ssh = ssh
+        self.verbose = verbose
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # The streams of the agent are kept, closing its stdin would stop it
+        self.streams = None
+        self.channel = None
+        self.running = False
+
+        # The reader thread never takes send_lock: a large request sent while the agent waits for its large response to
+        # be read would otherwise block the agent, the reader and the sender on each other
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.next_request_id = 1
+
+    def start(self):
+        """
+            This method starts the agent on the server and waits for its greeting.
+
+            :return: T/F based on if the agent is running.
+        """
+
+        if self.verbose: print("Starting remote agent")
+
+        try:
+            self.streams = self.ssh.exec_command("python3 -c {}".format(shlex.quote(REMOTE_AGENT_SCRIPT)))
+            self.metrics.add("ssh_commands")
+            self.channel = self.streams[1].channel
+            self.channel.settimeout(START_TIMEOUT)
+
+            length, request_id, status = FRAME_HEADER.unpack(self._read_exact(FRAME_HEADER.size))
+            greeting = self._read_exact(length)
+            if greeting != HELLO:
+                raise RemoteAgentError("unexpected greeting [{}]".format(greeting[:64]))
+
+            self.channel.settimeout(None)
+
+        except Exception as e:
+            print("!!! ERROR: Could not start the remote agent: [{}] !!!".format(e))
+            self.close()
+            return False
+
+        self.running = True
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+        if self.verbose: print("Remote agent started")
+
+        return True
+
+    def close(self):
+        """
+            This method stops the agent, closing its stdin makes it exit.
+        """
+
+        with self.send_lock:
+            with self.pending_lock:
+                self.running = False
+            if self.streams is not None:
+                for stream in self.streams:
+                    stream.close()
+                self.channel.close()
+                self.streams = None
+
+    def request(self, operation, body=b""):
+        """
+            This method sends a request to the agent without waiting for its response.
+
+            :param int operation: One of the OPERATION_* constants.
+            :param bytes body: The body of the request.
+
+            :return: A Future of the body of the response, it raises a RemoteAgentError if the request failed.
+        """
+
+        future = Future()
+
+        with self.send_lock:
+            with self.pending_lock:
+                if not self.running:
+                    raise RemoteAgentError("The remote agent is not running")
+
+                request_id = self.next_request_id
+                self.next_request_id += 1
+                self.pending[request_id] = future
+
+            try:
+                self.channel.sendall(FRAME_HEADER.pack(len(body), request_id, operation) + body)
+            except Exception as e:
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+                raise RemoteAgentError("Could not send request to the remote agent: [{}]".format(e))
+
+        self.metrics.add("remote_agent_requests")
+
+        return future
+
+    def call(self, operation, body=b""):
+        """
+            This method sends a request to the agent and waits for its response.
+
+            :return: The body of the response.
+        """
+
+        return self.request(operation, body).result()
+
+    def manifest(self, root, rules, compare_mode="hash", workers=1, hash_engine=DEFAULT_HASH_ENGINE):
+        """
+            This method lists a server directory, in the record format of the ssh_agent manifest: "D <path>" for a
+            directory, "M <size> <mtime> <path>" for a file in the metadata compare mode, "<hash>  <path>" for a file
+            in the hash compare mode and "I <path>" for an element matching the rules, paths being relative to root.
+
+            :param list rules: The IgnoreRules of the elements to skip, the agent matches their compiled expressions.
+            :param HashEngine hash_engine: The engine the files are hashed with.
+
+            :return: The list of records.
+        """
+
+        body = json.dumps({"root": root, "rules": [(rule.regex.pattern, rule.negate, rule.dir_only) for rule in rules],
+                           "mode": compare_mode, "workers": workers, "hash": hash_engine.agent_arguments()})
+
+        return [record for record in self.call(OPERATION_MANIFEST, body.encode()).split(b"\0") if record]
+
+    def hash_files(self, server_files, hash_engine=DEFAULT_HASH_ENGINE):
+        """
+            This method hashes server files.
+
+            :param HashEngine hash_engine: The engine the files are hashed with.
+
+            :return: A dictionary mapping each server path to its hash, files that could not be hashed are missing.
+        """
+
+        header = json.dumps(hash_engine.agent_arguments()).encode()
+
+        ret_val = {}
+        for record in self.call(OPERATION_HASH, PUT_HEADER.pack(len(header)) + header + _join_paths(server_files)).split(b"\0"):
+            if record:
+                file_hash, path = record.split(b"  ", 1)
+                ret_val[path.decode(errors="surrogateescape")] = bytes.fromhex(file_hash.decode())
+
+        return ret_val
+
+    def hash_capabilities(self):
+        """
+            This method asks the agent which hash algorithms the python of the server supports.
+
+            :return: The set of the supported HASH_ALGORITHMS, along with SAMPLED_CAPABILITY.
+        """
+
+        algorithms = {algorithm: (name, arguments) for algorithm, (name, arguments, _) in HASH_ALGORITHMS.items()}
+
+        return set(json.loads(self.call(OPERATION_CAPABILITIES, json.dumps(algorithms).encode())))
+
+    def put(self, data, server_file, mtime=None):
+        """
+            This method writes a server file atomically, through a temporary file renamed over it. Its directory is
+            created if needed.
+
+            :param bytes data: The content of the file.
+            :param str server_file: The server path to the file.
+            :param float mtime: The modification time to give to the file, None to leave the current time.
+
+            :return: A Future of the response.
+        """
+
+        header = json.dumps({"path": server_file, "mtime": mtime}).encode()
+
+        return self.request(OPERATION_PUT, PUT_HEADER.pack(len(header)) + header + data)
+
+    def copy(self, operations):
+        """
+            This method copies or moves files within the server. The destination directories are created if needed, and
+            copies are written to a temporary file renamed over the destination.
+
+            :param list operations: A list of (operation, source, destination, mtime) tuples, operation being "cp" or
+                                    "mv", and mtime the modification time to give to the destination or None.
+
+            :return: The list of the destinations that could not be copied or moved.
+        """
+
+        return json.loads(self.call(OPERATION_COPY, json.dumps(list(operations)).encode()))
+
+    def delete(self, server_paths):
+        """
+            This method deletes server files and directories, like rm -rf. The paths that could not be deleted are
+            skipped, and reported in the RemoteAgentError raised after the others were deleted.
+        """
+
+        self.call(OPERATION_DELETE, _join_paths(server_paths))
+
+    def mkdirs(self, server_directories):
+        """
+            This method creates server directories along with their parents, like mkdir -p.
+        """
+
+        self.call(OPERATION_MKDIR, _join_paths(server_directories))
+
+    def utimes(self, server_files):
+        """
+            This method sets the modification time of server files.
+
+            :param list server_files: A list of (server_file, mtime) tuples.
+
+            :return: The list of the server files whose modification time could not be set.
+        """
+
+        return json.loads(self.call(OPERATION_UTIME, json.dumps(list(server_files)).encode()))
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _read_exact(self, size):
+
+        data = b""
+        while len(data) < size:
+            chunk = self.channel.recv(size - len(data))
+            if not chunk:
+                raise RemoteAgentError("The remote agent exited")
+            data += chunk
+
+        return data
+
+    def _read_responses(self):
+        """
+            This method runs in its own thread and hands each response to the Future of its request.
+        """
+
+        error = None
+        try:
+            while True:
+                length, request_id, status = FRAME_HEADER.unpack(self._read_exact(FRAME_HEADER.size))
+                body = self._read_exact(length)
+
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+
+                if future is None:
+                    continue
+                if status == STATUS_OK:
+                    future.set_result(body)
+                else:
+                    future.set_exception(RemoteAgentError(body.decode(errors="replace")))
+
+        except Exception as e:
+            error = e
+
+        with self.pending_lock:
+            if self.running:
+                print("!!! ERROR: The remote agent stopped: [{}] !!!".format(error))
+            self.running = False
+            pending, self.pending = self.pending, {}
+
+        for future in pending.values():
+            future.set_exception(RemoteAgentError("The remote agent stopped"))
+
+
+def _join_paths(paths):
+
+    return b"".join(path.encode(errors="surrogateescape") + b"\0" for path in paths)
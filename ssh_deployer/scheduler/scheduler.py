@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the scheduler used by the ssh_deployer to run the deployments of an init file in a single
+    loop. Each deployment keeps its own state and caches, the scheduler decides which ones run a sync cycle and waits
+    for the next one to be due: a timer for the deployments polling their repo, inotify events for the ones watching it.
+
+    The init file is watched as well, so that a change of its config (pause, shutdown...) wakes the loop up instead of
+    being noticed when the wait ends.
+"""
+
+import datetime
+import os
+import time
+
+from ssh_deployer.ignore_matcher.ignore_matcher import IgnoreMatcher, escape_pattern
+from ssh_deployer.watcher.watcher import InotifyWatcher, WatcherError, wait_for_watchers
+
+# Even when the init file is watched, it is checked this often, a network file system may not report its changes
+MAX_CONFIG_CHECK_DELAY = 60
+
+
+class Scheduler():
+    """
+        This is the Scheduler class. The due deployers run one cycle each, the one that has been waiting the longest
+        first, so that a busy deployment cannot starve the others.
+    """
+    def __init__(self, deployers, verbose=False, config_path=None):
+
+        self.deployers = list(deployers)
+        self.verbose = verbose
+
+        # Deployer -> time.monotonic() time it became due, for the ones waiting for their turn
+        self.due_since = {}
+
+        # Watches the directory of the init file for changes of the file only, None when it is not watched and the
+        # waits are bounded by the loop delay instead
+        self.config_watcher = None
+        if config_path is not None:
+            config_directory, config_name = os.path.split(os.path.abspath(config_path))
+            try:
+                self.config_watcher = InotifyWatcher(config_directory, IgnoreMatcher(["*", "!/" + escape_pattern(config_name)]))
+            except WatcherError as e:
+                print("!!! ERROR: The init file will be checked every loop delay: [{}] !!!".format(e))
+
+        # Ends the current wait when wake() is called, from a signal handler for instance
+        self.wakeup = WakeupPipe()
+
+    def loop_print(self, msg):
+
+        if self.verbose:
+            current_time = datetime.datetime.now()
+            current_timestamp = current_time.strftime("%Y/%m/%d/%H/%M/%S")
+            print(f"{current_timestamp}: {msg}")
+
+    def run_due_cycles(self, loop_delay):
+        """
+            This method runs a sync cycle of every deployer that is due.
+
+            :param int loop_delay: The amount of seconds between two cycles of the polling mode.
+
+            :return: The metrics records of the cycles.
+        """
+
+        ret_val = []
+
+        now = time.monotonic()
+        for deployer in self.deployers:
+            next_cycle_time = deployer.get_next_cycle_time(loop_delay)
+            if next_cycle_time <= now:
+                self.due_since.setdefault(deployer, next_cycle_time)
+
+        for deployer in sorted(self.due_since, key=self.due_since.get):
+            if len(self.deployers) > 1:
+                self.loop_print(f"Syncing {deployer.name}")
+            ret_val.append(deployer.run_cycle())
+            del self.due_since[deployer]
+
+        return ret_val
+
+    def wait(self, loop_delay, debounce):
+        """
+            This method waits until the next deployer is due, and gives the changes of the watched repos to their
+            deployers. The wait ends early when the init file changes or wake() is called. It lasts at most loop_delay
+            seconds when the init file is not watched, so that it is checked again, and while targets sync in the
+            background, so that their failures are retried.
+
+            :param int loop_delay: The amount of seconds between two cycles of the polling mode.
+            :param float debounce: The amount of quiet seconds that ends a burst of events.
+        """
+
+        max_delay = MAX_CONFIG_CHECK_DELAY
+        if self.config_watcher is None or any(deployer.busy() for deployer in self.deployers):
+            max_delay = loop_delay
+
+        deadline = min([deployer.get_next_cycle_time(loop_delay) for deployer in self.deployers] +
+                       [time.monotonic() + max_delay])
+
+        self.loop_print(f"Waiting {max(deadline - time.monotonic(), 0):.1f}(s)")
+        self._wait_until(deadline, debounce)
+
+    def wait_for_config(self, loop_delay, debounce):
+        """
+            This method waits for the init file to change, while the deployer is paused.
+
+            :param int loop_delay: The maximum amount of seconds to wait when the init file is not watched.
+            :param float debounce: The amount of quiet seconds that ends a burst of events.
+        """
+
+        max_delay = MAX_CONFIG_CHECK_DELAY if self.config_watcher is not None else loop_delay
+
+        self._wait_until(time.monotonic() + max_delay, debounce, watch_repos=False)
+
+    def wake(self):
+        """
+            This method ends the current wait, or the next one. It is safe to call from a signal handler.
+        """
+
+        self.wakeup.wake()
+
+    def close(self):
+        """
+            This method closes every deployer and stops watching the init file.
+        """
+
+        for deployer in self.deployers:
+            deployer.close()
+
+        if self.config_watcher is not None:
+            self.config_watcher.close()
+
+        self.wakeup.close()
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _wait_until(self, deadline, debounce, watch_repos=True):
+        """
+            This method waits until the deadline, a change of the init file, a call to wake() or, with watch_repos,
+            changes in a watched repo.
+
+            :param float deadline: The time.monotonic() time the wait ends at.
+            :param float debounce: The amount of quiet seconds that ends a burst of events.
+            :param bool watch_repos: T/F based on if the changes of the repos end the wait.
+        """
+
+        watchers = {}
+        if watch_repos:
+            watchers = {deployer.watcher: deployer for deployer in self.deployers if deployer.watcher is not None}
+
+        waited = list(watchers) + [self.wakeup]
+        if self.config_watcher is not None:
+            waited.append(self.config_watcher)
+
+        while True:
+            ready = wait_for_watchers(waited, deadline - time.monotonic())
+            if not ready:
+                return
+
+            done = False
+            for watcher in ready:
+                if watcher is self.wakeup:
+                    watcher.drain()
+                    done = True
+                elif watcher is self.config_watcher:
+                    # The other files of its directory wake the watcher up as well, they are filtered out here
+                    if watcher.wait_for_changes(0, debounce):
+                        self.loop_print("Init file changed")
+                        done = True
+                else:
+                    watchers[watcher].dirty_paths.update(watcher.wait_for_changes(0, debounce))
+                    done = True
+
+            if done:
+                return
+
+
+class WakeupPipe():
+    """
+        This is the WakeupPipe class. It is a non blocking pipe that wait_for_watchers() waits on along with the
+        watchers, writing to it ends the wait.
+    """
+    def __init__(self):
+
+        self.fd, self.write_fd = os.pipe()
+        os.set_blocking(self.fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def wake(self):
+
+        try:
+            os.write(self.write_fd, b"\0")
+        except OSError:
+            # Full, the wait ends anyway, or already closed
+            pass
+
+    def drain(self):
+
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self.write_fd)
+            self.fd = -1
+            self.write_fd = -1
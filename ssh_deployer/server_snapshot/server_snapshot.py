@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the server_snapshot used by the ssh_deployer to avoid re-hashing every server file when it
+    starts. The hash, size and modification time of each server file are saved locally as they were after the last
+    sync. On startup, a stat-only listing of the server repo is compared with the snapshot and only the files whose size
+    or modification time changed are hashed again, so the first sync costs in proportion to what changed rather than to
+    the size of the repo.
+
+    The snapshot file is binary: a header holding the version, the server and the name of the hash engine, then one
+    record per file holding the lengths of its path and hash, its size and modification time, its raw hash and its path.
+"""
+
+import hashlib
+import os
+import struct
+
+from ssh_deployer.directory_tree.directory_tree import DirectoryTree, get_element, parse_metadata_value
+from ssh_deployer.hash_engine.hash_engine import DEFAULT_HASH_ENGINE
+
+SNAPSHOT_FILE_MAGIC = b"SSHDSNAP"
+SNAPSHOT_FILE_VERSION = 3
+
+# Magic, version, lengths of the server and of the hash engine name, then path length, size, mtime and hash length of
+# each file
+SNAPSHOT_HEADER = struct.Struct(">8sHHH")
+SNAPSHOT_RECORD = struct.Struct(">HQqB")
+
+
+def get_default_snapshot_path(host, username, repo_path):
+    """
+        This method returns the default location of the snapshot of a given server repo. The snapshot is stored in the
+        XDG cache directory ($XDG_CACHE_HOME or ~/.cache), next to the hash caches, and named after a hash of the server
+        and of the repo path.
+
+        :param str host: The host of the server.
+        :param str username: The user the deployer connects as.
+        :param str repo_path: The path to the server repo.
+
+        :return: The path to the snapshot file.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    repo_id = hashlib.sha1("{}@{}:{}".format(username, host, repo_path).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_home, "ssh_deployer", "server_snapshot_{}.bin".format(repo_id))
+
+
+class ServerSnapshot():
+    """
+        This is the server_snapshot class. It maps the path of a server file, relative to the server repo, to its size,
+        modification time and hash.
+    """
+    def __init__(self, host, username, repo_path, snapshot_path=None, verbose=False):
+
+        self.server = "{}@{}:{}".format(username, host, repo_path)
+        self.snapshot_path = snapshot_path if snapshot_path else get_default_snapshot_path(host, username, repo_path)
+        self.verbose = verbose
+
+        # path -> (size, mtime, raw hash)
+        self.entries = {}
+        # Name of the HashEngine the hashes were computed with
+        self.hash_engine = DEFAULT_HASH_ENGINE.name
+        self.dirty = False
+
+        self.reused = 0
+        self.rehashed = 0
+
+        self.load()
+
+    def set_hash_engine(self, hash_engine):
+        """
+            This method sets the engine the hashes are computed with, the snapshot is emptied if it was another one.
+
+            :param HashEngine hash_engine: The engine.
+        """
+
+        if hash_engine.name != self.hash_engine:
+            self.hash_engine = hash_engine.name
+            self.entries = {}
+            self.dirty = True
+
+    def reconcile(self, metadata_tree, hash_function):
+        """
+            This method builds the hash structure of the server repo from its metadata structure, reusing the hash of
+            every file whose size and modification time match the snapshot, and calling hash_function once for all the
+            other files. The snapshot is then updated with the result.
+
+            :param dict metadata_tree: The structure of the server repo built in the metadata compare mode.
+            :param hash_function: A function taking a list of paths relative to the repo and returning a dictionary
+                                  mapping them to their hash.
+
+            :return: The structure of the server repo, as built in the hash compare mode.
+        """
+
+        # (directory structure, element name, path, size, mtime) of every file that needs to be hashed
+        pending_files = []
+        self.reused = 0
+
+        ret_val = self._reconcile_directory(metadata_tree, "", pending_files)
+
+        hashes = hash_function([path for _, _, path, _, _ in pending_files]) if pending_files else {}
+
+        for directory_tree, element_name, path, size, mtime in pending_files:
+            file_hash = hashes.get(path)
+            if file_hash is None:
+                # The file disappeared since it was listed, it is left out like it would be from a regular scan
+                del directory_tree[element_name]
+                self.entries.pop(path, None)
+            else:
+                directory_tree[element_name] = file_hash
+                self.entries[path] = (size, mtime, file_hash)
+
+        self.rehashed = len(pending_files)
+
+        # Entries of files that are no longer on the server
+        for path in [path for path in self.entries if not isinstance(get_element(ret_val, path), bytes)]:
+            del self.entries[path]
+
+        self.dirty = True
+
+        return ret_val
+
+    def record(self, path, size, mtime, file_hash):
+        """
+            This method records the state of a server file after it was uploaded.
+
+            :param str path: The path of the file relative to the repo.
+            :param int size: The size of the file.
+            :param int mtime: The modification time of the file, in whole seconds.
+            :param bytes file_hash: The hash of the file.
+        """
+
+        self.entries[path] = (size, int(mtime), file_hash)
+        self.dirty = True
+
+    def forget(self, paths):
+        """
+            This method removes server files, and every file of server directories, from the snapshot. The paths are
+            removed together, in a single pass over the entries at most, as an upload forgets many of them at once.
+
+            :param iterable paths: The paths of the files and directories relative to the repo.
+        """
+
+        # The paths that are not files of the snapshot may be directories
+        directories = set()
+        for path in paths:
+            path = path.rstrip("/")
+            if self.entries.pop(path, None) is not None:
+                self.dirty = True
+            else:
+                directories.add(path)
+
+        if not directories or not self.entries:
+            return
+
+        for entry_path in [entry_path for entry_path in self.entries
+                           if any(parent in directories for parent in _parents(entry_path))]:
+            del self.entries[entry_path]
+            self.dirty = True
+
+    def check(self, hash_tree):
+        """
+            This method drops the entries that do not match a fresh hash structure of the server repo, for files that
+            were modified or deleted on the server by something else than the deployer.
+
+            :param dict hash_tree: The structure of the server repo built in the hash compare mode.
+        """
+
+        for path, (_, _, file_hash) in list(self.entries.items()):
+            if get_element(hash_tree, path) != file_hash:
+                del self.entries[path]
+                self.dirty = True
+
+    def load(self):
+        """
+            This method loads the snapshot from the snapshot file. A missing or unreadable snapshot file, or one written
+            by another version or for another server, results in an empty snapshot.
+        """
+
+        try:
+            with open(self.snapshot_path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+
+            magic, version, server_length, engine_length = SNAPSHOT_HEADER.unpack_from(data, 0)
+            offset = SNAPSHOT_HEADER.size + server_length
+            server = data[SNAPSHOT_HEADER.size:offset].decode(errors="surrogateescape")
+            hash_engine = data[offset:offset + engine_length].decode()
+            offset += engine_length
+
+            if magic == SNAPSHOT_FILE_MAGIC and version == SNAPSHOT_FILE_VERSION and server == self.server:
+                entries = {}
+                while offset < len(data):
+                    path_length, size, mtime, hash_length = SNAPSHOT_RECORD.unpack_from(data, offset)
+                    offset += SNAPSHOT_RECORD.size
+                    file_hash = data[offset:offset + hash_length]
+                    offset += hash_length
+                    path = data[offset:offset + path_length].decode(errors="surrogateescape")
+                    offset += path_length
+                    entries[path] = (size, mtime, file_hash)
+                self.entries = entries
+                self.hash_engine = hash_engine
+
+        except FileNotFoundError:
+            pass
+
+        except Exception as e:
+            print("!!! ERROR: Could not load server snapshot [{}]: [{}] !!!".format(self.snapshot_path, e))
+
+        if self.verbose: print("Loaded {} server snapshot entries from {}".format(len(self.entries), self.snapshot_path))
+
+    def save(self):
+        """
+            This method writes the snapshot to the snapshot file if it changed since it was loaded. The file is written
+            to a temporary path and renamed so that a crash never leaves a truncated snapshot behind.
+        """
+
+        if not self.dirty:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+
+            tmp_path = "{}.tmp".format(self.snapshot_path)
+            server = self.server.encode(errors="surrogateescape")
+            hash_engine = self.hash_engine.encode()
+            with open(tmp_path, "wb") as snapshot_file:
+                snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_FILE_MAGIC, SNAPSHOT_FILE_VERSION, len(server),
+                                                         len(hash_engine)) + server + hash_engine)
+                for path, (size, mtime, file_hash) in self.entries.items():
+                    encoded_path = path.encode(errors="surrogateescape")
+                    snapshot_file.write(SNAPSHOT_RECORD.pack(len(encoded_path), size, mtime, len(file_hash)) +
+                                        file_hash + encoded_path)
+            os.replace(tmp_path, self.snapshot_path)
+
+            self.dirty = False
+
+        except Exception as e:
+            print("!!! ERROR: Could not save server snapshot [{}]: [{}] !!!".format(self.snapshot_path, e))
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _reconcile_directory(self, metadata_tree, prefix, pending_files):
+
+        ret_val = DirectoryTree()
+        ret_val.protected = getattr(metadata_tree, "protected", False)
+
+        for element_name, value in metadata_tree.items():
+            path = prefix + element_name
+
+            if isinstance(value, dict):
+                ret_val[element_name] = self._reconcile_directory(value, path + "/", pending_files)
+                continue
+
+            size, mtime = parse_metadata_value(value)
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == size and entry[1] == mtime:
+                ret_val[element_name] = entry[2]
+                self.reused += 1
+            else:
+                ret_val[element_name] = None
+                pending_files.append((ret_val, element_name, path, size, mtime))
+
+        return ret_val
+
+
+def _parents(path):
+    """
+        This method yields the parent directories of a path relative to the repo, the closest first.
+    """
+
+    index = path.rfind("/")
+    while index > 0:
+        path = path[:index]
+        yield path
+        index = path.rfind("/")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the connection_pool used by the ssh_agent to share one authenticated SSH transport per server
+    between every deployment and target deployed to it. A connection carries the SFTP pool and the remote agent of the
+    server as well, so that deploying many repos to the same host costs one handshake and one set of channels instead
+    of one per repo, and stays within the number of sessions the server allows per connection.
+"""
+
+import threading
+
+import paramiko
+
+from ssh_deployer.remote_agent.remote_agent import RemoteAgent
+from ssh_deployer.ssh_agent.sftp_pool import SFTPPool, DEFAULT_POOL_SIZE
+
+
+class SSHConnection():
+    """
+        This is the SSHConnection class. It holds an authenticated SSH client, the pool of SFTP channels opened over it
+        and, when enabled, the remote agent running on the server.
+    """
+    def __init__(self, host, username, port=22, known_hosts_file=None, sftp_channels=DEFAULT_POOL_SIZE,
+                 connect_timeout=None, remote_agent=False, verbose=False, metrics=None):
+
+        self.host = host
+        self.username = username
+        self.port = port
+        self.known_hosts_file = known_hosts_file
+        self.verbose = verbose
+        self.metrics = metrics
+
+        # Number of ssh_agents using the connection, see ConnectionPool
+        self.users = 0
+
+        self.ssh = None
+        self.sftp_pool = None
+        self.remote_agent = None
+        # The hash algorithms the server supports, see SSHAgent.get_hash_capabilities()
+        self.hash_capabilities = None
+
+        if self.verbose: print("\nSSH Connecting to: Host-{}, Port-{}, Username-{}".format(host, port, username))
+        self.ssh = paramiko.SSHClient()
+        if known_hosts_file:
+            self.ssh.load_host_keys(known_hosts_file)
+        else:
+            self.ssh.load_system_host_keys()
+        self.ssh.connect(hostname=host, port=port, username=username, password="", timeout=connect_timeout,
+                         banner_timeout=connect_timeout, auth_timeout=connect_timeout)
+        if self.verbose: print("Connected")
+
+        # A first SFTP channel is opened to check that the server allows them
+        if self.verbose: print("\nSFTP Connecting")
+        self.sftp_pool = SFTPPool(self.ssh, size=sftp_channels, verbose=verbose, metrics=metrics)
+        with self.sftp_pool.client():
+            pass
+        if self.verbose: print("Connected")
+
+        # Long lived helper on the server running the small operations over a single channel, None when it is disabled
+        # or could not be started
+        if remote_agent:
+            self.remote_agent = RemoteAgent(self.ssh, verbose=verbose, metrics=metrics)
+            if not self.remote_agent.start():
+                self.remote_agent = None
+
+    def is_active(self):
+        """
+            :return: T/F based on if the SSH transport is still connected.
+        """
+
+        transport = self.ssh.get_transport() if self.ssh is not None else None
+
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """
+            This method stops the remote agent and closes the channels and the SSH connection.
+        """
+
+        if self.remote_agent is not None:
+            self.remote_agent.close()
+            self.remote_agent = None
+
+        if self.sftp_pool is not None:
+            if self.verbose: print("\nClosing SFTP Connections")
+            self.sftp_pool.close()
+            if self.verbose: print("Closed")
+
+        if self.ssh is not None:
+            if self.verbose: print("\nClosing SHH Connection")
+            self.ssh.close()
+            if self.verbose: print("Connection to {} closed.".format(self.host))
+
+
+class ConnectionPool():
+    """
+        This is the ConnectionPool class. Connections are keyed by host, port, user and known hosts file, opened by the
+        first ssh_agent that needs them and closed when the last one releases them. A connection that dropped is
+        replaced by the next acquire(), the ssh_agents still holding it fail and acquire the new one.
+    """
+    def __init__(self, verbose=False, metrics=None):
+
+        self.verbose = verbose
+        self.metrics = metrics
+
+        self.connections = {}
+        self.lock = threading.Lock()
+
+        # One lock per key, so that a slow or unreachable host does not hold back the connections to the others
+        self.key_locks = {}
+
+    def acquire(self, host, username, port=22, known_hosts_file=None, sftp_channels=DEFAULT_POOL_SIZE,
+                connect_timeout=None, remote_agent=False):
+        """
+            This method returns the connection to a server, opening it if there is none or if it dropped. The SFTP
+            channels and remote agent settings of the first caller are the ones used by the connection.
+
+            :return: The SSHConnection, to give back with release().
+        """
+
+        key = (host, port, username, known_hosts_file)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                connection = self.connections.get(key)
+                if connection is not None and connection.is_active():
+                    connection.users += 1
+                    return connection
+                self.connections.pop(key, None)
+
+            connection = SSHConnection(host, username, port=port, known_hosts_file=known_hosts_file,
+                                       sftp_channels=sftp_channels, connect_timeout=connect_timeout,
+                                       remote_agent=remote_agent, verbose=self.verbose, metrics=self.metrics)
+            if self.metrics is not None:
+                self.metrics.add("ssh_connections_opened")
+
+            with self.lock:
+                connection.users = 1
+                self.connections[key] = connection
+
+        return connection
+
+    def release(self, connection):
+        """
+            This method gives back a connection, it is closed once no ssh_agent uses it.
+
+            :param SSHConnection connection: The connection returned by acquire().
+        """
+
+        with self.lock:
+            connection.users -= 1
+            if connection.users > 0:
+                return
+            key = (connection.host, connection.port, connection.username, connection.known_hosts_file)
+            if self.connections.get(key) is connection:
+                del self.connections[key]
+
+        connection.close()
+
+    def close(self):
+        """
+            This method closes every connection of the pool.
+        """
+
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the sftp_pool used by the ssh_agent to share several SFTP channels between worker threads.
+    All the channels are opened over the single SSH transport of the agent, paramiko multiplexes them so that each worker
+    can have its own request in flight.
+"""
+
+import contextlib
+import queue
+import socket
+import threading
+
+import paramiko
+
+DEFAULT_POOL_SIZE = 4
+
+# Errors of the channel or of the transport under it, as opposed to the IOError statuses of SFTP requests that failed on
+# the server (no such file, permission denied...) which leave the channel usable
+CHANNEL_ERRORS = (EOFError, paramiko.SSHException, socket.timeout, ConnectionError)
+
+
+class SFTPPool():
+    """
+        This is the SFTP pool class. Channels are opened lazily, up to size of them, and handed out one worker at a time.
+    """
+    def __init__(self, ssh, size=DEFAULT_POOL_SIZE, verbose=False, metrics=None):
+
+        self.ssh = ssh
+        self.size = max(1, size)
+        self.verbose = verbose
+        self.metrics = metrics
+
+        self.idle = queue.LifoQueue()
+        self.clients = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+            This context manager hands out an SFTP client that is not used by any other worker, opening a new channel if
+            none is idle and the pool is not full, or waiting for one to be released otherwise. A client whose channel
+            failed is closed rather than released, and a new one is opened in its place when needed.
+
+            with pool.client() as sftp:
+                sftp.stat(path)
+        """
+
+        sftp = self._acquire()
+        try:
+            yield sftp
+        except BaseException as e:
+            if isinstance(e, CHANNEL_ERRORS) or _is_closed(sftp):
+                self._discard(sftp)
+            else:
+                self.idle.put(sftp)
+            raise
+        self.idle.put(sftp)
+
+    def close(self):
+        """
+            This method closes every channel of the pool.
+        """
+
+        with self.lock:
+            for sftp in self.clients:
+                sftp.close()
+            self.clients = []
+            self.idle = queue.LifoQueue()
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _acquire(self):
+
+        # The idle queue holds None for each discarded client, it wakes a waiting worker up to open a new channel
+        while True:
+            try:
+                sftp = self.idle.get_nowait()
+            except queue.Empty:
+                sftp = self._open()
+                if sftp is None:
+                    sftp = self.idle.get()
+
+            if sftp is not None:
+                return sftp
+
+    def _open(self):
+        """
+            This method opens a new channel if the pool is not full.
+
+            :return: The SFTP client of the channel, or None if the pool is full.
+        """
+
+        with self.lock:
+            if len(self.clients) >= self.size:
+                return None
+
+            if self.verbose: print("Opening SFTP channel {}/{}".format(len(self.clients) + 1, self.size))
+            try:
+                sftp = self.ssh.open_sftp()
+            except Exception:
+                # The workers waiting for a client try in turn, and fail as well if the connection is down
+                self.idle.put(None)
+                raise
+            self.clients.append(sftp)
+            if self.metrics is not None:
+                self.metrics.add("sftp_channels_opened")
+
+        return sftp
+
+    def _discard(self, sftp):
+
+        with self.lock:
+            if sftp in self.clients:
+                self.clients.remove(sftp)
+                self.idle.put(None)
+
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+
+def _is_closed(sftp):
+
+    channel = sftp.get_channel()
+
+    return channel is None or channel.closed
@@ -11,25 +11,110 @@
 import argparse
 import paramiko
 import os
+import shlex
 import stat
-import re
+import sys
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ssh_deployer.delta_transfer.delta_transfer import REMOTE_DELTA_SCRIPT, generate_delta, get_block_size, parse_signatures
+from ssh_deployer.directory_tree.directory_tree import DirectoryTree, get_metadata_value, set_protected
+from ssh_deployer.hash_engine.hash_engine import DEFAULT_HASH_ENGINE, HASH_ALGORITHMS, HashEngine
+from ssh_deployer.ignore_matcher.ignore_matcher import IgnoreMatcher
+from ssh_deployer.metrics.metrics import Metrics, timed_operation
+from ssh_deployer.remote_agent.remote_agent import MAX_PUT_SIZE, RemoteAgentError
+from ssh_deployer.ssh_agent.connection_pool import SSHConnection
+from ssh_deployer.ssh_agent.sftp_pool import DEFAULT_POOL_SIZE
+from ssh_deployer.transfer_queue.transfer_queue import ThrottledWriter, TransferQueue
+from ssh_deployer.upload_journal.upload_journal import UploadJournal, get_upload_journals
+
+DEFAULT_HASH_WORKERS = 4
+
+# Suffix of the temporary files uploads are written to before being renamed in place
+UPLOAD_TMP_SUFFIX = ".ssh_deployer_tmp"
+
+# Suffix of the files chunked uploads are written to, they are kept after a failure so that the upload can be resumed
+UPLOAD_PART_SUFFIX = ".ssh_deployer_part"
+
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_READ_SIZE = 1024 * 1024
+
+# The modification time of files modified this recently is not copied to the server, a change in the same second
+# would give a file with a different content but the same size and modification time. The server file gets the
+# RACY_MTIME sentinel instead, so that it never matches the local file in the metadata compare mode
+RACY_MTIME_WINDOW = 2
+RACY_MTIME = 0
+
+# Bulk upload compression -> (tarfile stream mode, remote tar option)
+TAR_COMPRESSIONS = {
+    "none": ("w|", ""),
+    "gzip": ("w|gz", "-z"),
+    "bz2": ("w|bz2", "-j"),
+    "xz": ("w|xz", "-J")
+}
+
+# Number of files given to each remote hash process by xargs
+MANIFEST_FILES_PER_HASH = 128
+MANIFEST_READ_SIZE = 65536
 
 class SSHAgent():
     """
         This is the ssh_agent class. It is used to send commands to a given server via ssh.
     """
-    def __init__(self, host, username, verbose=False):
+    def __init__(self, host, username, verbose=False, sftp_channels=DEFAULT_POOL_SIZE, delta_threshold=0, port=22,
+                 known_hosts_file=None, metrics=None, remote_agent=False, connect_timeout=None, connection_pool=None,
+                 chunked_upload_threshold=0, upload_chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE, journal_directory=None,
+                 bandwidth_limiter=None):
 
         self.host = host
         self.username = username
+        self.port = port
+        # Known hosts file to use instead of the system ones, None for the system ones
+        self.known_hosts_file = known_hosts_file
+        # Seconds to wait for the server to accept the connection, None to wait as long as the system does
+        self.connect_timeout = connect_timeout
         self.verbose = verbose
+        self.sftp_channels = sftp_channels
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Files at least this large are updated with a delta transfer, 0 disables delta transfers
+        self.delta_threshold = delta_threshold
+        # New files at least this large are uploaded in chunks of upload_chunk_size bytes written in parallel, 0 disables
+        # chunked uploads
+        self.chunked_upload_threshold = chunked_upload_threshold
+        self.upload_chunk_size = upload_chunk_size
+        # Directory of the journals of the chunked uploads in progress, None for the default one
+        self.journal_directory = journal_directory
+        # The engine chunked uploads are checked with, the one the server repo is hashed with
+        self.hash_engine = DEFAULT_HASH_ENGINE
+        # TokenBucket the uploaded bytes go through, None for no bandwidth limit
+        self.bandwidth_limiter = bandwidth_limiter
 
         self.local_host = os.uname()[1]
 
-        self.ssh = None
-        self._ssh_connect()
-        self.sftp = None
-        self._ssh_sftp_connect()
+        # With a connection pool, the connection to the server is shared with the other ssh_agents connected to it
+        self.connection_pool = connection_pool
+        self.connection = None
+        if connection_pool is not None:
+            self.connection = connection_pool.acquire(host, username, port=port, known_hosts_file=known_hosts_file,
+                                                      sftp_channels=sftp_channels, connect_timeout=connect_timeout,
+                                                      remote_agent=remote_agent)
+        else:
+            self.connection = SSHConnection(host, username, port=port, known_hosts_file=known_hosts_file,
+                                            sftp_channels=sftp_channels, connect_timeout=connect_timeout,
+                                            remote_agent=remote_agent, verbose=verbose, metrics=self.metrics)
+
+        self.ssh = self.connection.ssh
+        self.sftp_pool = self.connection.sftp_pool
+        # Long lived helper on the server running the small operations over a single channel, None when it is disabled
+        # or could not be started, the operations then run their own commands
+        self.remote_agent = self.connection.remote_agent
+
+        # Server directories known to exist, so that uploads do not need to check or create them
+        self.known_directories = set()
+        self.directories_lock = threading.Lock()
 
         # Will hold the three main file types on the ssh server.
         self.streams = {
@@ -42,83 +127,598 @@ class SSHAgent():
 
     def __del__(self):
 
-        # Closed connection with the SSH server
-        if self.verbose: print("\nClosing SHH Connection")
-        self.ssh.close()
-        if self.verbose: print("Connection to {} closed.".format(self.host))
+        # The connection may have failed before it was opened
+        if getattr(self, "connection", None) is None:
+            return
 
-        # Closes SFTP connection
-        if self.verbose: print("\nClosing SFTP Connection")
-        self.sftp.close()
-        if self.verbose: print("Closed")
+        if self.connection_pool is not None:
+            self.connection_pool.release(self.connection)
+        else:
+            self.connection.close()
 
-    def get_server_directory_structure(self, directory, do_not_delete):
+        self.connection = None
+
+    def get_server_directory_structure(self, directory, do_not_delete, compare_mode="hash", prefix="",
+                                       hash_engine=DEFAULT_HASH_ENGINE):
         """
             This method will use the sftp connection to list the server directory and populate a directory structure of the
             repo. The structure of the repo will be denoted by a dictionary with each key being the name of an element in
             the repo. The value to each element will either be an integer representing the file size of element, or a
             dictionary representing the directory of the element. Therefore checking the type of the value of a key in
             repo structure will let you know whether the element is either a directory or a file. If while going through the
-            repo, an element is a part of the ignored files list, it is skipped and will not appear in the returned structure.
+            repo, an element matches the do not delete patterns, it is skipped and will not appear in the returned structure.
 
             example_repo_structure = {
                 "foo": 42,
                 "bar": { ... }
             }
 
+            In the metadata compare mode, files are given the value of get_metadata_value() instead of their hash.
+
             :param str directory: The path to the server directory/repo.
+            :param IgnoreMatcher do_not_delete: The patterns of the elements that are skipped, along with their content.
+            :param str compare_mode: "hash" or "metadata".
+            :param str prefix: The path of directory relative to the repo followed by a "/", "" for the repo itself.
+            :param HashEngine hash_engine: The engine the files are hashed with, the files of a directory are hashed
+                                           with a single get_server_file_hashes() call.
 
             :return: The structure of the repo in type dictionary.
         """
 
-        ret_val = {}
+        ret_val = DirectoryTree()
+        files_to_hash = []
 
         # Iterate through all elements in the server repo
-        directory_scan = self.sftp.listdir_attr(directory)
+        with self.sftp_pool.client() as sftp:
+            directory_scan = sftp.listdir_attr(directory)
         for element in directory_scan:
 
-            element_name = element.filename
+            element_name = sys.intern(element.filename)
+
+            if do_not_delete.is_ignored(prefix + element_name, stat.S_ISDIR(element.st_mode)):
 
-            if element_name not in do_not_delete:
+                ret_val.protected = True
+
+            else:
 
                 # If the element is a directory we recursively call this method to get the structure of the directory
                 if stat.S_ISDIR(element.st_mode):
 
-                    ret_val[element_name] = self.get_server_directory_structure(directory="{}/{}".format(directory, element_name), do_not_delete=do_not_delete)
+                    ret_val[element_name] = self.get_server_directory_structure(directory="{}/{}".format(directory, element_name), do_not_delete=do_not_delete, compare_mode=compare_mode, prefix=prefix + element_name + "/", hash_engine=hash_engine)
+                    ret_val.protected = ret_val.protected or ret_val[element_name].protected
+
+                # In the metadata compare mode the listing already holds all we need for a file
+                elif stat.S_ISREG(element.st_mode) and compare_mode == "metadata":
 
-                # If the element is a file, we set the element's value to the file size
+                    ret_val[element_name] = get_metadata_value(element.st_size, element.st_mtime)
+
+                # If the element is a file, it is hashed along with the other files of the directory
                 elif stat.S_ISREG(element.st_mode):
 
-                    self._run_command(f"sha1sum {directory}/{element_name}", get_pty=True)
-                    ret_val[element_name] = self._extract_hash(self.streams["out"].readlines()[0])
+                    files_to_hash.append(element_name)
 
                 else:
 
                     print("!!! ERROR: Did not recognize [{}] element type in directory: [{}] !!!".format(element_name, directory))
 
+        # A file that disappeared since it was listed is left out
+        file_hashes = self.get_server_file_hashes(["{}/{}".format(directory, element_name) for element_name in files_to_hash], hash_engine)
+        for element_name in files_to_hash:
+            file_hash = file_hashes.get("{}/{}".format(directory, element_name))
+            if file_hash is not None:
+                ret_val[element_name] = file_hash
+
+        return ret_val
+
+    @timed_operation
+    def get_server_manifest(self, directory, do_not_delete, hash_workers=DEFAULT_HASH_WORKERS, compare_mode="hash",
+                            hash_engine=DEFAULT_HASH_ENGINE):
+        """
+            This method builds the same repo structure as get_server_directory_structure() but with a single remote
+            command instead of one listing and one hash command per directory. The server lists every directory and
+            hashes every regular file with find, xargs and the hash command of hash_engine (sha1sum, b2sum...) running
+            hash_workers processes in parallel. The NUL separated output is parsed as it is streamed back.
+
+            The command needs GNU find, coreutils and flock on the server. If it fails, an error is printed and None is returned
+            so that the caller can fall back on get_server_directory_structure().
+
+            In the metadata compare mode, nothing is hashed and find prints the size and modification time of each file.
+
+            With the remote agent, the manifest is built by the agent instead of a find command.
+
+            :param str directory: The path to the server directory/repo.
+            :param IgnoreMatcher do_not_delete: The patterns of the elements that are skipped, along with their content.
+                                                find prunes the ones it can match exactly (see _get_find_prune()), the
+                                                others are removed from the structure once it is built.
+            :param int hash_workers: Number of hash processes to run in parallel on the server.
+            :param str compare_mode: "hash" or "metadata".
+            :param HashEngine hash_engine: The engine the files are hashed with.
+
+            :return: The structure of the repo in type dictionary, or None if the manifest could not be built.
+        """
+
+        if self.verbose: print("Building manifest of {}".format(directory))
+
+        if self._agent_available():
+            try:
+                records = self.remote_agent.manifest(directory, do_not_delete.rules, compare_mode, hash_workers, hash_engine)
+            except RemoteAgentError as e:
+                print("!!! ERROR: Remote agent manifest of [{}] failed: [{}] !!!".format(directory, e))
+            else:
+                ret_val = DirectoryTree()
+                for record in records:
+                    self._add_manifest_record(ret_val, record)
+                if compare_mode == "hash":
+                    self.metrics.add("server_files_hashed", _count_files(ret_val))
+                return ret_val
+
+        server_command = hash_engine.server_command()
+        if server_command is None and compare_mode == "hash":
+            print("!!! ERROR: The server has no command to hash with [{}] !!!".format(hash_engine.name))
+            return None
+
+        prune, exact_prune = _get_find_prune(do_not_delete)
+        # The pruned elements are listed by the first find, so that their directories are not deleted
+        listed_prune = prune.replace("-prune -o", "-prune -printf 'I %P\\0' -o")
+
+        # Parallel hash processes would interleave their output in the middle of records, so each batch is hashed into
+        # a temporary file that is then written out while holding a lock
+        hash_command = "{} -z --".format(server_command)
+        if hash_workers > 1:
+            hash_command = ("sh -c 't=$(mktemp) || exit 1; {} -z -- \"$@\" > \"$t\"; s=$?; "
+                            "flock \"$0\" cat \"$t\"; rm -f \"$t\"; exit $s' \"$L\"").format(server_command)
+
+        command = ("cd {directory} && L=$(mktemp) && {{ "
+                   "find . -mindepth 1 {listed_prune} -type d -printf 'D %P\\0' && "
+                   "find . -mindepth 1 {prune} -type f -printf '%P\\0' | "
+                   "xargs -0 -r -P {workers} -n {per_hash} {hash_command}; "
+                   "s=$?; rm -f \"$L\"; exit $s; }}").format(directory=shlex.quote(directory),
+                                                          listed_prune=listed_prune,
+                                                          prune=prune,
+                                                          workers=hash_workers,
+                                                          per_hash=MANIFEST_FILES_PER_HASH,
+                                                          hash_command=hash_command)
+
+        if compare_mode == "metadata":
+            command = ("cd {directory} && "
+                       "find . -mindepth 1 {prune} -type d -printf 'D %P\\0' -o "
+                       "-type f -printf 'M %s %T@ %P\\0'").format(directory=shlex.quote(directory), prune=listed_prune)
+
+        stdin, stdout, stderr = self.ssh.exec_command(command)
+        self.metrics.add("ssh_commands")
+        channel = stdout.channel
+
+        ret_val = DirectoryTree()
+
+        # Records are NUL terminated, the last element of a split is the start of a record that is not complete yet
+        pending = b""
+        for chunk in iter(lambda: channel.recv(MANIFEST_READ_SIZE), b""):
+            records = (pending + chunk).split(b"\0")
+            pending = records.pop()
+            for record in records:
+                self._add_manifest_record(ret_val, record)
+
+        exit_status = channel.recv_exit_status()
+        if compare_mode == "hash":
+            self.metrics.add("server_files_hashed", _count_files(ret_val))
+        if not exact_prune:
+            _remove_ignored(ret_val, do_not_delete)
+        if exit_status != 0:
+            print("!!! ERROR: Manifest of [{}] failed with status [{}]: [{}] !!!".format(directory, exit_status, stderr.read().decode(errors="replace").strip()))
+            ret_val = None
+
         return ret_val
 
     def copy_file_to_server(self, local_file, server_path):
         """
             This method will use the put() method to copy a file over to the ssh server from the local machine.
 
+            The file is written to a temporary name inside server_path and then renamed over the destination, so the
+            destination is replaced atomically and is never seen half written. Only SFTP requests are used, the server
+            directory is created first if it is not known to exist (see ensure_server_directories()).
+
+            Files of at least delta_threshold bytes that already exist on the server are first tried with a delta
+            transfer (see _copy_file_to_server_delta()), which only sends the parts of the file that changed. The other
+            files of at least chunked_upload_threshold bytes are uploaded in chunks (see _copy_file_to_server_chunked()).
+
+            With the remote agent, files of up to MAX_PUT_SIZE bytes are sent to the agent in a single request instead,
+            it writes and renames them the same way.
+
+            This method is thread safe, each call uses its own SFTP channel from the pool. An IOError is raised if the
+            file could not be copied.
+
             :param str local_file: The local path to the file that needs to be copied.
             :param str server_path: The server path to the local to copy the local file.
+        """
+
+        if self.verbose: print("Copying {} to {}/".format(local_file, server_path))
+
+        if server_path not in self.known_directories:
+            self.ensure_server_directories([server_path])
+
+        # The temporary name is unique so that concurrent uploads of the same file do not collide
+        file_name = os.path.split(local_file)[1]
+        server_file = "{}/{}".format(server_path, file_name)
+        tmp_file = "{}/.{}.{}{}".format(server_path, file_name, uuid.uuid4().hex[:8], UPLOAD_TMP_SUFFIX)
+
+        local_stat = os.stat(local_file)
+
+        # The modification time is copied so that the metadata compare mode sees both files as equal
+        mtime = get_server_mtime(local_stat.st_mtime)
 
-            Todo remove the tmp file location as I do not wantt o support sudo right now
+        copied = False
+        if self.delta_threshold and local_stat.st_size >= self.delta_threshold:
+            copied = self._copy_file_to_server_delta(local_file, server_file, tmp_file)
 
+        if not copied and self.chunked_upload_threshold and local_stat.st_size >= self.chunked_upload_threshold:
+            self._copy_file_to_server_chunked(local_file, server_file, local_stat)
+            copied = True
+
+        elif not copied and local_stat.st_size <= MAX_PUT_SIZE and self._agent_available():
+            with open(local_file, "rb") as f:
+                data = f.read()
+            self._throttle(len(data))
+            try:
+                self.remote_agent.put(data, server_file, mtime).result()
+            except RemoteAgentError as e:
+                if self.remote_agent.running:
+                    raise
+                print("!!! ERROR: Remote agent upload of [{}] failed, retrying over SFTP: [{}] !!!".format(local_file, e))
+            else:
+                self.metrics.add("bytes_uploaded", len(data))
+                return
+
+        with self.sftp_pool.client() as sftp:
+            if not copied:
+                try:
+                    callback = None
+                    if self.bandwidth_limiter is not None:
+                        sent_bytes = [0]
+
+                        def callback(transferred, total):
+                            self._throttle(transferred - sent_bytes[0])
+                            sent_bytes[0] = transferred
+
+                    sftp.put(local_file, tmp_file, callback=callback, confirm=False)
+                    self._rename_on_server(sftp, tmp_file, server_file)
+                    self.metrics.add("bytes_uploaded", local_stat.st_size)
+                except Exception:
+                    try:
+                        sftp.remove(tmp_file)
+                    except IOError:
+                        pass
+                    raise
+
+            try:
+                sftp.utime(server_file, (local_stat.st_atime, mtime))
+            except IOError as e:
+                print("!!! ERROR: Could not set the modification time of [{}]: [{}] !!!".format(server_file, e))
+
+    @timed_operation
+    def copy_files_to_server_tar(self, local_root, server_root, files, compression="gzip"):
         """
+            This method copies many files to the server as a single tar stream, which is much faster than one upload
+            per file when the files are small. The archive is generated on the fly and written to the stdin of a remote
+            tar -x command, it is never stored on either disk.
 
-        if self.verbose: print("Copying {} to {}/".format(local_file, server_path))
+            Contrary to copy_file_to_server(), the files are extracted over the existing ones rather than atomically
+            replaced.
 
-        server_path_exists = self.file_exists_on_server(file_path=server_path)
+            :param str local_root: The local directory the file paths are relative to.
+            :param str server_root: The server directory the files are extracted in.
+            :param list files: The paths of the files to copy, relative to local_root.
+            :param str compression: One of the keys of TAR_COMPRESSIONS.
 
-        if not server_path_exists:
-            self._run_command(command="mkdir {}".format(server_path))
+            :return: T/F based on if all the files were copied.
+        """
 
-        file_name = os.path.split(local_file)[1]
-        self.sftp.put(local_file, "/tmp/{}".format(file_name))
-        self._run_command("mv /tmp/{} {}/".format(file_name, server_path), get_pty=True)
+        tar_mode, tar_option = TAR_COMPRESSIONS[compression]
+
+        if self.verbose: print("Copying {} file(s) to {} as a tar stream ({})".format(len(files), server_root, compression))
+
+        command = "mkdir -p -- {root} && tar -x {option} --no-same-owner -C {root} -f -".format(root=shlex.quote(server_root),
+                                                                                                  option=tar_option)
+        stdin, stdout, stderr = self._run_command(command)
+
+        # Like copy_file_to_server(), the modification time of files modified too recently is not kept
+        racy_mtime = time.time() - RACY_MTIME_WINDOW
+
+        def tar_filter(tarinfo):
+            if tarinfo.mtime >= racy_mtime:
+                tarinfo.mtime = RACY_MTIME
+            return tarinfo
+
+        fileobj = stdin if self.bandwidth_limiter is None else ThrottledWriter(stdin, self._throttle)
+
+        try:
+            with tarfile.open(fileobj=fileobj, mode=tar_mode, format=tarfile.PAX_FORMAT) as tar:
+                for file in files:
+                    tar.add(os.path.join(local_root, file), arcname=file, recursive=False, filter=tar_filter)
+            stdin.flush()
+        except Exception as e:
+            print("!!! ERROR: Could not stream tar archive to [{}]: [{}] !!!".format(server_root, e))
+            stdin.channel.close()
+            return False
+
+        stdin.channel.shutdown_write()
+
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            print("!!! ERROR: tar -x in [{}] failed with status [{}]: [{}] !!!".format(server_root, exit_status, stderr.read().decode(errors="replace").strip()))
+            return False
+
+        self.metrics.add("files_uploaded", len(files))
+        self.metrics.add("bytes_uploaded", sum(os.path.getsize(os.path.join(local_root, file)) for file in files))
+
+        with self.directories_lock:
+            for file in files:
+                directory = os.path.dirname(os.path.join(server_root, file))
+                while directory not in self.known_directories and directory not in ("", "/"):
+                    self.known_directories.add(directory)
+                    directory = os.path.dirname(directory)
+
+        return True
+
+    @timed_operation
+    def ensure_server_directories(self, directories):
+        """
+            This method makes sure that server directories exist. The directories that are not known to exist are all
+            created, along with their parents, by a single mkdir -p command, or a single remote agent request. It is
+            meant to be called once per sync cycle with the directories of every file about to be copied.
+
+            :param iterable directories: The server paths of the directories.
+        """
+
+        with self.directories_lock:
+            missing_directories = sorted(set(directories) - self.known_directories)
+
+            if missing_directories:
+                if self.verbose: print("Creating {} server directories".format(len(missing_directories)))
+
+                if self._agent_available():
+                    self.remote_agent.mkdirs(missing_directories)
+
+                else:
+                    # The paths are given NUL separated on stdin so that the command line length is never an issue
+                    stdin, stdout, stderr = self._run_command("xargs -0 mkdir -p --")
+                    stdin.write("\0".join(missing_directories) + "\0")
+                    stdin.channel.shutdown_write()
+
+                    exit_status = stdout.channel.recv_exit_status()
+                    if exit_status != 0:
+                        raise IOError("mkdir failed with status [{}]: [{}]".format(exit_status, stderr.read().decode(errors="replace").strip()))
+
+                for directory in missing_directories:
+                    while directory not in self.known_directories and directory not in ("", "/"):
+                        self.known_directories.add(directory)
+                        directory = os.path.dirname(directory)
+
+    @timed_operation
+    def copy_files_to_server(self, transfers, workers=None):
+        """
+            This method copies many files to the server concurrently, with one worker per SFTP channel of the pool. A
+            file that could not be copied does not stop the others, an error is printed for it and it is returned.
+
+            The files are uploaded by priority (see TransferQueue): the workers take the next transfer from the queue
+            when they are done with one, so the transfers preempted while they are still queued are never sent. They are
+            returned along with the failed ones, without an error.
+
+            :param transfers: A TransferQueue, or a list of (local_file, server_path) tuples, as given to
+                              copy_file_to_server().
+            :param int workers: The number of concurrent uploads, defaults to the number of SFTP channels.
+
+            :return: The list of local files that could not be copied.
+        """
+
+        transfer_queue = transfers
+        if not isinstance(transfer_queue, TransferQueue):
+            transfer_queue = TransferQueue()
+            for local_file, server_path in transfers:
+                transfer_queue.put(local_file, server_path)
+
+        failed_files = []
+        copied_files = 0
+        copied_bytes = 0
+        lock = threading.Lock()
+
+        try:
+            self.ensure_server_directories(server_path for local_file, server_path in transfer_queue.get_transfers())
+        except IOError as e:
+            # Each upload will try to create its own directory again and report its own error
+            print("!!! ERROR: Could not create server directories: [{}] !!!".format(e))
+
+        def copy_queued():
+
+            nonlocal copied_files, copied_bytes
+
+            for local_file, server_path in iter(transfer_queue.get, None):
+                try:
+                    self.copy_file_to_server(local_file, server_path)
+                except Exception as e:
+                    print("!!! ERROR: Could not copy [{}] to [{}]: [{}] !!!".format(local_file, server_path, e))
+                    with lock:
+                        failed_files.append(local_file)
+                else:
+                    with lock:
+                        copied_files += 1
+                        copied_bytes += os.path.getsize(local_file)
+
+        start_time = time.monotonic()
+
+        workers = min(workers or self.sftp_channels, len(transfer_queue))
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(copy_queued) for _ in range(workers)]:
+                    future.result()
+
+        preempted_files = transfer_queue.pop_preempted()
+
+        self.metrics.add("files_uploaded", copied_files)
+        self.metrics.add("files_upload_failed", len(failed_files))
+        self.metrics.add("files_upload_preempted", len(preempted_files))
+
+        elapsed = time.monotonic() - start_time
+        if self.verbose and (copied_files or failed_files or preempted_files):
+            print("Copied {} file(s), {} byte(s) in {:.2f}(s): {:.2f} MB/s, {} failure(s), {} preempted".format(
+                copied_files, copied_bytes, elapsed, copied_bytes / max(elapsed, 1e-6) / 1e6, len(failed_files),
+                len(preempted_files)))
+
+        return failed_files + preempted_files
+
+    @timed_operation
+    def get_server_file_hashes(self, server_files, hash_engine=DEFAULT_HASH_ENGINE):
+        """
+            This method hashes a list of server files with a single hash command, or a single remote agent request.
+
+            :param list server_files: The server paths of the files.
+            :param HashEngine hash_engine: The engine the files are hashed with.
+
+            :return: A dictionary mapping each server path to its hash, files that could not be hashed are missing.
+        """
+
+        ret_val = {}
+        if not server_files:
+            return ret_val
+
+        if self._agent_available():
+            ret_val = self.remote_agent.hash_files(server_files, hash_engine)
+            self.metrics.add("server_files_hashed", len(ret_val))
+            return ret_val
+
+        server_command = hash_engine.server_command()
+        if server_command is None:
+            raise IOError("The server has no command to hash with [{}]".format(hash_engine.name))
+
+        stdin, stdout, stderr = self._run_command("xargs -0 -r {} -z --".format(server_command))
+
+        # The list is written from another thread, the hashes must be read while it is sent or both sides could block
+        def write_files():
+            stdin.write("\0".join(server_files) + "\0")
+            stdin.channel.shutdown_write()
+
+        writer = threading.Thread(target=write_files, daemon=True)
+        writer.start()
+
+        for record in stdout.read().split(b"\0"):
+            if record:
+                file_hash, path = record.split(b"  ", 1)
+                ret_val[path.decode(errors="surrogateescape")] = bytes.fromhex(file_hash.decode())
+        writer.join()
+        stdout.channel.recv_exit_status()
+
+        self.metrics.add("server_files_hashed", len(ret_val))
+
+        return ret_val
+
+    def get_hash_capabilities(self):
+        """
+            This method finds the hash algorithms the server supports, the ones whose command it has along with, when
+            the remote agent runs, the ones its python supports. The result is kept with the connection.
+
+            :return: The set of the supported HASH_ALGORITHMS, along with SAMPLED_CAPABILITY if the remote agent runs.
+        """
+
+        if self.connection.hash_capabilities is not None:
+            return self.connection.hash_capabilities
+
+        commands = {command.split()[0]: algorithm for algorithm, (_, _, command) in HASH_ALGORITHMS.items() if command}
+        # Some shells only look one command up per command -v
+        stdin, stdout, stderr = self._run_command("for c in {}; do command -v \"$c\"; done".format(" ".join(commands)))
+
+        ret_val = set()
+        for line in stdout.read().decode(errors="replace").split():
+            ret_val.update(algorithm for command, algorithm in commands.items() if os.path.basename(line) == command)
+
+        if self._agent_available():
+            try:
+                ret_val.update(self.remote_agent.hash_capabilities())
+            except RemoteAgentError as e:
+                print("!!! ERROR: Could not get the hash algorithms of the remote agent: [{}] !!!".format(e))
+
+        if self.verbose: print("Server hash algorithms: {}".format(", ".join(sorted(ret_val))))
+
+        self.connection.hash_capabilities = ret_val
+
+        return ret_val
+
+    @timed_operation
+    def set_server_file_mtimes(self, server_files):
+        """
+            This method sets the modification time of server files, pipelining the requests over the SFTP channels.
+
+            :param list server_files: A list of (server_file, mtime) tuples.
+        """
+
+        if self._agent_available():
+            for server_file in self.remote_agent.utimes(server_files):
+                print("!!! ERROR: Could not set the modification time of [{}] !!!".format(server_file))
+            return
+
+        def set_mtime(server_file_mtime):
+
+            server_file, mtime = server_file_mtime
+            with self.sftp_pool.client() as sftp:
+                try:
+                    sftp.utime(server_file, (mtime, mtime))
+                except IOError as e:
+                    print("!!! ERROR: Could not set the modification time of [{}]: [{}] !!!".format(server_file, e))
+
+        with ThreadPoolExecutor(max_workers=self.sftp_channels) as executor:
+            for _ in executor.map(set_mtime, server_files):
+                pass
+
+    @timed_operation
+    def copy_files_on_server(self, operations):
+        """
+            This method copies or moves files that already are on the server to new server paths, so that their content
+            does not have to be uploaded again. All the operations are run by a single command, or a single remote
+            agent request. The destination directories are created if needed, copies are written to a temporary file
+            renamed over the destination and moves replace the destination.
+
+            :param list operations: A list of (operation, server_source, server_destination, mtime) tuples, operation
+                                    being "cp" or "mv", and mtime the modification time to give to the destination, or
+                                    None to leave it.
+
+            :return: The list of the server destinations that could not be copied or moved.
+        """
+
+        if not operations:
+            return []
+
+        if self.verbose: print("Copying {} file(s) on the server".format(len(operations)))
+
+        if self._agent_available():
+            failed_files = self.remote_agent.copy(operations)
+
+        else:
+            # Each operation is given as 4 NUL separated arguments, the destinations that failed are printed back
+            script = ("d=$(dirname -- \"$3\") && mkdir -p -- \"$d\" && "
+                      "if [ \"$1\" = mv ]; then mv -f -- \"$2\" \"$3\"; "
+                      "else t=\"$d/.$(basename -- \"$3\").$${}\" && cp -- \"$2\" \"$t\" && mv -f -- \"$t\" \"$3\"; fi && "
+                      "{{ [ -z \"$4\" ] || touch -m -d \"@$4\" -- \"$3\"; }} || printf '%s\\0' \"$3\"").format(UPLOAD_TMP_SUFFIX)
+            stdin, stdout, stderr = self._run_command("xargs -0 -r -n 4 sh -c {} sh".format(shlex.quote(script)))
+
+            def write_operations():
+                for operation, source, destination, mtime in operations:
+                    stdin.write("{}\0{}\0{}\0{}\0".format(operation, source, destination, "" if mtime is None else "{:f}".format(mtime)))
+                stdin.channel.shutdown_write()
+
+            writer = threading.Thread(target=write_operations, daemon=True)
+            writer.start()
+
+            failed_files = [path.decode(errors="surrogateescape") for path in stdout.read().split(b"\0") if path]
+            writer.join()
+
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise IOError("Copies on the server failed with status [{}]: [{}]".format(exit_status, stderr.read().decode(errors="replace").strip()))
+
+        failed = set(failed_files)
+        for operation, source, destination, mtime in operations:
+            if destination not in failed:
+                self.metrics.add("files_moved_on_server" if operation == "mv" else "files_copied_on_server")
+
+        return failed_files
 
     def delete_file_from_server(self, file_path):
         """
@@ -126,8 +726,49 @@ class SSHAgent():
 
             :param str file_path: The path to the file that needs to be deleted
         """
-        if self.verbose: print("Deleting {}".format(file_path))
-        self._run_command("rm -rf {}".format(file_path), get_pty=True)
+
+        self.delete_files_from_server([file_path])
+
+    @timed_operation
+    def delete_files_from_server(self, file_paths):
+        """
+            This method deletes files and directories from the server, like rm -rf, with a single command or a single
+            remote agent request whatever their number. The paths under another path of the list are dropped first, since
+            deleting their ancestor already deletes them. An IOError is raised if some could not be deleted.
+
+            :param list file_paths: The server paths of the files/directories to delete.
+        """
+
+        file_paths = collapse_paths(file_paths)
+        if not file_paths:
+            return
+
+        if self.verbose:
+            for file_path in file_paths:
+                print("Deleting {}".format(file_path))
+
+        try:
+            if self._agent_available():
+                try:
+                    self.remote_agent.delete(file_paths)
+                except RemoteAgentError as e:
+                    raise IOError("rm failed: [{}]".format(e))
+
+            else:
+                # The paths are given NUL separated on stdin, like for mkdir in ensure_server_directories()
+                stdin, stdout, stderr = self._run_command("xargs -0 -r rm -rf --")
+                stdin.write("\0".join(file_paths) + "\0")
+                stdin.channel.shutdown_write()
+
+                # Wait for the deletion, so that a sync cycle is over when it returns
+                exit_status = stdout.channel.recv_exit_status()
+                if exit_status != 0:
+                    raise IOError("rm failed with status [{}]: [{}]".format(exit_status, stderr.read().decode(errors="replace").strip()))
+
+        finally:
+            self._forget_server_directories(file_paths)
+
+        self.metrics.add("files_deleted", len(file_paths))
 
     def file_exists_on_server(self, file_path):
         """
@@ -140,7 +781,8 @@ class SSHAgent():
 
         ret_val = None
         try:
-            self.sftp.stat(file_path)
+            with self.sftp_pool.client() as sftp:
+                sftp.stat(file_path)
 
         except IOError as e:
             ret_val = False
@@ -150,50 +792,400 @@ class SSHAgent():
 
         return ret_val
 
+    def remove_stale_uploads(self):
+        """
+            This method removes the part files of the interrupted chunked uploads to the server (see
+            _copy_file_to_server_chunked()) that cannot be resumed anymore, as their local file was modified or deleted
+            since.
+        """
+
+        for journal in get_upload_journals(self._get_server_name(), self.journal_directory):
+            try:
+                if journal.matches(journal.local_file, os.stat(journal.local_file), journal.chunk_size):
+                    continue
+            except OSError:
+                pass
+
+            if self.verbose: print("Removing stale upload {}".format(journal.part_file))
+            with self.sftp_pool.client() as sftp:
+                _remove_quietly(sftp, journal.part_file)
+            journal.remove()
+
     # ////////////////////// Helpers ////////////////////// #
 
+    def _agent_available(self):
+        """
+            This method tells if the operations can be sent to the remote agent. An agent that stopped is dropped, the
+            operations then go back to running their own commands.
+
+            :return: T/F based on if the remote agent is running.
+        """
+
+        if self.remote_agent is not None and not self.remote_agent.running:
+            print("!!! ERROR: The remote agent is not running anymore, falling back on SSH commands !!!")
+            self.remote_agent = None
+
+        return self.remote_agent is not None
+
     def _run_command(self, command, get_pty=False):
         """
             This is a simple wrapper method around exec_command() that stores stdin, stdout, and stderr in the streams
-            class variable.
+            class variable. The streams are also returned, callers running in worker threads must use those as the
+            streams class variable is shared.
 
             :param str command: Command to run
+
+            :return: The stdin, stdout and stderr of the command.
         """
 
         stdin, stdout, stderr = self.ssh.exec_command(command, get_pty=get_pty)
+        self.metrics.add("ssh_commands")
         # print(stdout.readlines())
         self.streams["in"] = stdin
         self.streams["out"] = stdout
         self.streams["err"] = stderr
 
-    def _ssh_connect(self):
+        return stdin, stdout, stderr
+
+    @timed_operation
+    def _copy_file_to_server_delta(self, local_file, server_file, tmp_file):
         """
-            This method will connect to an ssh server given its class variables instantiated int the init method.
-            If an error occurs during connection, a message is printed.
+            This method updates a server file with an rsync style delta transfer. The block signatures of the server copy
+            are fetched, the delta of the local file against them is streamed to the server where the file is rebuilt in
+            tmp_file, checked against the hash of the local file and renamed over server_file. Both steps run
+            REMOTE_DELTA_SCRIPT with python3 on the server.
+
+            :param str local_file: The local path to the file.
+            :param str server_file: The server path to the file to update.
+            :param str tmp_file: The server path the file is rebuilt in.
+
+            :return: T/F based on if the file was updated, False meaning it should be uploaded in full.
         """
 
-        if self.verbose: print("\nSSH Connecting to: Host-{}, Username-{}".format(self.host, self.username))
-        self.ssh = paramiko.SSHClient()
-        self.ssh.load_system_host_keys()
-        self.ssh.connect(hostname=self.host, username=self.username, password="")
-        if self.verbose: print("Connected")
+        script = shlex.quote(REMOTE_DELTA_SCRIPT)
+        block_size = get_block_size(os.path.getsize(local_file))
+
+        stdin, stdout, stderr = self._run_command("python3 -c {} signature {} {}".format(script, shlex.quote(server_file), block_size))
+        signature = stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            # Usually because the file does not exist on the server yet
+            return False
 
-    def _ssh_sftp_connect(self):
+        server_size, block_size, signatures = parse_signatures(signature)
+
+        stdin, stdout, stderr = self._run_command("python3 -c {} patch {} {} {}".format(script, shlex.quote(server_file),
+                                                                                        shlex.quote(tmp_file), block_size))
+        sent_bytes = 0
+        try:
+            for piece in generate_delta(local_file, block_size, signatures):
+                self._throttle(len(piece))
+                stdin.write(piece)
+                sent_bytes += len(piece)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+        except Exception as e:
+            print("!!! ERROR: Delta transfer of [{}] failed: [{}] !!!".format(local_file, e))
+            stdin.channel.close()
+            return False
+
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            print("!!! ERROR: Delta transfer of [{}] failed with status [{}]: [{}] !!!".format(local_file, exit_status, stderr.read().decode(errors="replace").strip()))
+            return False
+
+        if self.verbose: print("Delta transfer of {}: sent {} byte(s) for {} byte(s)".format(local_file, sent_bytes + len(signature), os.path.getsize(local_file)))
+
+        self.metrics.add("bytes_uploaded", sent_bytes)
+        self.metrics.add("delta_bytes_saved", max(0, os.path.getsize(local_file) - sent_bytes))
+
+        return True
+
+    @timed_operation
+    def _copy_file_to_server_chunked(self, local_file, server_file, local_stat):
         """
-            This method will use the open_sftp() method to establish an SFTP connection with the ssh server
+            This method uploads a large file in chunks of upload_chunk_size bytes, written concurrently to a part file
+            next to server_file, each one through its own SFTP channel of the pool with pipelined writes. A chunk is
+            recorded in the journal of the upload (see UploadJournal) once the server answered the close of its handle,
+            so an interrupted upload keeps its part file and the next upload of the same version of the local file only
+            sends the chunks that are missing.
 
+            The part file is hashed on the server and checked against the local file, hashed while the chunks are sent,
+            before it is renamed over server_file. A mismatch, from a failed write or a local file modified during the
+            upload, abandons the part file. An IOError is raised if the file could not be copied.
+
+            :param str local_file: The local path to the file.
+            :param str server_file: The server path to the file.
+            :param os.stat_result local_stat: The stat result of the local file.
         """
 
-        if self.verbose: print("\nSFTP Connecting")
-        self.sftp = self.ssh.open_sftp()
-        if self.verbose: print("Connected")
+        size = local_stat.st_size
+        chunk_size = self.upload_chunk_size
+        journal = UploadJournal(self._get_server_name(), server_file, self.journal_directory)
+
+        with self.sftp_pool.client() as sftp:
+            resumable = False
+            if journal.matches(local_file, local_stat, chunk_size):
+                # The chunks are only resumed if the part file is still there, the digest check catches a part file
+                # modified since
+                try:
+                    resumable = sftp.stat(journal.part_file).st_size <= size
+                except IOError:
+                    pass
+
+            if not resumable:
+                if journal.part_file is not None:
+                    _remove_quietly(sftp, journal.part_file)
+                server_path, file_name = server_file.rsplit("/", 1)
+                journal.start(local_file, local_stat, chunk_size,
+                              "{}/.{}.{}{}".format(server_path, file_name, uuid.uuid4().hex[:8], UPLOAD_PART_SUFFIX))
+                with sftp.open(journal.part_file, "w") as part:
+                    part.truncate(size)
+
+        part_file = journal.part_file
+        chunks = [index for index in range(-(-size // chunk_size)) if index not in journal.chunks]
+
+        if self.verbose and resumable: print("Resuming upload of {}: {} chunk(s) left".format(local_file, len(chunks)))
+        self.metrics.add("upload_chunks_resumed", -(-size // chunk_size) - len(chunks))
+
+        def write_chunk(index):
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            with open(local_file, "rb") as local, self.sftp_pool.client() as sftp:
+                local.seek(offset)
+                # The handle is closed before the chunk is recorded, close() only returns once the server answered the
+                # writes sent before it
+                with sftp.open(part_file, "r+") as part:
+                    part.set_pipelined(True)
+                    part.seek(offset)
+                    remaining = length
+                    while remaining:
+                        data = local.read(min(UPLOAD_READ_SIZE, remaining))
+                        if not data:
+                            raise IOError("[{}] was truncated while being uploaded".format(local_file))
+                        self._throttle(len(data))
+                        part.write(data)
+                        remaining -= len(data)
+            journal.add_chunk(index)
+            self.metrics.add("bytes_uploaded", length)
+            self.metrics.add("upload_chunks")
+
+        # A sampled digest is too weak to check an upload, the whole file is hashed with the same algorithm
+        hash_engine = self.hash_engine if not self.hash_engine.sample_size else HashEngine(self.hash_engine.algorithm)
+
+        # The outer thread does not hold an SFTP channel while it waits, the chunks need them all
+        with ThreadPoolExecutor(max_workers=self.sftp_pool.size + 1) as executor:
+            local_digest = executor.submit(hash_engine.hash_file, local_file)
+            for _ in executor.map(write_chunk, chunks):
+                pass
+            local_digest = local_digest.result()
+
+        server_digest = self.get_server_file_hashes([part_file], hash_engine).get(part_file)
+
+        with self.sftp_pool.client() as sftp:
+            if server_digest != local_digest:
+                _remove_quietly(sftp, part_file)
+                journal.remove()
+                raise IOError("The upload of [{}] does not match the local file, it will be sent again".format(local_file))
+
+            self._rename_on_server(sftp, part_file, server_file)
+            journal.remove()
+
+    def _throttle(self, amount):
+        """
+            This method waits until the bandwidth limit allows amount more bytes to be uploaded.
+
+            :param int amount: The number of bytes about to be sent.
+        """
+
+        if self.bandwidth_limiter is not None and amount > 0:
+            self.metrics.add("bandwidth_wait_seconds", self.bandwidth_limiter.consume(amount))
+
+    def _get_server_name(self):
+
+        return "{}@{}:{}".format(self.username, self.host, self.port)
+
+    def _rename_on_server(self, sftp, old_path, new_path):
+        """
+            This method renames a file on the server, replacing new_path if it exists. The posix-rename SFTP extension is
+            used when the server supports it, a mv command otherwise.
+
+            :param paramiko.SFTPClient sftp: The SFTP client to use.
+            :param str old_path: The current path of the file.
+            :param str new_path: The new path of the file.
+        """
+
+        try:
+            sftp.posix_rename(old_path, new_path)
+        except IOError:
+            self._check_command("mv -f -- {} {}".format(shlex.quote(old_path), shlex.quote(new_path)))
+
+    def _forget_server_directories(self, paths):
+        """
+            This method removes deleted server paths, and every directory under them, from the known directories.
+
+            :param list paths: The deleted server paths.
+        """
+
+        paths = {path.rstrip("/") for path in paths}
+        with self.directories_lock:
+            self.known_directories = {directory for directory in self.known_directories
+                                      if not any(ancestor in paths for ancestor in _ancestors(directory))}
+
+    def _check_command(self, command):
+        """
+            This method runs a command and waits for it to finish. An IOError holding the error output of the command is
+            raised if it fails.
+
+            :param str command: Command to run
+        """
+
+        stdin, stdout, stderr = self._run_command(command)
+
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            raise IOError("[{}] failed with status [{}]: [{}]".format(command, exit_status, stderr.read().decode(errors="replace").strip()))
+
+    def _add_manifest_record(self, tree, record):
+        """
+            This method adds one record of the output of get_server_manifest() to a repo structure. A record is either
+            "D <path>" for a directory, "<hash>  <path>" for a regular file, "M <size> <mtime> <path>" for a regular
+            file in the metadata compare mode, or "I <path>" for an element matching the do not delete patterns, which
+            protects its directories (see DirectoryTree).
+
+            :param dict tree: The repo structure to update.
+            :param bytes record: The record without its NUL terminator.
+        """
+
+        if record.startswith(b"I "):
+            set_protected(tree, record[2:].decode(errors="surrogateescape"))
+            return
+        elif record.startswith(b"D "):
+            is_dir = True
+            path = record[2:]
+        elif record.startswith(b"M "):
+            is_dir = False
+            size, mtime, path = record[2:].split(b" ", 2)
+            value = get_metadata_value(int(size), float(mtime))
+        else:
+            is_dir = False
+            file_hash, path = record.split(b"  ", 1)
+            value = bytes.fromhex(file_hash.decode())
+
+        names = [sys.intern(name) for name in path.decode(errors="surrogateescape").split("/")]
+
+        # Walk down to the parent directory, creating the directories that were not listed yet
+        parent = tree
+        for name in names[:-1]:
+            if name not in parent:
+                parent[name] = DirectoryTree()
+            parent = parent[name]
+
+        if is_dir:
+            if names[-1] not in parent:
+                parent[names[-1]] = DirectoryTree()
+        else:
+            parent[names[-1]] = value
+
+
+def _remove_quietly(sftp, server_file):
+
+    try:
+        sftp.remove(server_file)
+    except IOError:
+        pass
+
+
+def _get_find_prune(do_not_delete):
+    """
+        This method converts do not delete patterns into find expressions pruning the matching elements. Only the
+        patterns find matches exactly are converted: names, which find -name matches like .gitignore does, and literal
+        paths. Nothing is pruned when a pattern is negated, as it could include again an element of a pruned directory.
+
+        :param IgnoreMatcher do_not_delete: The patterns.
+
+        :return: The find expression, "" for none, and T/F based on if it prunes all the patterns.
+    """
+
+    if do_not_delete.has_negations:
+        return "", not do_not_delete
+
+    tests = []
+    exact = True
+    for rule in do_not_delete.rules:
+        if not rule.anchored:
+            test = "-name {}".format(shlex.quote(rule.pattern))
+        elif not any(character in rule.pattern for character in "*?[\\"):
+            test = "-path {}".format(shlex.quote("./" + rule.pattern))
+        else:
+            exact = False
+            continue
+        tests.append("\\( {} -type d \\)".format(test) if rule.dir_only else test)
+
+    if not tests:
+        return "", exact
+
+    return "\\( {} \\) -prune -o".format(" -o ".join(tests)), exact
+
+
+def _remove_ignored(directory_tree, ignore_matcher, prefix=""):
+    """
+        This method removes the elements matching patterns from a repo structure, along with their content, and marks
+        their directories as protected.
+    """
+
+    for name, element in list(directory_tree.items()):
+        is_dir = isinstance(element, dict)
+        if ignore_matcher.is_ignored(prefix + name, is_dir):
+            del directory_tree[name]
+            directory_tree.protected = True
+        elif is_dir:
+            _remove_ignored(element, ignore_matcher, prefix + name + "/")
+            directory_tree.protected = directory_tree.protected or element.protected
+
+
+def collapse_paths(paths):
+    """
+        This method drops the paths that are under another path of a list, and the duplicates.
+
+        :param iterable paths: The paths.
+
+        :return: The sorted list of the remaining paths.
+    """
+
+    paths = {path.rstrip("/") for path in paths}
+
+    return sorted(path for path in paths if not any(ancestor in paths for ancestor in _ancestors(os.path.dirname(path))))
+
+
+def get_server_mtime(mtime, now=None):
+    """
+        This method gives the modification time to give to the server copy of a local file.
+
+        :param float mtime: The modification time of the local file.
+        :param float now: The current time, None for time.time().
+
+        :return: mtime, or RACY_MTIME if the local file was modified in the last RACY_MTIME_WINDOW seconds.
+    """
+
+    now = time.time() if now is None else now
+
+    return mtime if now - mtime > RACY_MTIME_WINDOW else RACY_MTIME
+
+
+def _ancestors(path):
+    """
+        This method yields a path and each of its parents, up to the root.
+    """
+
+    while path not in ("", "/"):
+        yield path
+        path = os.path.dirname(path)
+
+
+def _count_files(directory_tree):
+
+    return sum(_count_files(value) if isinstance(value, dict) else 1 for value in directory_tree.values())
 
-    def _extract_hash(self, output):
-        ret_val = None
-        hash = re.findall("[0-9a-f]{5,40}", output)
-        if  len(hash) == 1:
-            ret_val = hash[0]
-        return ret_val
 
 def main(host, username, verbose=False):
     """
@@ -201,7 +1193,7 @@ def main(host, username, verbose=False):
     """
     ssh = SSHAgent(host=host, username=username, verbose=verbose)
     print(ssh.file_exists_on_server(file_path="/home/justin/deployer_repos/"))
-    print(ssh.get_server_directory_structure("/home/justin/deployer_repos/", []))
+    print(ssh.get_server_directory_structure("/home/justin/deployer_repos/", IgnoreMatcher([])))
     del ssh
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the transfer_queue used by the ssh_deployer to schedule the uploads of a sync, and the
+    TokenBucket used to cap the bandwidth they use.
+
+    The uploads are not sent in the order the diff found them: the files modified recently, which are the ones being
+    worked on, go first and the smaller files go before the larger ones, so that a large asset does not hold back the
+    source file that was just saved. An upload still queued when a newer change of its file arrives is preempted, the
+    sync that follows sends the newer version instead. The change is noticed either by the deployer, for a target still
+    busy when the next cycle starts, or by the queue itself, which checks the stat signature of each file as its upload
+    starts.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Files modified this recently are uploaded before the others
+RECENT_CHANGE_WINDOW = 60
+
+
+class TransferQueue():
+    """
+        This is the TransferQueue class. It holds (local_file, server_path) transfers, as given to
+        SSHAgent.copy_file_to_server(), and hands them out by priority. It is thread safe, the upload workers get the
+        transfers while the deployer preempts the ones whose file changed again. A transfer whose file changed since it
+        was queued is preempted when it is handed out.
+    """
+    def __init__(self):
+
+        # (priority, order, local_file) entries, the ones no longer in transfers are skipped when popped
+        self.heap = []
+        # local_file -> (server_path, order, stat signature when queued) of the queued transfers
+        self.transfers = {}
+        # Local files of the transfers preempted since the last pop_preempted()
+        self.preempted = []
+
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+
+        with self.lock:
+            return len(self.transfers)
+
+    def put(self, local_file, server_path):
+        """
+            This method queues a transfer, replacing the queued transfer of the same file if there is one.
+
+            :param str local_file: The local path to the file to upload.
+            :param str server_path: The server directory to upload it to.
+        """
+
+        stat_result = _stat(local_file)
+
+        with self.lock:
+            order = next(self.order)
+            self.transfers[local_file] = (server_path, order, _get_signature(stat_result))
+            heapq.heappush(self.heap, (get_transfer_priority(stat_result), order, local_file))
+
+    def get(self):
+        """
+            :return: The (local_file, server_path) transfer with the highest priority, removed from the queue, or None
+                     if the queue is empty. The transfers whose file changed since they were queued are preempted
+                     instead of being returned.
+        """
+
+        while True:
+            with self.lock:
+                transfer = None
+                while self.heap and transfer is None:
+                    _, order, local_file = heapq.heappop(self.heap)
+                    transfer = self.transfers.get(local_file)
+                    if transfer is not None and transfer[1] == order:
+                        del self.transfers[local_file]
+                    else:
+                        transfer = None
+
+            if transfer is None:
+                return None
+
+            server_path, _, signature = transfer
+            if _get_signature(_stat(local_file)) == signature:
+                return local_file, server_path
+
+            with self.lock:
+                self.preempted.append(local_file)
+
+    def get_transfers(self):
+        """
+            :return: The list of the queued (local_file, server_path) transfers, in no particular order.
+        """
+
+        with self.lock:
+            return [(local_file, server_path) for local_file, (server_path, _, _) in self.transfers.items()]
+
+    def preempt(self, paths):
+        """
+            This method removes the queued transfers of files that changed again, and of the files inside directories
+            that changed again.
+
+            :param list paths: The local paths of the files and directories.
+
+            :return: The number of transfers removed.
+        """
+
+        paths = [path.rstrip("/") for path in paths]
+        directories = tuple(path + "/" for path in paths)
+        paths = set(paths)
+
+        with self.lock:
+            preempted = [local_file for local_file in self.transfers
+                         if local_file in paths or local_file.startswith(directories)]
+            for local_file in preempted:
+                del self.transfers[local_file]
+            self.preempted += preempted
+
+        return len(preempted)
+
+    def pop_preempted(self):
+        """
+            :return: The local files of the transfers preempted since the last call.
+        """
+
+        with self.lock:
+            ret_val = self.preempted
+            self.preempted = []
+
+        return ret_val
+
+
+class TokenBucket():
+    """
+        This is the TokenBucket class. It caps the rate of the bytes sent through it, the bytes not sent during an idle
+        second can be sent at once afterwards, up to burst bytes. It is thread safe and shared by every upload, of every
+        target, so that the cap holds for the whole deployer.
+    """
+    def __init__(self, rate, burst=None):
+
+        # Bytes per second
+        self.rate = rate
+        self.burst = burst if burst else rate
+
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+            This method takes amount bytes from the bucket, waiting until the bucket allows them to be sent. The waiting
+            uploads queue up: each one waits for its share of the rate.
+
+            :param int amount: The number of bytes about to be sent.
+
+            :return: The number of seconds waited.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+        return delay
+
+
+class ThrottledWriter():
+    """
+        This is the ThrottledWriter class. It wraps a file object written to, each write first waits for the bandwidth
+        limit to allow it.
+    """
+    def __init__(self, fileobj, throttle):
+
+        self.fileobj = fileobj
+        # Function taking a number of bytes about to be sent, and returning once they can be
+        self.throttle = throttle
+
+    def write(self, data):
+
+        self.throttle(len(data))
+
+        return self.fileobj.write(data)
+
+    def flush(self):
+
+        self.fileobj.flush()
+
+
+def get_transfer_priority(stat_result):
+    """
+        This method gives the priority of the upload of a file, lower values being uploaded first: the files modified
+        in the last RECENT_CHANGE_WINDOW seconds, then the others, the smaller files first in both groups.
+
+        :param os.stat_result stat_result: The stat result of the local file, None if it does not exist.
+
+        :return: A tuple to sort the uploads by.
+    """
+
+    if stat_result is None:
+        # It fails right away and is reported as such
+        return 0, 0
+
+    return int(time.time() - stat_result.st_mtime > RECENT_CHANGE_WINDOW), stat_result.st_size
+
+
+# ////////////////////// Helpers ////////////////////// #
+
+def _stat(local_file):
+
+    try:
+        return os.stat(local_file)
+    except OSError:
+        return None
+
+
+def _get_signature(stat_result):
+
+    if stat_result is None:
+        return None
+
+    return stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the upload_journal used by the ssh_agent to resume the chunked uploads of large files. A
+    chunked upload writes the file to a part file on the server, chunk by chunk, and records each chunk in a journal
+    once the server confirmed its writes. When the upload is interrupted, the next upload of the same file only sends
+    the chunks missing from the part file, as long as the local file did not change in the meantime.
+
+    The journals are stored in the XDG cache directory ($XDG_CACHE_HOME or ~/.cache), one small file per upload in
+    progress, named after a hash of the server and of the server path of the file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+JOURNAL_FILE_VERSION = 1
+
+
+def get_default_journal_directory():
+    """
+        :return: The directory the upload journals are stored in.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "ssh_deployer", "uploads")
+
+
+class UploadJournal():
+    """
+        This is the upload_journal class. It records the chunks of a server file already written to its part file, for
+        the local file it was started from, identified by its path, size and mtime_ns. It is thread safe, the chunks of
+        an upload are written concurrently.
+    """
+    def __init__(self, server, server_file, journal_directory=None):
+
+        self.server = server
+        self.server_file = server_file
+
+        journal_directory = journal_directory if journal_directory else get_default_journal_directory()
+        journal_id = hashlib.sha1("{}\0{}".format(server, server_file).encode(errors="surrogateescape")).hexdigest()[:16]
+        self.journal_path = os.path.join(journal_directory, "{}.json".format(journal_id))
+
+        # The upload in progress, None when there is none
+        self.part_file = None
+        self.local_file = None
+        self.size = None
+        self.mtime_ns = None
+        self.chunk_size = None
+        # Indexes of the chunks written to the part file
+        self.chunks = set()
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        """
+            This method loads the journal from its file. A missing or unreadable file results in no upload in progress.
+        """
+
+        try:
+            with open(self.journal_path) as journal_file:
+                journal_json = json.load(journal_file)
+
+            if (journal_json.get("version") == JOURNAL_FILE_VERSION and journal_json.get("server") == self.server and
+                    journal_json.get("server_file") == self.server_file):
+                self.part_file = journal_json["part_file"]
+                self.local_file = journal_json["local_file"]
+                self.size = journal_json["size"]
+                self.mtime_ns = journal_json["mtime_ns"]
+                self.chunk_size = journal_json["chunk_size"]
+                self.chunks = set(journal_json["chunks"])
+
+        except FileNotFoundError:
+            pass
+
+        except Exception as e:
+            print("!!! ERROR: Could not load upload journal [{}]: [{}] !!!".format(self.journal_path, e))
+
+    def matches(self, local_file, stat_result, chunk_size):
+        """
+            This method checks whether the upload in progress can be resumed.
+
+            :param str local_file: The local path to the file to upload.
+            :param os.stat_result stat_result: The stat result of the local file.
+            :param int chunk_size: The size of the chunks of the upload.
+
+            :return: T/F based on if the upload in progress is the one of this version of the file.
+        """
+
+        return (self.part_file is not None and
+                (self.local_file, self.size, self.mtime_ns, self.chunk_size) ==
+                (local_file, stat_result.st_size, stat_result.st_mtime_ns, chunk_size))
+
+    def start(self, local_file, stat_result, chunk_size, part_file):
+        """
+            This method starts a new upload, forgetting the one in progress.
+
+            :param str local_file: The local path to the file to upload.
+            :param os.stat_result stat_result: The stat result of the local file.
+            :param int chunk_size: The size of the chunks of the upload.
+            :param str part_file: The server path the file is written to.
+        """
+
+        with self.lock:
+            self.part_file = part_file
+            self.local_file = local_file
+            self.size = stat_result.st_size
+            self.mtime_ns = stat_result.st_mtime_ns
+            self.chunk_size = chunk_size
+            self.chunks = set()
+
+        self.save()
+
+    def add_chunk(self, index):
+        """
+            This method records a chunk whose writes the server confirmed.
+
+            :param int index: The index of the chunk.
+        """
+
+        with self.lock:
+            self.chunks.add(index)
+
+        self.save()
+
+    def save(self):
+        """
+            This method writes the journal to its file. The file is written to a temporary path and renamed so that a
+            crash never leaves a truncated journal behind. An upload whose journal cannot be saved still completes, it
+            just cannot be resumed.
+        """
+
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+
+                tmp_path = "{}.tmp".format(self.journal_path)
+                with open(tmp_path, "w") as journal_file:
+                    json.dump({"version": JOURNAL_FILE_VERSION, "server": self.server, "server_file": self.server_file,
+                               "part_file": self.part_file, "local_file": self.local_file, "size": self.size,
+                               "mtime_ns": self.mtime_ns, "chunk_size": self.chunk_size,
+                               "chunks": sorted(self.chunks)}, journal_file)
+                os.replace(tmp_path, self.journal_path)
+
+            except Exception as e:
+                print("!!! ERROR: Could not save upload journal [{}]: [{}] !!!".format(self.journal_path, e))
+
+    def remove(self):
+        """
+            This method deletes the journal, once its upload completed or was abandoned.
+        """
+
+        with self.lock:
+            self.part_file = None
+            self.chunks = set()
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print("!!! ERROR: Could not remove upload journal [{}]: [{}] !!!".format(self.journal_path, e))
+
+
+def get_upload_journals(server, journal_directory=None):
+    """
+        This method returns the journals of the uploads in progress to a server.
+
+        :param str server: The server, as given to UploadJournal.
+        :param str journal_directory: The directory the journals are stored in, None for the default one.
+
+        :return: The list of UploadJournal.
+    """
+
+    journal_directory = journal_directory if journal_directory else get_default_journal_directory()
+
+    ret_val = []
+    try:
+        file_names = os.listdir(journal_directory)
+    except FileNotFoundError:
+        return ret_val
+
+    for file_name in file_names:
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(journal_directory, file_name)) as journal_file:
+                journal_json = json.load(journal_file)
+        except Exception:
+            # The upload of an unreadable journal reports it itself
+            continue
+        if journal_json.get("server") == server and journal_json.get("server_file"):
+            journal = UploadJournal(server, journal_json["server_file"], journal_directory)
+            if journal.part_file is not None:
+                ret_val.append(journal)
+
+    return ret_val
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+    This python file holds the watcher used by the ssh_deployer to be notified of changes in the local repo instead of
+    rescanning it on a fixed interval. It is a small ctypes binding of the Linux inotify API, so it has no dependency
+    outside of the standard library but only works on Linux.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_BUFFER_SIZE = 65536
+
+DEFAULT_DEBOUNCE = 0.2
+
+# A burst of events is never delayed longer than this many debounce periods
+MAX_DEBOUNCE_PERIODS = 10
+
+
+class WatcherError(Exception):
+    """
+        Raised when inotify is not available or a watch could not be added.
+    """
+
+
+class InotifyWatcher():
+    """
+        This is the inotify watcher class. It watches every directory of a local repo and collects the paths, relative
+        to the repo, that were created, modified, moved or deleted.
+    """
+    def __init__(self, repo_path, ignore_files, verbose=False):
+
+        self.repo_path = os.path.abspath(repo_path)
+        self.ignore_files = ignore_files
+        self.verbose = verbose
+
+        # Watch descriptor -> path of the watched directory relative to the repo ("" for the repo itself)
+        self.watches = {}
+
+        # Set when the kernel event queue overflowed, events were lost and a full rescan is needed
+        self.overflowed = False
+
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise WatcherError("libc could not be found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise WatcherError("inotify is not available on this platform")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError("inotify_init1 failed: [{}]".format(os.strerror(ctypes.get_errno())))
+
+        self._add_watches("")
+
+        if self.verbose: print("Watching {} directories of {}".format(len(self.watches), self.repo_path))
+
+    def __del__(self):
+
+        self.close()
+
+    def close(self):
+        """
+            This method closes the inotify file descriptor, which also removes all watches.
+        """
+
+        if getattr(self, "fd", -1) >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def wait_for_changes(self, timeout, debounce=DEFAULT_DEBOUNCE):
+        """
+            This method blocks until a change happens in the repo or the timeout expires. Once a first event is received,
+            events keep being collected until none arrived for debounce seconds, so that a burst of writes (an editor
+            saving, a branch checkout...) is coalesced into a single set of dirty paths.
+
+            :param float timeout: The maximum amount of seconds to wait for a first event.
+            :param float debounce: The amount of quiet seconds that ends a burst of events.
+
+            :return: A set of dirty paths relative to the repo, empty if the timeout expired.
+        """
+
+        dirty_paths = set()
+
+        if not self._wait_readable(timeout):
+            return dirty_paths
+
+        burst_deadline = time.monotonic() + debounce * MAX_DEBOUNCE_PERIODS
+        while True:
+            self._read_events(dirty_paths)
+
+            remaining = burst_deadline - time.monotonic()
+            if remaining <= 0 or not self._wait_readable(min(debounce, remaining)):
+                break
+
+        return dirty_paths
+
+    def drain(self):
+        """
+            This method discards every pending event, it is used before a full rescan which makes them irrelevant.
+        """
+
+        self._read_events(set())
+        self.overflowed = False
+
+    # ////////////////////// Helpers ////////////////////// #
+
+    def _wait_readable(self, timeout):
+        """
+            This method waits for the inotify file descriptor to be readable.
+
+            :param float timeout: The maximum amount of seconds to wait.
+
+            :return: T/F based on if events are ready to be read.
+        """
+
+        try:
+            readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        except InterruptedError:
+            readable = []
+
+        return bool(readable)
+
+    def _read_events(self, dirty_paths):
+        """
+            This method reads all pending events and adds the paths they concern to dirty_paths. New directories get
+            watched as they appear.
+
+            :param set dirty_paths: The set of dirty relative paths to update.
+        """
+
+        while True:
+            try:
+                buffer = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    continue
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+
+                if not name:
+                    # The event concerns the watched directory itself (deleted or moved away)
+                    if directory:
+                        dirty_paths.add(directory)
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name))
+                if self._is_ignored(path, bool(mask & IN_ISDIR)):
+                    continue
+
+                dirty_paths.add(path)
+
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watches(path)
+
+    def _add_watches(self, directory):
+        """
+            This method adds a watch on a directory of the repo and, recursively, on all of its sub directories.
+
+            :param str directory: The path of the directory relative to the repo.
+        """
+
+        full_path = os.path.join(self.repo_path, directory)
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(full_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # The directory may have been removed again before it could be watched
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise WatcherError("Could not watch [{}]: [{}]".format(full_path, os.strerror(error)))
+
+        self.watches[wd] = directory
+
+        try:
+            directory_scan = os.scandir(full_path)
+        except OSError:
+            return
+
+        with directory_scan:
+            for element in directory_scan:
+                path = os.path.join(directory, element.name)
+                if element.is_dir(follow_symlinks=False) and not self._is_ignored(path, True):
+                    self._add_watches(path)
+
+    def _is_ignored(self, path, is_dir):
+
+        # The directories of the path are watched, so they are not ignored
+        return self.ignore_files.is_ignored(path, is_dir)
+
+
+def wait_for_watchers(watchers, timeout):
+    """
+        This method blocks until at least one of several watchers has pending events or the timeout expires, it lets a
+        single loop wait on the repos of several deployments.
+
+        :param list watchers: The InotifyWatcher objects, or any object whose fd attribute is a file descriptor to wait
+                              for.
+        :param float timeout: The maximum amount of seconds to wait.
+
+        :return: The list of the watchers with pending events, empty if the timeout expired.
+    """
+
+    watchers = [watcher for watcher in watchers if watcher.fd >= 0]
+    if not watchers:
+        time.sleep(max(timeout, 0))
+        return []
+
+    try:
+        readable, _, _ = select.select([watcher.fd for watcher in watchers], [], [], max(timeout, 0))
+    except InterruptedError:
+        readable = []
+
+    return [watcher for watcher in watchers if watcher.fd in readable]